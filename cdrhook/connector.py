@@ -1,7 +1,11 @@
 import logging
+import time
+import urllib.parse
 import requests
-from typing import List, Optional
-from pydantic import BaseModel, Field, AnyUrl
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Callable, Dict, List, Optional
+from pydantic import BaseModel, Field, AnyUrl, PrivateAttr
 
 class CdrConnector(BaseModel):
     """
@@ -33,7 +37,64 @@ class CdrConnector(BaseModel):
     registration : Optional[str] = Field(
         default=None,
         description="The registration ID returned by the CDR")
-    
+    pool_size : int = Field(
+        default=10,
+        description="The number of connections to keep open to the CDR")
+    timeout : float = Field(
+        default=60,
+        description="The default timeout in seconds for requests to the CDR")
+    endpoint_timeouts : Dict[str, float] = Field(
+        default_factory=dict,
+        description="Timeouts in seconds for specific endpoints, the key is matched against the endpoint url")
+    max_retries : int = Field(
+        default=3,
+        description="The number of times to retry a failed request to the CDR")
+    backoff_factor : float = Field(
+        default=0.5,
+        description="The exponential backoff factor in seconds between retries, unless the CDR sends a Retry-After header")
+    _session : requests.Session = PrivateAttr(default=None)
+    _observers : List[Callable] = PrivateAttr(default_factory=list)
+
+    def model_post_init(self, __context):
+        """
+        Create the session shared by all requests to the CDR, this will reuse
+        connections and retry requests that fail with a connection error or
+        a 429/5xx response.
+        """
+        retry = Retry(
+            total=self.max_retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=[429, 500, 502, 503, 504],
+            respect_retry_after_header=True,
+            raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry)
+        self._session = requests.Session()
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    @property
+    def session(self) -> requests.Session:
+        return self._session
+
+    def add_observer(self, observer:Callable[[str, float, int, str], None]):
+        """
+        Add a function that is called after each request made by retrieve_endpoint
+        with the endpoint name, the duration in seconds, the size of the response
+        in bytes and the status code (or the name of the exception if there was
+        no response). Used to collect metrics.
+        """
+        self._observers.append(observer)
+
+    def get_timeout(self, endpoint_url:str) -> float:
+        """
+        Return the timeout for the endpoint, using the first matching key in
+        endpoint_timeouts, or the default timeout.
+        """
+        for key, timeout in self.endpoint_timeouts.items():
+            if key in endpoint_url:
+                return timeout
+        return self.timeout
+
     def register(self):
         """
         Register our system to the CDR using the app_settings. The register call can fail if
@@ -58,7 +119,8 @@ class CdrConnector(BaseModel):
             "events": self.events
         }
         logging.info(f"Registering with CDR: [system_name : {registration['name']}, system_version : {registration['version']}, callback_url : {registration['callback_url']}")
-        r = requests.post(f"{self.cdr_url}user/me/register", json=registration, headers=headers)
+        url = f"{self.cdr_url}user/me/register"
+        r = self.session.post(url, json=registration, headers=headers, timeout=self.get_timeout(url))
         logging.debug(r.text)
         r.raise_for_status()
         self.registration = r.json()["id"]
@@ -72,7 +134,8 @@ class CdrConnector(BaseModel):
         # unregister from the CDR
         headers = {'Authorization': f"Bearer {self.token}"}
         logging.info("Unregistering with CDR")
-        r = requests.delete(f"{self.cdr_url}/user/me/register/{self.registration}", headers=headers)
+        url = f"{self.cdr_url}/user/me/register/{self.registration}"
+        r = self.session.delete(url, headers=headers, timeout=self.get_timeout(url))
         logging.info("Unregistered with CDR")
         r.raise_for_status()
         self.registration = None
@@ -111,7 +174,7 @@ class CdrConnector(BaseModel):
         if self.registration is not None:
             self.unregister()
 
-    def retrieve_endpoint(self, endpoint_url:str, schema:BaseModel=None, headers:dict=None):
+    def retrieve_endpoint(self, endpoint_url:str, schema:BaseModel=None, headers:dict=None, timeout:float=None, endpoint:str=None):
         """
         Retrieve data from a CDR endpoint. If a schema is provided, the data will be converted to that schema and validated.
 
@@ -119,6 +182,8 @@ class CdrConnector(BaseModel):
             endpoint_url (str): The URL of the endpoint to retrieve data from.
             schema (BaseModel, optional): A Pydantic schema to convert the data to. Defaults to None.
             headers (dict, optional): A dictionary of headers to include in the request.  Defaults to None.
+            timeout (float, optional): The timeout in seconds for the request. Defaults to the endpoint timeout.
+            endpoint (str, optional): The name of the endpoint reported to the observers. Defaults to the url path.
         
         Returns:
             A dictionary of the data from the endpoint or
@@ -131,8 +196,25 @@ class CdrConnector(BaseModel):
         """
         if headers is None:
             headers = {'Authorization': f'Bearer {self.token}'}
+        if timeout is None:
+            timeout = self.get_timeout(endpoint_url)
         logging.debug(f"Retrieving {endpoint_url}")
-        r = requests.get(endpoint_url, headers=headers)
+        start = time.perf_counter()
+        status = "error"
+        size = 0
+        try:
+            r = self.session.get(endpoint_url, headers=headers, timeout=timeout)
+            status = str(r.status_code)
+            size = len(r.content)
+        except requests.RequestException as e:
+            status = type(e).__name__
+            raise
+        finally:
+            if self._observers:
+                if endpoint is None:
+                    endpoint = urllib.parse.urlparse(endpoint_url).path
+                for observer in self._observers:
+                    observer(endpoint, time.perf_counter() - start, size, status)
         r.raise_for_status()
         response = r.json()
         if schema is not None:
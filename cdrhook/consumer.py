@@ -0,0 +1,176 @@
+import functools
+import logging
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, List, Optional
+
+import pika
+from pika.exceptions import AMQPError
+
+if TYPE_CHECKING:
+    from retry import RetryPolicy
+
+
+class KeyedConsumer:
+    """
+    Consume messages from a RabbitMQ queue and process up to `workers` messages
+    at the same time. Every message is assigned a key (for example the cog_id)
+    and all messages with the same key are handled by the same worker lane, in
+    the order they were received. The pika connection is not thread-safe, so
+    the workers never touch the channel, acks are scheduled on the consumer
+    thread using add_callback_threadsafe.
+    """
+    def __init__(self, rabbitmq_uri: str, queue: str, handler: Callable[[bytes], None], workers: int = 1,
+                 key: Optional[Callable[[bytes], str]] = None, queues: Optional[List[str]] = None,
+                 retry: Optional["RetryPolicy"] = None, pass_properties: bool = False,
+                 arguments: Optional[dict] = None):
+        """
+        Args:
+            rabbitmq_uri (str): The amqp uri of the RabbitMQ server.
+            queue (str): The queue to consume messages from.
+            handler (Callable[[bytes], None]): Called with the body of each message, exceptions are logged.
+            workers (int, optional): The number of messages processed concurrently. Defaults to 1.
+            key (Callable[[bytes], str], optional): Returns the ordering key for a message. Defaults to None,
+                in which case all messages share the same lane when there is a single worker, or are spread
+                round robin otherwise.
+            queues (List[str], optional): Additional queues to declare when connecting. Defaults to None.
+            retry (RetryPolicy, optional): Used to retry messages for which the handler raised an
+                exception. Defaults to None, in which case the exception is logged and the message acked.
+            pass_properties (bool, optional): Call the handler with the body and the properties of the
+                message, for example to read the headers. Defaults to False.
+            arguments (dict, optional): Arguments to declare the queue with, for example the
+                maximum priority. Defaults to None.
+        """
+        self.rabbitmq_uri = rabbitmq_uri
+        self.queue = queue
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.key = key
+        self.queues = queues or []
+        self.retry = retry
+        self.pass_properties = pass_properties
+        self.arguments = arguments
+        self.processed = 0
+        self._next_lane = 0
+        self._inflight = 0
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._stopped = threading.Event()
+        self._connection = None
+        self._channel = None
+        self._lanes = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{queue}-{i}") for i in range(self.workers)]
+
+    @property
+    def inflight(self) -> int:
+        with self._lock:
+            return self._inflight
+
+    def lane(self, body: bytes) -> int:
+        """
+        Pick the worker lane for the message, messages with the same key always
+        end up in the same lane.
+        """
+        if self.key is not None:
+            try:
+                return zlib.crc32(self.key(body).encode("utf-8")) % self.workers
+            except Exception:
+                logging.debug("Could not compute key for message, using round robin", exc_info=True)
+        self._next_lane = (self._next_lane + 1) % self.workers
+        return self._next_lane
+
+    def run(self):
+        """
+        Connect to RabbitMQ and process messages until stop is called, reconnecting
+        if the connection is lost.
+        """
+        while not self._stopping.is_set():
+            try:
+                self._connection = pika.BlockingConnection(pika.URLParameters(self.rabbitmq_uri))
+                self._channel = self._connection.channel()
+                self._channel.queue_declare(queue=self.queue, durable=True, arguments=self.arguments)
+                for queue in self.queues:
+                    self._channel.queue_declare(queue=queue, durable=True)
+                if self.retry is not None:
+                    self.retry.declare(self._channel)
+                self._channel.basic_qos(prefetch_count=self.workers)
+                self._channel.basic_consume(queue=self.queue, on_message_callback=self._on_message, auto_ack=False)
+                self._channel.start_consuming()
+                self._drain()
+                self._connection.close()
+            except Exception:
+                logging.exception(f"Error consuming from {self.queue}.")
+            if not self._stopping.is_set():
+                time.sleep(5)
+        for lane in self._lanes:
+            lane.shutdown(wait=True)
+        self._stopped.set()
+
+    def _on_message(self, channel, method, properties, body):
+        connection = self._connection
+        with self._lock:
+            self._inflight += 1
+        self._lanes[self.lane(body)].submit(self._work, connection, channel, method.delivery_tag, properties, body)
+
+    def _work(self, connection, channel, delivery_tag, properties, body):
+        exception = None
+        try:
+            if self.pass_properties:
+                self.handler(body, properties)
+            else:
+                self.handler(body)
+        except Exception as e:
+            logging.exception(f"Error handling message from {self.queue}.")
+            exception = e
+        try:
+            connection.add_callback_threadsafe(functools.partial(self._ack, channel, delivery_tag, properties, body,
+                                                                 exception))
+        except AMQPError:
+            # connection is gone, the message will be redelivered by the broker
+            logging.warning(f"Could not ack message from {self.queue}, connection closed")
+            with self._lock:
+                self._inflight -= 1
+
+    def _publish(self, channel, queue_name, body, properties, arguments=None):
+        channel.basic_publish(exchange='', routing_key=queue_name, body=body, properties=properties)
+
+    def _ack(self, channel, delivery_tag, properties=None, body=None, exception=None):
+        with self._lock:
+            self._inflight -= 1
+            self.processed += 1
+        if not channel.is_open:
+            return
+        if exception is not None and self.retry is not None:
+            # the retry is published before the ack, so the message is never lost
+            try:
+                self.retry.retry(functools.partial(self._publish, channel), body, properties, exception)
+            except AMQPError:
+                logging.exception(f"Could not retry message from {self.queue}, it will be redelivered")
+                return
+        channel.basic_ack(delivery_tag=delivery_tag)
+
+    def _drain(self):
+        """
+        Wait for the messages that are being processed to finish, sending their
+        acks, before the connection is closed.
+        """
+        while self.inflight > 0 and self._connection.is_open:
+            self._connection.process_data_events(time_limit=0.5)
+
+    def stop(self, timeout: Optional[float] = None) -> bool:
+        """
+        Stop consuming new messages and wait for the messages in flight to be
+        processed and acked.
+
+        Returns:
+            bool: True if all messages were drained before the timeout.
+        """
+        self._stopping.set()
+        connection, channel = self._connection, self._channel
+        if connection is not None and connection.is_open:
+            try:
+                connection.add_callback_threadsafe(channel.stop_consuming)
+            except AMQPError:
+                pass
+        return self._stopped.wait(timeout)
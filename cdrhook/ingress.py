@@ -0,0 +1,151 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+# events that are processed by the cdrhook, everything else is ignored
+KNOWN_EVENTS = ["ping", "ncsacog", "map.process", "feature.process"]
+
+# prefix of the feature.process events that are processed
+PROCESSED_FEATURES = "uncharted-area_"
+
+# priorities of the messages in the queues, higher is processed first. A cog
+# requested by hand goes before the validated areas from the CDR, which go
+# before the bulk backfill of cogs. Cogs in an active CMA get a boost.
+PRIORITY_MANUAL = 8
+PRIORITY_EVENT = 5
+PRIORITY_BULK = 1
+PRIORITY_CMA_BOOST = 2
+
+
+def event_name(data : dict) -> str:
+    """
+    Return the event of the message, used as label in the metrics.
+    """
+    event = data.get("event")
+    return event if event in KNOWN_EVENTS else "other"
+
+
+def event_id(data : dict) -> str:
+    """
+    Return the id of the event of a feature.process message.
+    """
+    return str(data.get("payload", {}).get("id", "")).strip()
+
+
+def is_handled(data : dict) -> bool:
+    """
+    Return True if the cdrhook does something with the message, the other
+    messages are only logged by the consumer.
+    """
+    event = data.get("event")
+    if event in ("ping", "ncsacog"):
+        return True
+    if event == "feature.process":
+        return event_id(data).startswith(PROCESSED_FEATURES)
+    return False
+
+
+def message_priority(data : dict, manual : bool=False) -> int:
+    """
+    Return the priority of an incoming message, manual is True if the message
+    was sent by an operator instead of the CDR.
+    """
+    if manual:
+        return PRIORITY_MANUAL
+    if data.get("event") == "feature.process":
+        return PRIORITY_EVENT
+    return PRIORITY_BULK
+
+
+def coalesce_key(data : dict) -> Optional[Tuple]:
+    """
+    Return the key of the work the message triggers, messages with the same
+    key do the same work. None if the message is never coalesced.
+    """
+    event = data.get("event")
+    if event == "ncsacog":
+        parameters = json.dumps(data.get("parameters", {}), sort_keys=True)
+        return (event, str(data.get("cog_id", "")).strip(), parameters)
+    if event == "feature.process":
+        return (event, event_id(data))
+    return None
+
+
+class IngressFilter:
+    """
+    Decides which incoming messages are queued. Messages the cdrhook does not
+    handle are dropped, and a message that triggers the same work as a
+    message that is still waiting in the queue is merged into it. A key stays
+    pending until the consumer starts processing it, or at most window
+    seconds, so a trigger that arrives while the work is running is queued.
+    A message with a higher priority than the waiting one is queued as well,
+    so it is not stuck behind the lower priority messages.
+    """
+    def __init__(self, drop_unhandled : bool=True, window : float=300, max_keys : int=10000):
+        """
+        Args:
+            drop_unhandled (bool, optional): Drop messages the cdrhook does not handle. Defaults to True.
+            window (float, optional): Longest time in seconds a message can absorb repeats,
+                0 disables coalescing. Defaults to 300.
+            max_keys (int, optional): Maximum number of pending keys remembered. Defaults to 10000.
+        """
+        self.drop_unhandled = drop_unhandled
+        self.window = window
+        self.max_keys = max_keys
+        self.accepted = 0
+        self.dropped = 0
+        self.merged = 0
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+
+    def accept(self, data : dict, now : Optional[float]=None, priority : Optional[int]=None) -> str:
+        """
+        Decide what happens with an incoming message.
+
+        Args:
+            data (dict): The incoming message.
+            now (float, optional): The current time. Defaults to time.time().
+            priority (int, optional): The priority the message is queued with. Defaults to None.
+
+        Returns:
+            str: "accepted" if the message should be queued, "dropped" if it is not
+                handled or "merged" if the same work is already queued.
+        """
+        now = now or time.time()
+        if self.drop_unhandled and not is_handled(data):
+            with self._lock:
+                self.dropped += 1
+            return "dropped"
+        key = coalesce_key(data) if self.window > 0 else None
+        with self._lock:
+            if key is not None:
+                queued = self._pending.get(key)
+                if queued is not None and now - queued[0] < self.window and (priority or 0) <= (queued[1] or 0):
+                    self.merged += 1
+                    return "merged"
+                self._pending.pop(key, None)
+                self._pending[key] = (now, priority)
+                while len(self._pending) > self.max_keys:
+                    self._pending.popitem(last=False)
+            self.accepted += 1
+        return "accepted"
+
+    def started(self, data : dict):
+        """
+        Called when the consumer starts processing a message, new triggers for
+        the same work are queued again.
+        """
+        key = coalesce_key(data)
+        if key is not None:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def report(self) -> dict:
+        """
+        Return the number of messages accepted, dropped and merged.
+        """
+        with self._lock:
+            return {"accepted": self.accepted, "dropped": self.dropped, "merged": self.merged,
+                    "pending": len(self._pending)}
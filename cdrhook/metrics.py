@@ -0,0 +1,50 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+# buckets used for requests to the CDR and RabbitMQ, in seconds
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# buckets used for the size of responses from the CDR, in bytes
+SIZE_BUCKETS = (1024, 10 * 1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024, 100 * 1024 * 1024)
+
+CDR_REQUEST_SECONDS = Histogram(
+    "cdrhook_cdr_request_seconds", "Time spent on requests to the CDR",
+    ["endpoint", "status"], buckets=LATENCY_BUCKETS)
+
+CDR_RESPONSE_BYTES = Histogram(
+    "cdrhook_cdr_response_bytes", "Size of the responses from the CDR",
+    ["endpoint"], buckets=SIZE_BUCKETS)
+
+EVENTS = Counter(
+    "cdrhook_events_total", "Messages handled by the cdrhook, by event type",
+    ["event", "result"])
+
+INGRESS = Counter(
+    "cdrhook_ingress_total", "Incoming messages by event type and if they were accepted, dropped or merged",
+    ["event", "result"])
+
+PROCESS_COG_SECONDS = Histogram(
+    "cdrhook_process_cog_seconds", "Time spent processing a cog, by phase",
+    ["phase"], buckets=LATENCY_BUCKETS)
+
+MODELS_PER_COG = Histogram(
+    "cdrhook_models_per_cog", "Number of models fired for each cog",
+    buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10))
+
+PUBLISH_SECONDS = Histogram(
+    "cdrhook_publish_seconds", "Time spent publishing a message to RabbitMQ",
+    ["queue"], buckets=LATENCY_BUCKETS)
+
+SPOOL_DEPTH = Gauge(
+    "cdrhook_spool_depth", "Webhook messages in the spool waiting to be sent to RabbitMQ")
+
+SPOOL_AGE_SECONDS = Gauge(
+    "cdrhook_spool_age_seconds", "Age of the oldest webhook message in the spool")
+
+
+def observe_cdr_request(endpoint, seconds, size, status):
+    """
+    Observer for the CdrConnector, records the latency, status and size of
+    each request to the CDR.
+    """
+    CDR_REQUEST_SECONDS.labels(endpoint, status).observe(seconds)
+    CDR_RESPONSE_BYTES.labels(endpoint).observe(size)
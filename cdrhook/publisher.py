@@ -0,0 +1,206 @@
+import json
+import logging
+import queue
+import threading
+import time
+import pika
+from pika.exceptions import AMQPError
+
+
+class PooledChannel:
+    """
+    A single long lived connection to RabbitMQ with one channel. The channel
+    remembers which queues it has already declared so we only declare a queue
+    once per connection.
+    """
+    def __init__(self, parameters: pika.URLParameters, confirm: bool = True):
+        self.connection = pika.BlockingConnection(parameters)
+        self.channel = self.connection.channel()
+        if confirm:
+            self.channel.confirm_delivery()
+        self.declared = set()
+
+    @property
+    def is_open(self) -> bool:
+        return self.connection.is_open and self.channel.is_open
+
+    def declare(self, queue_name: str, arguments: dict = None):
+        """
+        Declare the queue, unless it was already declared on this channel.
+        """
+        if queue_name not in self.declared:
+            self.channel.queue_declare(queue=queue_name, durable=True, arguments=arguments)
+            self.declared.add(queue_name)
+
+    def close(self):
+        try:
+            if self.connection.is_open:
+                self.connection.close()
+        except AMQPError:
+            logging.debug("Ignoring error closing pooled RabbitMQ connection", exc_info=True)
+
+
+class RabbitPublisher:
+    """
+    Thread-safe publisher that keeps a small pool of persistent RabbitMQ
+    channels. A BlockingConnection is not thread-safe, so each channel in the
+    pool owns its own connection and is only ever used by one thread at a time.
+    Channels use publisher confirms, cache their queue declarations and are
+    replaced automatically when the connection to RabbitMQ is lost.
+    """
+    def __init__(self, rabbitmq_uri: str, pool_size: int = 4, confirm: bool = True, attempts: int = 2,
+                 queue_arguments: dict = None):
+        """
+        Args:
+            rabbitmq_uri (str): The amqp uri of the RabbitMQ server.
+            pool_size (int, optional): The maximum number of open channels. Defaults to 4.
+            confirm (bool, optional): Wait for the broker to confirm each message. Defaults to True.
+            attempts (int, optional): Number of times to try publishing a message, reconnecting in
+                between. Defaults to 2.
+            queue_arguments (dict, optional): Arguments to declare a queue with, keyed by queue name,
+                used when publish is not given arguments. Defaults to None.
+        """
+        self.parameters = pika.URLParameters(rabbitmq_uri)
+        self.pool_size = pool_size
+        self.confirm = confirm
+        self.attempts = attempts
+        self.queue_arguments = queue_arguments or {}
+        self.published = 0
+        self.reconnects = 0
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _connect(self) -> PooledChannel:
+        return PooledChannel(self.parameters, confirm=self.confirm)
+
+    def _acquire(self) -> PooledChannel:
+        """
+        Get a channel from the pool, blocking if all channels are in use. A new
+        channel is opened if there are no idle channels, or the idle channel has
+        been closed by the broker.
+        """
+        if self._closed:
+            raise RuntimeError("Publisher has been closed")
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    entry = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if entry.is_open:
+                    return entry
+                entry.close()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _release(self, entry: PooledChannel, broken: bool = False):
+        if broken or self._closed:
+            entry.close()
+        else:
+            self._idle.put(entry)
+        self._slots.release()
+
+    def publish(self, message, queue_name: str, properties: pika.BasicProperties = None, arguments: dict = None):
+        """
+        Publish a message to the queue, declaring the queue if needed.
+
+        Args:
+            message: The message to send, anything that is not bytes or str is json encoded.
+            queue_name (str): The queue to publish the message to.
+            properties (pika.BasicProperties, optional): Properties for the message. Defaults to
+                a persistent message with the current time as timestamp.
+            arguments (dict, optional): Arguments to declare the queue with, for example the
+                time to live of a delay queue. Defaults to None.
+
+        Raises:
+            pika.exceptions.AMQPError: If the message could not be published after all attempts.
+        """
+        if isinstance(message, (bytes, str)):
+            body = message
+        else:
+            body = json.dumps(message)
+        if properties is None:
+            properties = pika.BasicProperties(delivery_mode=pika.DeliveryMode.Persistent, timestamp=int(time.time()))
+        if arguments is None:
+            arguments = self.queue_arguments.get(queue_name)
+
+        for attempt in range(1, self.attempts + 1):
+            entry = self._acquire()
+            try:
+                # service heartbeats that were missed while the channel was idle
+                entry.connection.process_data_events(0)
+                entry.declare(queue_name, arguments)
+                entry.channel.basic_publish(exchange='', routing_key=queue_name, properties=properties, body=body)
+            except AMQPError:
+                self._release(entry, broken=True)
+                if attempt >= self.attempts:
+                    raise
+                logging.warning("Lost RabbitMQ channel publishing to %s, reconnecting", queue_name, exc_info=True)
+                with self._lock:
+                    self.reconnects += 1
+                continue
+            self._release(entry)
+            with self._lock:
+                self.published += 1
+            return
+
+    def publish_batch(self, messages: list, queue_name: str, arguments: dict = None) -> int:
+        """
+        Publish a list of messages to the queue using a single channel. With
+        publisher confirms each message is confirmed before the next is sent, if
+        the channel is lost the remaining messages are sent on a new channel.
+
+        Args:
+            messages (list): List of (message, properties), the message is encoded like publish.
+            queue_name (str): The queue to publish the messages to.
+            arguments (dict, optional): Arguments to declare the queue with. Defaults to None.
+
+        Returns:
+            int: The number of messages published.
+
+        Raises:
+            pika.exceptions.AMQPError: If the messages could not be published after all attempts.
+        """
+        if arguments is None:
+            arguments = self.queue_arguments.get(queue_name)
+        sent = 0
+        for attempt in range(1, self.attempts + 1):
+            entry = self._acquire()
+            try:
+                entry.connection.process_data_events(0)
+                entry.declare(queue_name, arguments)
+                while sent < len(messages):
+                    message, properties = messages[sent]
+                    body = message if isinstance(message, (bytes, str)) else json.dumps(message)
+                    if properties is None:
+                        properties = pika.BasicProperties(delivery_mode=pika.DeliveryMode.Persistent,
+                                                          timestamp=int(time.time()))
+                    entry.channel.basic_publish(exchange='', routing_key=queue_name, properties=properties, body=body)
+                    sent += 1
+                    with self._lock:
+                        self.published += 1
+            except AMQPError:
+                self._release(entry, broken=True)
+                if attempt >= self.attempts:
+                    raise
+                logging.warning("Lost RabbitMQ channel publishing to %s, reconnecting", queue_name, exc_info=True)
+                with self._lock:
+                    self.reconnects += 1
+                continue
+            self._release(entry)
+            return sent
+
+    def close(self):
+        """
+        Close all idle channels, channels in use are closed when they are released.
+        """
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
@@ -1,10 +1,223 @@
-from typing import List, Literal
+import hashlib
+import logging
+import os
+import pickle
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterator, List, Literal, Optional, Tuple
+from pydantic import BaseModel
 from connector import CdrConnector
 from cdr_endpoint_schemas import SystemId, CogSystemVersionsSchema, CogMetadataSchema, CogDownloadSchema
 from cdr_schemas.cdr_responses.area_extractions import AreaExtractionResponse
 from cdr_schemas.cdr_responses.legend_items import LegendItemResponse
 from cdr_schemas.map_results import MapResults
 
+# region Cache
+class RetrieveCache:
+    """
+    LRU cache with a time to live for responses from the CDR. Entries are keyed
+    by endpoint, cog_id, system_version and validated. If a directory is given
+    entries are also written to disk (using the same xx/yy/cog_id layout as the
+    data folder) so they survive a restart of the cdrhook. Expired files are
+    removed when the cache is created and every prune_interval seconds after.
+    """
+    def __init__(self, max_entries:int=1024, ttl:float=600, directory:Optional[str]=None,
+                 prune_interval:Optional[float]=None):
+        """
+        Args:
+            max_entries (int, optional): The maximum number of entries kept in memory. Defaults to 1024.
+            ttl (float, optional): Number of seconds an entry is valid. Defaults to 600.
+            directory (str, optional): Folder to persist entries to. Defaults to None (memory only).
+            prune_interval (float, optional): Seconds between removing expired files from the
+                directory. Defaults to the ttl.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.prune_interval = ttl if prune_interval is None else prune_interval
+        self.hits = 0
+        self.misses = 0
+        self.pruned = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._pruning = False
+        self._last_prune = time.time()
+        if self.directory:
+            self.prune()
+
+    @staticmethod
+    def make_key(endpoint:str, cog_id:str, system_id:Optional[SystemId]=None, validated:Optional[str]=None) -> Tuple:
+        system_version = f"{system_id.name}__{system_id.version}" if system_id is not None else None
+        return (endpoint, cog_id, system_version, validated)
+
+    def _cog_folder(self, cog_id:str) -> str:
+        return os.path.join(self.directory, cog_id[0:2], cog_id[2:4], cog_id)
+
+    def _filename(self, key:Tuple) -> str:
+        digest = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self._cog_folder(key[1]), f"{digest}.pkl")
+
+    def _load(self, key:Tuple) -> Optional[Tuple[float, Any]]:
+        filename = self._filename(key)
+        try:
+            with open(filename, "rb") as fh:
+                return pickle.load(fh)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logging.warning(f"Removing unreadable cache file {filename}", exc_info=True)
+            self._remove(filename)
+            return None
+
+    def _save(self, key:Tuple, entry:Tuple[float, Any]):
+        filename = self._filename(key)
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            tmpname = f"{filename}.{threading.get_ident()}.tmp"
+            with open(tmpname, "wb") as fh:
+                pickle.dump(entry, fh)
+            os.replace(tmpname, filename)
+        except OSError:
+            logging.warning(f"Could not write cache file {filename}", exc_info=True)
+
+    @staticmethod
+    def _remove(filename:str):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    def get(self, key:Tuple) -> Tuple[bool, Any]:
+        """
+        Return (True, value) if the key is in the cache and not expired, (False, None) otherwise.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry[0] < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, entry[1]
+                del self._entries[key]
+        if self.directory:
+            entry = self._load(key)
+            if entry is not None:
+                if now - entry[0] < self.ttl:
+                    with self._lock:
+                        self._store(key, entry)
+                        self.hits += 1
+                    return True, entry[1]
+                self._remove(self._filename(key))
+        with self._lock:
+            self.misses += 1
+        return False, None
+
+    def _store(self, key:Tuple, entry:Tuple[float, Any]):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def put(self, key:Tuple, value:Any):
+        entry = (time.time(), value)
+        with self._lock:
+            self._store(key, entry)
+            start_prune = self.directory and not self._pruning and entry[0] - self._last_prune >= self.prune_interval
+            if start_prune:
+                self._pruning = True
+        if self.directory:
+            self._save(key, entry)
+        if start_prune:
+            threading.Thread(target=self.prune, name="cache-prune", daemon=True).start()
+
+    def prune(self) -> int:
+        """
+        Remove the expired files, and the folders left empty, from the directory.
+
+        Returns:
+            int: The number of files removed.
+        """
+        removed = 0
+        try:
+            if not self.directory or not os.path.isdir(self.directory):
+                return 0
+            expired = time.time() - self.ttl
+            for root, _, files in os.walk(self.directory, topdown=False):
+                for name in files:
+                    filename = os.path.join(root, name)
+                    try:
+                        if os.path.getmtime(filename) < expired:
+                            os.remove(filename)
+                            removed += 1
+                    except OSError:
+                        pass
+                if root != self.directory:
+                    try:
+                        os.rmdir(root)
+                    except OSError:
+                        pass
+            if removed:
+                logging.debug(f"Removed {removed} expired files from the CDR cache")
+            return removed
+        finally:
+            with self._lock:
+                self.pruned += removed
+                self._pruning = False
+                self._last_prune = time.time()
+
+    def invalidate(self, cog_id:str):
+        """
+        Remove all entries for the cog, for example when new features are posted for it.
+        """
+        with self._lock:
+            for key in [k for k in self._entries if k[1] == cog_id]:
+                del self._entries[key]
+        if self.directory:
+            shutil.rmtree(self._cog_folder(cog_id), ignore_errors=True)
+        logging.debug(f"Cog-{cog_id[0:8]} - Invalidated cached CDR responses")
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+retrieve_cache : Optional[RetrieveCache] = None
+
+def set_retrieve_cache(cache:Optional[RetrieveCache]):
+    """
+    Set the cache used by the retrieve functions, None disables caching.
+    """
+    global retrieve_cache
+    retrieve_cache = cache
+
+def invalidate_cog(cog_id:str):
+    """
+    Remove all cached responses for the cog.
+    """
+    if retrieve_cache is not None:
+        retrieve_cache.invalidate(cog_id)
+
+def cached_retrieve(endpoint:str, cog_id:str, fetch:Callable[[], Any], system_id:Optional[SystemId]=None, validated:Optional[str]=None) -> Any:
+    """
+    Return the cached response for the endpoint, or call fetch and cache the result.
+    Empty results are not cached, the data could be posted to the CDR later.
+    Lists are copied so callers can not modify the cached value.
+    """
+    if retrieve_cache is None:
+        return fetch()
+    key = RetrieveCache.make_key(endpoint, cog_id, system_id, validated)
+    found, value = retrieve_cache.get(key)
+    if not found:
+        value = fetch()
+        if value is not None and not (isinstance(value, list) and len(value) == 0):
+            retrieve_cache.put(key, value)
+    if isinstance(value, list):
+        return list(value)
+    return value
+# endregion Cache
+
 # region Cog Endpoints
 def retrieve_cog_download(connection:CdrConnector, cog_id:str) -> CogDownloadSchema:
     """
@@ -22,7 +235,7 @@ def retrieve_cog_download(connection:CdrConnector, cog_id:str) -> CogDownloadSch
         pydantic.ValidationError: If the data returned from the CDR does not match the CogDownloadSchema format.
     """
     endpoint_url = f"{connection.cdr_url}/v1/maps/cog/{cog_id}"
-    return connection.retrieve_endpoint(endpoint_url, schema=CogDownloadSchema)
+    return cached_retrieve("cog_download", cog_id, lambda: connection.retrieve_endpoint(endpoint_url, schema=CogDownloadSchema, endpoint="cog_download"))
 
 def retrieve_cog_metadata(connection:CdrConnector, cog_id:str) -> CogMetadataSchema:
     """
@@ -40,7 +253,7 @@ def retrieve_cog_metadata(connection:CdrConnector, cog_id:str) -> CogMetadataSch
         pydantic.ValidationError: If the data returned from the CDR does not match the CogMetadataSchema format.
     """
     endpoint_url = f"{connection.cdr_url}/v1/maps/cog/meta/{cog_id}"
-    return connection.retrieve_endpoint(endpoint_url, schema=CogMetadataSchema)
+    return connection.retrieve_endpoint(endpoint_url, schema=CogMetadataSchema, endpoint="cog_metadata")
 
 def retrieve_cog_results(connection:CdrConnector, cog_id:str) -> List[MapResults]:
     """
@@ -58,7 +271,7 @@ def retrieve_cog_results(connection:CdrConnector, cog_id:str) -> List[MapResults
         pydantic.ValidationError: If the data returned from the CDR does not match the MapResults format.
     """
     endpoint_url = f"{connection.cdr_url}/v1/maps/cog/{cog_id}/results"
-    return connection.retrieve_endpoint(endpoint_url, schema=MapResults)
+    return connection.retrieve_endpoint(endpoint_url, schema=MapResults, endpoint="cog_results")
     # response_data['cog_id'] = cog_id # Need to add cog_id to the response to conform to cdr_schema
     # return response_data
 
@@ -91,11 +304,87 @@ def retrieve_cog_system_versions(connection:CdrConnector, cog_id:str, type:Liter
     endpoint_url = f"{connection.cdr_url}/v1/features/{cog_id}/system_versions"
     if type != 'any':
         endpoint_url += f"?type={type}"
-    response = connection.retrieve_endpoint(endpoint_url)
-    system_versions = [SystemId(name=item[0], version=item[1]) for item in response]
-    return CogSystemVersionsSchema(system_versions=system_versions)
+    def fetch():
+        response = connection.retrieve_endpoint(endpoint_url, endpoint="system_versions")
+        system_versions = [SystemId(name=item[0], version=item[1]) for item in response]
+        return CogSystemVersionsSchema(system_versions=system_versions)
+    return cached_retrieve(f"system_versions:{type}", cog_id, fetch)
 
-def retrieve_cog_area_extraction(connection:CdrConnector, cog_id:str, system_id:SystemId=None, validated:Literal['any','false','true']="any", items:int=5000) -> List[AreaExtractionResponse]:
+def iterate_pages(connection:CdrConnector, endpoint_url:str, schema:BaseModel, page_size:int=1000, max_items:Optional[int]=None, required_categories:Optional[Dict[str,int]]=None, endpoint:Optional[str]=None) -> Iterator[BaseModel]:
+    """
+    Page through a CDR endpoint that supports page/size parameters, yielding validated items. Only a single
+    page is kept in memory at a time.
+
+    Args:
+        connection (CdrConnector): A CdrConnector with a registered connection.
+        endpoint_url (str): The URL of the endpoint, without page and size parameters.
+        schema (BaseModel): The Pydantic schema used to validate each item.
+        page_size (int, optional): The number of items to request per page. Defaults to 1000.
+        max_items (int, optional): The maximum number of items to retrieve. Defaults to None (all items).
+        required_categories (Dict[str,int], optional): Stop once at least this many items of each category have
+            been seen, for example {"map_area": 1, "polygon_legend_area": 1}. Defaults to None (no early stop).
+        endpoint (str, optional): The name of the endpoint used for metrics. Defaults to None (the url path).
+
+    Yields:
+        Validated items from the endpoint.
+
+    Raises:
+        requests.HTTPError: If a request fails
+        pydantic.ValidationError: If an item does not match the schema
+    """
+    separator = "&" if "?" in endpoint_url else "?"
+    needed = dict(required_categories) if required_categories else None
+    count = 0
+    page = 0
+    while max_items is None or count < max_items:
+        response = connection.retrieve_endpoint(f"{endpoint_url}{separator}page={page}&size={page_size}", endpoint=endpoint)
+        for item in response:
+            if max_items is not None and count >= max_items:
+                return
+            item = schema.model_validate(item)
+            count += 1
+            yield item
+            if needed is not None and item.category in needed:
+                needed[item.category] -= 1
+                if needed[item.category] <= 0:
+                    del needed[item.category]
+                if not needed:
+                    return
+        if len(response) < page_size:
+            return
+        page += 1
+
+def iterate_cog_area_extraction(connection:CdrConnector, cog_id:str, system_id:SystemId=None, validated:Literal['any','false','true']="any", page_size:int=1000, items:Optional[int]=None, required_categories:Optional[Dict[str,int]]=None) -> Iterator[AreaExtractionResponse]:
+    """
+    Iterate over the area extraction data for a given cog from the cdr, one page at a time.
+
+    Args:
+        connection (CdrConnector): A CdrConnector with a registered connection.
+        cog_id (str): The id of the cog to retrieve data for
+        system_id (SystemId, optional): The system id to filter the data by. Defaults to None.
+        validated (Literal['any','false','true'], optional): The validation status of the data. Defaults to "any".
+        page_size (int, optional): The number of items to request per page. Defaults to 1000.
+        items (int, optional): The maxium number of items to retrieve. Defaults to None (all items).
+        required_categories (Dict[str,int], optional): Stop once enough areas of each category are seen. Defaults to None.
+
+    Yields:
+        AreaExtractionResponse: The area extractions for the cog.
+
+    Raises:
+        requests.HTTPError: If the request fails
+        pydantic.ValidationError: If the data returned does not match the AreaExtractionResponse format.
+    """
+    endpoint_url = f"{connection.cdr_url}/v1/features/{cog_id}/area_extractions"
+    params = []
+    if system_id is not None:
+        params.append(f"system_version={system_id.name}__{system_id.version}")
+    if validated.lower() in ['true','false']:
+        params.append(f"validated={validated.lower()}")
+    if params:
+        endpoint_url += "?" + "&".join(params)
+    return iterate_pages(connection, endpoint_url, AreaExtractionResponse, page_size=page_size, max_items=items, required_categories=required_categories, endpoint="area_extractions")
+
+def retrieve_cog_area_extraction(connection:CdrConnector, cog_id:str, system_id:SystemId=None, validated:Literal['any','false','true']="any", items:Optional[int]=None, page_size:int=1000) -> List[AreaExtractionResponse]:
     """
     Retreive area extraction data for a given cog from the cdr.
 
@@ -104,7 +393,8 @@ def retrieve_cog_area_extraction(connection:CdrConnector, cog_id:str, system_id:
         cog_id (str): The id of the cog to retrieve data for
         system_id (SystemId, optional): The system id to filter the data by. Defaults to None.
         validated (Literal['any','false','true'], optional): The validation status of the data. Defaults to "any".
-        items (int, optional): The maxium number of items to retrieve. Defaults to 5000.
+        items (int, optional): The maxium number of items to retrieve. Defaults to None (all items).
+        page_size (int, optional): The number of items to request per page. Defaults to 1000.
 
     Returns:
         List[AreaExtractionResponse]: A list of area extraction responses.
@@ -113,14 +403,41 @@ def retrieve_cog_area_extraction(connection:CdrConnector, cog_id:str, system_id:
         requests.HTTPError: If the request fails
         pydantic.ValidationError: If the data returned does not match the AreaExtractionResponse format.
     """
-    endpoint_url = f"{connection.cdr_url}/v1/features/{cog_id}/area_extractions?size={items}"
+    def fetch():
+        return list(iterate_cog_area_extraction(connection, cog_id, system_id=system_id, validated=validated, page_size=page_size, items=items))
+    return cached_retrieve(f"area_extractions:{items}", cog_id, fetch, system_id=system_id, validated=validated.lower())
+
+def iterate_cog_legend_items(connection:CdrConnector, cog_id:str, system_id:SystemId=None, validated:Literal['any','false','true']="any", page_size:int=1000, items:Optional[int]=None, required_categories:Optional[Dict[str,int]]=None) -> Iterator[LegendItemResponse]:
+    """
+    Iterate over the legend items for a given cog from the cdr, one page at a time.
+
+    Args:
+        connection (CdrConnector): A CdrConnector with a registered connection.
+        cog_id (str): The id of the cog to retrieve data for
+        system_id (SystemId, optional): The system id to filter the data by. Defaults to None.
+        validated (Literal['any','false','true'], optional): The validation status of the data. Defaults to "any".
+        page_size (int, optional): The number of items to request per page. Defaults to 1000.
+        items (int, optional): The maxium number of items to retrieve. Defaults to None (all items).
+        required_categories (Dict[str,int], optional): Stop once enough legend items of each category are seen. Defaults to None.
+
+    Yields:
+        LegendItemResponse: The legend items for the cog.
+
+    Raises:
+        requests.HTTPError: If the request fails
+        pydantic.ValidationError: If the data returned does not match the LegendItemResponse format.
+    """
+    endpoint_url = f"{connection.cdr_url}/v1/features/{cog_id}/legend_items"
+    params = []
     if system_id is not None:
-        endpoint_url += f"&system_version={system_id.name}__{system_id.version}"
+        params.append(f"system_version={system_id.name}__{system_id.version}")
     if validated.lower() in ['true','false']:
-        endpoint_url += f"&validated={validated.lower()}"
-    return connection.retrieve_endpoint(endpoint_url, schema=AreaExtractionResponse)
+        params.append(f"validated={validated.lower()}")
+    if params:
+        endpoint_url += "?" + "&".join(params)
+    return iterate_pages(connection, endpoint_url, LegendItemResponse, page_size=page_size, max_items=items, required_categories=required_categories, endpoint="legend_items")
 
-def retrieve_cog_legend_items(connection:CdrConnector, cog_id:str, system_id:SystemId=None, validated:Literal['any','false','true']="any", items:int=5000) -> List[LegendItemResponse]:
+def retrieve_cog_legend_items(connection:CdrConnector, cog_id:str, system_id:SystemId=None, validated:Literal['any','false','true']="any", items:Optional[int]=None, page_size:int=1000) -> List[LegendItemResponse]:
     """
     Retrieve legend items for a given cog from the cdr.
 
@@ -129,7 +446,8 @@ def retrieve_cog_legend_items(connection:CdrConnector, cog_id:str, system_id:Sys
         cog_id (str): The id of the cog to retrieve data for
         system_id (SystemId, optional): The system id to filter the data by. Defaults to None.
         validated (Literal['any','false','true'], optional): The validation status of the data. Defaults to "any".
-        items (int, optional): The maxium number of items to retrieve. Defaults to 5000.
+        items (int, optional): The maxium number of items to retrieve. Defaults to None (all items).
+        page_size (int, optional): The number of items to request per page. Defaults to 1000.
 
     Returns:
         List[LegendItemResponse]: A list of legend items.
@@ -138,12 +456,9 @@ def retrieve_cog_legend_items(connection:CdrConnector, cog_id:str, system_id:Sys
         requests.HTTPError: If the request fails
         pydantic.ValidationError: If the data returned does not match the LegendItemResponse format.
     """
-    endpoint_url = f"{connection.cdr_url}/v1/features/{cog_id}/legend_items?size={items}"
-    if system_id is not None:
-        endpoint_url += f"&system_version={system_id.name}__{system_id.version}"
-    if validated.lower() in ['true','false']:
-        endpoint_url += f"&validated={validated.lower()}"
-    return connection.retrieve_endpoint(endpoint_url, schema=LegendItemResponse)
+    def fetch():
+        return list(iterate_cog_legend_items(connection, cog_id, system_id=system_id, validated=validated, page_size=page_size, items=items))
+    return cached_retrieve(f"legend_items:{items}", cog_id, fetch, system_id=system_id, validated=validated.lower())
 # endregion Cog Endpoints
 
 # region Event Endpoints
@@ -162,6 +477,6 @@ def retrieve_area_extraction_event(connection:CdrConnector, event_id:str) -> dic
         requests.HTTPError: If the request fails
     """
     endpoint_url = f"{connection.cdr_url}/v1/maps/extractions/{event_id}"
-    return connection.retrieve_endpoint(endpoint_url)
+    return connection.retrieve_endpoint(endpoint_url, endpoint="extraction_event")
 # endregion Event Endpoints
 
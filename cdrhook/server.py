@@ -1,11 +1,16 @@
 from flask import Flask, request, abort, current_app, send_from_directory
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 from flask_httpauth import HTTPBasicAuth
+from werkzeug.security import safe_join
 import os
 import logging
 import json
 import requests
 import hmac
 import hashlib
+import gzip
+import functools
+import itertools
 import urllib.parse
 import pika
 import signal
@@ -14,20 +19,32 @@ from waitress.server import create_server
 import threading
 import time
 from typing import Optional
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import cmaas_utils.cdr as convert
 from cmaas_utils.types import CMAAS_Map
-from cdr_schemas.cdr_responses.area_extractions import AreaType
+from cdr_schemas.cdr_responses.area_extractions import AreaType, AreaExtractionResponse
+from pydantic import TypeAdapter, ValidationError
 
-from retrieve import retrieve_cog_area_extraction, retrieve_cog_legend_items, retrieve_cog_system_versions, retrieve_cog_download
+from retrieve import retrieve_cog_area_extraction, retrieve_cog_legend_items, retrieve_cog_system_versions, retrieve_cog_download, \
+    retrieve_cog_metadata, retrieve_area_extraction_event, RetrieveCache, set_retrieve_cache, invalidate_cog
 from connector import CdrConnector
-from cdr_endpoint_schemas import SystemId
+from cdr_endpoint_schemas import SystemId, CogSystemVersionsSchema
+from publisher import RabbitPublisher
+from consumer import KeyedConsumer
+from retry import RetryPolicy
+from spool import Spool
+import ingress
+import metrics
+import tracing
 
 
 auth = HTTPBasicAuth()
 cdr_url = os.getenv("CDR_URL","https://api.cdr.land")
 
+# folder with the map data files, served by the download route
+data_folder = "/data"
+
 config = { }
 cdr_connector = None
 
@@ -70,73 +87,170 @@ def verify_password(username, password):
 # ----------------------------------------------------------------------
 # region Connection with RabbitMQ
 # ----------------------------------------------------------------------
-def send_message(message, queue):
+def send_message(message, queue, headers=None, priority=None):
+    """
+    Send a message to the RabbitMQ queue, using the shared pool of
+    persistent channels. The headers carry the trace of the cog.
+    """
+    properties = None
+    if headers or priority is not None:
+        properties = pika.BasicProperties(delivery_mode=pika.DeliveryMode.Persistent, timestamp=int(time.time()),
+                                          headers=headers, priority=priority)
+    with metrics.PUBLISH_SECONDS.labels(queue).time():
+        config["publisher"].publish(message, queue, properties)
+
+
+def receive_message(message, headers=None, priority=None):
     """
-    Send a message to the RabbitMQ queue
+    Accept a message for the cdrhook queue. Messages that are not handled by
+    the cdrhook are dropped, and messages for work that is already waiting in
+    the queue with the same or a higher priority are merged (see IngressFilter). If the spool is enabled the
+    message is written to the spool and sent by the forwarder, so the caller
+    does not wait for RabbitMQ. If no priority is given it is computed from
+    the message (see ingress.message_priority).
+
+    Returns:
+        str: accepted, dropped or merged.
     """
-    parameters = pika.URLParameters(config["rabbitmq_uri"])
-    connection = pika.BlockingConnection(parameters)
-    channel = connection.channel()
-    channel.queue_declare(queue=queue, durable=True)
-    properties = pika.BasicProperties(delivery_mode=2)
-    channel.basic_publish(exchange='', routing_key=queue, properties=properties, body=json.dumps(message))
-    channel.close()
-    connection.close()
+    queue = f'{config["prefix"]}cdrhook'
+    result = "accepted"
+    if priority is None and isinstance(message, dict):
+        priority = ingress.message_priority(message)
+    if config.get("ingress") and isinstance(message, dict):
+        result = config["ingress"].accept(message, priority=priority)
+        metrics.INGRESS.labels(ingress.event_name(message), result).inc()
+        if result != "accepted":
+            logging.debug("Message %s for event %s", result, message.get("event"))
+            if result == "merged" or not config["cdr_keep_event"]:
+                return result
+            # dropped messages are still kept for inspection
+            queue = f'{config["prefix"]}cdrhook.unknown'
+    if config.get("spool"):
+        config["spool"].append(queue, message, headers, priority)
+    else:
+        send_message(message, queue, headers, priority)
+    return result
+
+
+def forward_spooled(records):
+    """
+    Send the messages from the spool to RabbitMQ, in order and in batches per queue.
+    """
+    for queue, group in itertools.groupby(records, key=lambda r: r["queue"]):
+        messages = [(r["message"], pika.BasicProperties(delivery_mode=pika.DeliveryMode.Persistent,
+                                                        timestamp=int(r["time"]), headers=r["headers"],
+                                                        priority=r.get("priority")))
+                    for r in group]
+        with metrics.PUBLISH_SECONDS.labels(queue).time():
+            config["publisher"].publish_batch(messages, queue)
 
 # ----------------------------------------------------------------------
 # region Process maps
 # ----------------------------------------------------------------------
-def process_event(event_id):
+def group_event_extractions(data : list) -> dict:
+    """
+    Group the extractions of an event by cog, removing duplicate extractions.
+    For each cog this returns the systems that posted areas, and the area
+    extractions per system__version (None if the extractions could not be
+    validated, in which case they will be fetched from the CDR).
+    """
+    cogs = {}
+    for extraction in data:
+        cog_id = extraction["cog_id"]
+        system = f'{extraction["system"]}__{extraction["system_version"]}'
+        cog = cogs.setdefault(cog_id, {"systems": [], "areas": {}, "seen": set()})
+        if system not in cog["systems"]:
+            cog["systems"].append(system)
+            cog["areas"][system] = []
+        extraction_id = extraction.get("area_extraction_id")
+        if extraction_id:
+            if extraction_id in cog["seen"]:
+                continue
+            cog["seen"].add(extraction_id)
+        if cog["areas"][system] is None:
+            continue
+        try:
+            cog["areas"][system].append(AreaExtractionResponse.model_validate(extraction))
+        except ValidationError:
+            logging.debug(f"Cog-{cog_id[0:8]} - Could not use area extraction from event, will fetch areas for {system}")
+            cog["areas"][system] = None
+    for cog in cogs.values():
+        del cog["seen"]
+        cog["areas"] = {k: v for k, v in cog["areas"].items() if v}
+    return cogs
+
+def process_event(event_id, trace=None, priority=None):
     """
     Get the data from the event and submit to process_cog setting the
     legend and area parameters to be the system and system_version. This
-    might only be true for the uncharted area event.
+    might only be true for the uncharted area event. The extractions are
+    grouped by cog, and the cogs are processed concurrently reusing the
+    area extractions from the event. A failing cog does not stop the other
+    cogs, it is retried on its own as an ncsacog message. Each cog gets its
+    own trace, starting with the stages of the event, and the priority of
+    the event.
+
+    Returns a dict with for each cog_id None on success, or the exception.
     """
     # get the event information
-    headers = {'Authorization': f'Bearer {config["cdr_token"]}'}
-    r = requests.get(f"{cdr_url}/v1/maps/extractions/{event_id}", headers=headers)
-    r.raise_for_status()
-    data = r.json()
-
-    # get the cog
-    for extraction in data:
-        cog_id = extraction["cog_id"]
-        system_name = extraction["system"]
-        system_version = extraction["system_version"]
+    data = retrieve_area_extraction_event(config["cdr_connector"], event_id)
+    cogs = group_event_extractions(data)
+    logging.info(f"Event {event_id} has {len(data)} extractions for {len(cogs)} cogs")
+    traces = {cog_id: tracing.add_stage(tracing.fork(trace), "event") for cog_id in cogs}
+
+    def run(cog_id, cog):
+        # new features were posted for this cog, cached responses are stale
+        invalidate_cog(cog_id)
         parameters = {
             "validated": ["true"],
-            "legend": [ f"{system_name}__{system_version}" ],
-            "area": [ f"{system_name}__{system_version}" ]
+            "legend": cog["systems"],
+            "area": cog["systems"]
         }
-        process_cog(config["cdr_connector"], cog_id, parameters=parameters)
-
-    return
-
-def process_cog(cdr_connector : CdrConnector , cog_id : str, config_parm : Optional[dict]=None, parameters : Optional[dict]=None):
+        process_cog(config["cdr_connector"], cog_id, parameters=parameters, known_areas=cog["areas"],
+                    trace=traces[cog_id], priority=priority)
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=config["event_threads"], thread_name_prefix="event") as executor:
+        futures = {cog_id: executor.submit(run, cog_id, cog) for cog_id, cog in cogs.items()}
+        for cog_id, future in futures.items():
+            try:
+                future.result()
+                results[cog_id] = None
+            except Exception as e:
+                logging.exception(f"Cog-{cog_id[0:8]} - Error processing cog for event {event_id}")
+                results[cog_id] = e
+                parameters = {"validated": ["true"], "legend": cogs[cog_id]["systems"], "area": cogs[cog_id]["systems"]}
+                message = json.dumps({"event": "ncsacog", "cog_id": cog_id, "parameters": parameters, "event_id": event_id})
+                config["retry_policy"].retry(
+                    lambda queue, body, properties, arguments: config["publisher"].publish(body, queue, properties, arguments),
+                    message, pika.BasicProperties(headers=traces[cog_id], priority=priority), exception=e)
+
+    failed = len([e for e in results.values() if e is not None])
+    logging.info(f"Event {event_id} processed {len(results) - failed} cogs, {failed} failed")
+    return results
+
+def get_system_id(system : str, cog_system_versions : CogSystemVersionsSchema) -> Optional[SystemId]:
     """
-    Processing callback for cogs. Checks if there is enough information available
-    to process the cog with the requested models. If there is downloads the 
-    prereq data from the CDR, saves it to a temporary file and fires the download
-    event to rabbitmq.
-
-    cdr_connector : CdrConnector, CDR Connection with a registered connection
-    cog_id : str, The cog_id to process
-    config_parm : dict, Optional field to overwrite the global config parameters, needed for unit testing
-    parameters : dict, Optional field to overwrite the parameters, contains the legend, area and models to fire
+    Convert a system from the legend/area list to a SystemId. The system is
+    either given as name__version, or just the name in which case the version
+    is looked up in the system versions posted for the cog.
     """
-    if parameters is None:
-        parameters = {}
-    if config_parm is None:
-        config_parm = config
-    valid_area_systems = config_parm["systems"]["area"]
-    valid_legend_systems = parameters.get("legend", config_parm["systems"]["legend"])
-    validated = parameters.get("validated", ["true"])[0]
+    if "__" in system:
+        name, version = system.split("__")
+        return SystemId(name=name, version=version)
+    return next((x for x in cog_system_versions.system_versions if x.name == system), None)
 
-    logging.info(f"Cog:{cog_id[0:8]} - Processing cog {cog_id}")
+def lookup_cog_sequential(cdr_connector : CdrConnector, cog_id : str, validated : str, legend_systems : list, area_systems : list,
+                          known_areas : Optional[dict]=None):
+    """
+    Retrieve the system versions, legend items and area extractions for a cog,
+    one request at a time. Area extractions for systems in known_areas are
+    used as is, instead of being fetched from the CDR.
 
+    Returns the system versions, legend items and area extractions.
+    """
     # Retrieve available system versions for this cog and check if there are any valid systems posted
     cog_system_versions = retrieve_cog_system_versions(cdr_connector, cog_id)
-    logging.debug(f"Cog-{cog_id[0:8]} - Available system versions : {cog_system_versions.pretty_str()}")
 
     # checking for legends, logic will be:
     # 1. check if cog has validated legends, if it does, use them
@@ -148,23 +262,15 @@ def process_cog(cdr_connector : CdrConnector , cog_id : str, config_parm : Optio
         if strtobool(validated):
             logging.debug(f"Cog-{cog_id[0:8]} - No validated legend items found, trying unvalidated")
         # 2.1 loop through the list of legends and check if they are available
-        for legend in parameters.get("legend", config_parm["systems"]["legend"]) or []:
+        for legend in legend_systems:
             logging.debug(f"Cog-{cog_id[0:8]} - Trying legend {legend}")
-            if "__" in legend:
-                system, version = legend.split("__")
-                systemid = SystemId(name=system, version=version)
-            else:
-                systemid = next((x for x in cog_system_versions.system_versions if x.name == legend), None)
+            systemid = get_system_id(legend, cog_system_versions)
             if not systemid:
                 continue
             # 2.2 fetch the legend items for the system
             cog_legend_items = retrieve_cog_legend_items(cdr_connector, cog_id, system_id=systemid, validated="false")
             if cog_legend_items:
                 break
-    if cog_legend_items is not None:    
-        logging.debug(f"Cog-{cog_id[0:8]} - Found {len(cog_legend_items)} legend items")
-    else: 
-        logging.debug(f"Cog-{cog_id[0:8]} - No legend items found")
 
     # checking for area, logic will be:
     # 1. check if cog has validated legends, if it does, use them
@@ -173,19 +279,188 @@ def process_cog(cdr_connector : CdrConnector , cog_id : str, config_parm : Optio
         cog_area_extraction = retrieve_cog_area_extraction(cdr_connector, cog_id, validated=validated)
     # 2. if no validated legends, check if there are any legends from the list
     if not cog_area_extraction:
-        for area in parameters.get("area", config_parm["systems"]["area"]) or []:
+        for area in area_systems:
             logging.debug(f"Cog-{cog_id[0:8]} - Trying area {area}")
-            if "__" in area:
-                system, version = area.split("__")
-                systemid = SystemId(name=system, version=version)
-            else:
-                systemid = next((x for x in cog_system_versions.system_versions if x.name == area), None)
+            if known_areas and area in known_areas:
+                cog_area_extraction = known_areas[area]
+                if cog_area_extraction:
+                    break
+                continue
+            systemid = get_system_id(area, cog_system_versions)
             if not systemid:
                 continue
             # 2.2 fetch the area items for the system
             cog_area_extraction = retrieve_cog_area_extraction(cdr_connector, cog_id, system_id=systemid)
             if cog_area_extraction:
-                break    
+                break
+
+    return cog_system_versions, cog_legend_items, cog_area_extraction
+
+def lookup_cog_concurrent(executor : ThreadPoolExecutor, cdr_connector : CdrConnector, cog_id : str, validated : str, legend_systems : list, area_systems : list,
+                          known_areas : Optional[dict]=None):
+    """
+    Retrieve the system versions, legend items, area extractions and download
+    information for a cog, issuing the requests in parallel. The legend/area
+    requests for all fallback systems are fetched speculatively, the first
+    non empty result (in the same order as the sequential lookup) is used.
+    Systems that are only given by name are fetched once the system versions
+    are known. None of the submitted tasks wait on other tasks, so sharing the
+    executor between cogs can not deadlock. Area extractions for systems in
+    known_areas are used as is, instead of being fetched from the CDR.
+
+    Returns the system versions, legend items, area extractions and download information.
+    """
+    versions_future = executor.submit(retrieve_cog_system_versions, cdr_connector, cog_id)
+    download_future = executor.submit(retrieve_cog_download, cdr_connector, cog_id)
+
+    # candidates in order of preference, either a future or the name of a
+    # system that still needs to be resolved using the system versions
+    legend_candidates = []
+    area_candidates = []
+    if strtobool(validated):
+        legend_candidates.append(executor.submit(retrieve_cog_legend_items, cdr_connector, cog_id, validated=validated))
+        area_candidates.append(executor.submit(retrieve_cog_area_extraction, cdr_connector, cog_id, validated=validated))
+    for legend in legend_systems:
+        if "__" in legend:
+            legend_candidates.append(executor.submit(retrieve_cog_legend_items, cdr_connector, cog_id,
+                                                     system_id=get_system_id(legend, None), validated="false"))
+        else:
+            legend_candidates.append(legend)
+    for area in area_systems:
+        if known_areas and area in known_areas:
+            known = Future()
+            known.set_result(known_areas[area])
+            area_candidates.append(known)
+        elif "__" in area:
+            area_candidates.append(executor.submit(retrieve_cog_area_extraction, cdr_connector, cog_id,
+                                                   system_id=get_system_id(area, None)))
+        else:
+            area_candidates.append(area)
+
+    # resolve systems given by name
+    cog_system_versions = versions_future.result()
+    for candidates, fetch, kwargs in ((legend_candidates, retrieve_cog_legend_items, {"validated": "false"}),
+                                      (area_candidates, retrieve_cog_area_extraction, {})):
+        for i, candidate in enumerate(candidates):
+            if isinstance(candidate, str):
+                systemid = get_system_id(candidate, cog_system_versions)
+                if systemid:
+                    candidates[i] = executor.submit(fetch, cdr_connector, cog_id, system_id=systemid, **kwargs)
+                else:
+                    candidates[i] = None
+
+    def first_result(candidates):
+        result = None
+        for i, future in enumerate(candidates):
+            if future is None:
+                continue
+            result = future.result()
+            if result:
+                for remaining in candidates[i + 1:]:
+                    if remaining is not None:
+                        remaining.cancel()
+                break
+        return result
+
+    cog_legend_items = first_result(legend_candidates)
+    cog_area_extraction = first_result(area_candidates)
+    return cog_system_versions, cog_legend_items, cog_area_extraction, download_future.result()
+
+map_data_adapter = TypeAdapter(CMAAS_Map)
+
+
+def write_map_data(filename : str, map_data : CMAAS_Map, compress : bool=True):
+    """
+    Write the map data as json, and a gzip compressed copy next to it. Both
+    files are written to a temporary file first and renamed once complete, so
+    a download never sees a partial file. The compressed copy is renamed
+    first, so it is never older than the json file.
+
+    Args:
+        filename (str): The json file to write.
+        map_data (CMAAS_Map): The map data to write.
+        compress (bool, optional): Also write filename + ".gz". Defaults to True.
+    """
+    # serialize straight to bytes, avoids keeping both a str and its encoded copy
+    data = map_data_adapter.dump_json(map_data)
+    files = [(filename + ".gz", True)] if compress else []
+    files.append((filename, False))
+    for name, gzipped in files:
+        tmpname = f"{name}.{threading.get_ident()}.tmp"
+        try:
+            with (gzip.open(tmpname, "wb", compresslevel=6) if gzipped else open(tmpname, "wb")) as fh:
+                fh.write(data)
+            os.replace(tmpname, name)
+        finally:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+    if not compress and os.path.exists(filename + ".gz"):
+        os.remove(filename + ".gz")
+
+
+def cog_priority(cdr_connector : CdrConnector, cog_id : str, priority : Optional[int], config_parm : dict) -> Optional[int]:
+    """
+    Return the priority of the cog, boosted if the cog is part of one of the
+    active CMAs (priority_cmas). The priority is not changed if the metadata
+    of the cog can not be retrieved.
+    """
+    cmas = config_parm.get("priority_cmas")
+    if priority is None or not cmas:
+        return priority
+    try:
+        metadata = retrieve_cog_metadata(cdr_connector, cog_id)
+    except Exception:
+        logging.warning(f"Cog-{cog_id[0:8]} - Could not retrieve metadata to check the CMAs", exc_info=True)
+        return priority
+    if any(cma.cma_id in cmas for cma in metadata.cmas):
+        priority += ingress.PRIORITY_CMA_BOOST
+        if config_parm.get("queue_max_priority"):
+            priority = min(priority, config_parm["queue_max_priority"])
+    return priority
+
+def process_cog(cdr_connector : CdrConnector , cog_id : str, config_parm : Optional[dict]=None, parameters : Optional[dict]=None,
+                known_areas : Optional[dict]=None, trace : Optional[dict]=None, priority : Optional[int]=None):
+    """
+    Processing callback for cogs. Checks if there is enough information available
+    to process the cog with the requested models. If there is downloads the 
+    prereq data from the CDR, saves it to a temporary file and fires the download
+    event to rabbitmq.
+
+    cdr_connector : CdrConnector, CDR Connection with a registered connection
+    cog_id : str, The cog_id to process
+    config_parm : dict, Optional field to overwrite the global config parameters, needed for unit testing
+    parameters : dict, Optional field to overwrite the parameters, contains the legend, area and models to fire
+    known_areas : dict, Optional area extractions already retrieved, keyed by system__version, used instead of fetching them
+    trace : dict, Optional trace headers of the message, passed on to the download message
+    priority : int, Optional priority of the message, passed on to the download message
+    """
+    if parameters is None:
+        parameters = {}
+    if config_parm is None:
+        config_parm = config
+    validated = parameters.get("validated", ["true"])[0]
+
+    logging.info(f"Cog:{cog_id[0:8]} - Processing cog {cog_id}")
+
+    legend_systems = parameters.get("legend", config_parm["systems"]["legend"]) or []
+    area_systems = parameters.get("area", config_parm["systems"]["area"]) or []
+    executor = config_parm.get("lookup_executor")
+    start = time.perf_counter()
+    if executor is not None:
+        cog_system_versions, cog_legend_items, cog_area_extraction, cog_download = \
+            lookup_cog_concurrent(executor, cdr_connector, cog_id, validated, legend_systems, area_systems, known_areas)
+    else:
+        cog_system_versions, cog_legend_items, cog_area_extraction = \
+            lookup_cog_sequential(cdr_connector, cog_id, validated, legend_systems, area_systems, known_areas)
+        cog_download = None
+    lookup_seconds = time.perf_counter() - start
+    logging.debug(f"Cog-{cog_id[0:8]} - Available system versions : {cog_system_versions.pretty_str()}")
+    if config_parm.get("retrieve_cache"):
+        logging.debug(f"Cog-{cog_id[0:8]} - CDR cache {config_parm['retrieve_cache'].stats()}")
+    if cog_legend_items is not None:    
+        logging.debug(f"Cog-{cog_id[0:8]} - Found {len(cog_legend_items)} legend items")
+    else: 
+        logging.debug(f"Cog-{cog_id[0:8]} - No legend items found")
     if cog_area_extraction is not None:
         logging.debug(f"Cog-{cog_id[0:8]} - Found {len(cog_area_extraction)} area items")
     else:
@@ -241,27 +516,35 @@ def process_cog(cdr_connector : CdrConnector , cog_id : str, config_parm : Optio
                 firemodels.append(model)
 
     # only continue if there are models to fire
+    metrics.MODELS_PER_COG.observe(len(firemodels))
     if len(firemodels) == 0:
+        # the message is retried for when the areas or legends are posted, ask the CDR again
+        invalidate_cog(cog_id)
         raise ValueError(f"Cannot process {cog_id}, no models were able to be started")
         
-    # Retrieve download link for the geotiff
-    cog_download = retrieve_cog_download(cdr_connector, cog_id)
+    # Retrieve download link for the geotiff, unless already fetched
+    if cog_download is None:
+        start = time.perf_counter()
+        cog_download = retrieve_cog_download(cdr_connector, cog_id)
+        lookup_seconds += time.perf_counter() - start
+    metrics.PROCESS_COG_SECONDS.labels("lookup").observe(lookup_seconds)
 
     # Convert cdr obects to cmass objects for saving
-    layout = convert.convert_cdr_area_extraction_to_layout(cog_area_extraction)
-    legend = convert.convert_cdr_legend_items_to_legend(cog_legend_items)
-    map_data = CMAAS_Map(name=cog_id, cog_id=cog_id, layout=layout, legend=legend)
+    with metrics.PROCESS_COG_SECONDS.labels("convert").time():
+        layout = convert.convert_cdr_area_extraction_to_layout(cog_area_extraction)
+        legend = convert.convert_cdr_legend_items_to_legend(cog_legend_items)
+        map_data = CMAAS_Map(name=cog_id, cog_id=cog_id, layout=layout, legend=legend)
 
     # write the cog_area to disk
     folder = os.path.join(cog_id[0:2], cog_id[2:4])
     filepart = os.path.join(folder, cog_id)
-    filename = os.path.join("/data", f"{filepart}.map_data.json")
+    filename = os.path.join(data_folder, f"{filepart}.map_data.json")
     if 'mode' in config_parm and config_parm['mode'] == 'test': # Can't write to /data in tests
         filename = os.path.join('tests', 'data', f'{filepart}.map_data.json')
     os.makedirs(os.path.dirname(filename) , exist_ok=True)
 
-    with open(filename, "w") as fh:
-        fh.write(map_data.model_dump_json())
+    with metrics.PROCESS_COG_SECONDS.labels("write").time():
+        write_map_data(filename, map_data, config_parm.get("map_data_gzip", True))
     # saveCMASSMap(filename, map_data)
 
     message = {
@@ -274,7 +557,10 @@ def process_cog(cdr_connector : CdrConnector , cog_id : str, config_parm : Optio
     if 'mode' in config_parm and config_parm['mode'] == 'test': # Can't send rabbitmq in tests
         pass
     else:
-        send_message(message, f'{config_parm["prefix"]}download')
+        priority = cog_priority(cdr_connector, cog_id, priority, config_parm)
+        with metrics.PROCESS_COG_SECONDS.labels("publish").time():
+            send_message(message, f'{config_parm["prefix"]}download', tracing.next_stage(trace, "download_queued"),
+                         priority)
 
 # ----------------------------------------------------------------------
 # region Process incoming requests
@@ -302,41 +588,103 @@ def hook():
     elif not request.headers.get("x-ncsa-secret", "") == config["callback_secret"]:
         abort(403, "Callback secret didn't match!")
 
-    send_message(request.get_json(), f'{config["prefix"]}cdrhook')
+    receive_message(request.get_json(), tracing.add_stage(None, "hook"))
     return {"ok": "success"}
 
 
 @auth.login_required
 def cog(id):
     """
-    Process the cog
+    Process the cog, the cog goes before the events from the CDR unless the
+    bulk parameter is given.
     """
     logging.info(f"Received process cog for {id}")
     parameters = request.args.to_dict(False)
-    send_message({"event": "ncsacog", "cog_id": id, "parameters": parameters}, f'{config["prefix"]}cdrhook')
+    message = {"event": "ncsacog", "cog_id": id, "parameters": parameters}
+    try:
+        manual = not strtobool(parameters.pop("bulk", ["no"])[0] or "yes")
+    except ValueError:
+        abort(400, "bulk should be yes or no")
+    receive_message(message, tracing.add_stage(None, "hook"), ingress.message_priority(message, manual))
 
     return {"ok": "success"}
 
 
+@functools.lru_cache(maxsize=4096)
+def _file_md5(path : str, mtime_ns : int, size : int) -> str:
+    """
+    Return the md5 of the file, cached for as long as the file is not changed.
+    """
+    digest = hashlib.md5()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_etag(path : Optional[str]) -> Optional[str]:
+    """
+    Return a strong ETag for the file, the md5 of its content, or None if the
+    file does not exist.
+    """
+    if not path or not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    return _file_md5(path, stat.st_mtime_ns, stat.st_size)
+
+
 @auth.login_required
 def download(filename):
     """
-    download the file
+    download the file, the gzip compressed copy is sent if it exists and the
+    client accepts gzip. The ETag is the md5 of the file sent, and Range,
+    If-None-Match, If-Modified-Since and If-Range requests are handled, so a
+    client that has the file already gets a 304 Not Modified.
     """
     logging.info(f"Received download request for {filename}")
-    return send_from_directory("/data", filename)
+    gzname = f"{filename}.gz"
+    etag = file_etag(safe_join(data_folder, gzname)) if "gzip" in request.accept_encodings else None
+    if etag:
+        response = send_from_directory(data_folder, gzname, mimetype="application/json", etag=etag)
+        if response.status_code != 304:
+            response.headers["Content-Encoding"] = "gzip"
+    else:
+        etag = file_etag(safe_join(data_folder, filename))
+        response = send_from_directory(data_folder, filename, etag=etag or True)
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+@auth.login_required
+def metrics_endpoint():
+    """
+    Prometheus metrics
+    """
+    return generate_latest(), 200, {"Content-Type": CONTENT_TYPE_LATEST}
 
 # ----------------------------------------------------------------------
 # region Start the server and register with the CDR
 # ----------------------------------------------------------------------
-def cdrhook_callback(channel, method, properties, body):
+def cdrhook_callback(body, properties=None):
     """
     Callback to process maps without required metadata. This will check
     a map every 30 seconds to see if the metadata is available. If not
-    it will be added to the back of the queue.
+    it will be added to the back of the queue. This is called from one of
+    the worker lanes of the consumer, which will ack the message. If an
+    exception is raised the consumer retries the message later, until the
+    maximum number of attempts is reached and it is sent to cdrhook.error.
+    The trace in the headers and the priority of the message are passed on
+    to the download message.
     """
+    trace = tracing.add_stage(getattr(properties, "headers", None), "cdrhook")
+    priority = getattr(properties, "priority", None)
+    event = "invalid"
     try:
         data = json.loads(body)
+        event = ingress.event_name(data)
+        # new triggers for the same work are queued again from now on
+        if config.get("ingress"):
+            config["ingress"].started(data)
 
         if not data.get("event"):
             logging.error("No event in message")
@@ -345,52 +693,59 @@ def cdrhook_callback(channel, method, properties, body):
         elif data.get("event") == "ncsacog":
             cog_id = data.get("cog_id", "").strip()
             parameters = data.get("parameters", {})
-            process_cog(config["cdr_connector"], cog_id, parameters=parameters)
+            process_cog(config["cdr_connector"], cog_id, parameters=parameters, trace=trace, priority=priority)
         elif data.get("event") == "map.process":
             logging.debug("ignoring map.process")
         elif data.get("event") == "feature.process":
-            event_id = data.get("payload", {}).get("id", "").strip()
-            if event_id.startswith("uncharted-area_"):
-                process_event(event_id)
+            if ingress.is_handled(data):
+                process_event(ingress.event_id(data), trace, priority)
             else:
-                logging.debug(f"Ignoring feature.process with id {event_id}")
+                logging.debug(f"Ignoring feature.process with id {ingress.event_id(data)}")
         else:
             logging.debug("Unknown event %s", data.get("event"))
         
         if config["cdr_keep_event"]:
             send_message(data, f'{config["prefix"]}cdrhook.unknown')
-    except Exception as e:
+        metrics.EVENTS.labels(event, "success").inc()
+    except Exception:
         logging.exception("Error processing cdrhook message.")
-        data["exception"] = repr(e)
-        send_message(data, f'{config["prefix"]}cdrhook.error')
-    channel.basic_ack(delivery_tag=method.delivery_tag)
+        metrics.EVENTS.labels(event, "error").inc()
+        raise
+
+def cdrhook_message_key(body):
+    """
+    Return the key used to keep messages in order, messages for the same
+    cog (or the same event) are processed one after the other.
+    """
+    data = json.loads(body)
+    if data.get("cog_id"):
+        return data["cog_id"].strip()
+    return data.get("payload", {}).get("id", "") or data.get("event", "")
+
+def queue_arguments(config):
+    """
+    Return the arguments to declare the cdrhook and download queues with, so
+    messages with a higher priority are delivered first.
+    """
+    if config.get("queue_max_priority", 0) > 0:
+        return {"x-max-priority": config["queue_max_priority"]}
+    return None
 
 def cdrhook_listener(config):
     """
     Listen to the RabbitMQ queue and process the messages. The messages
     are maps that need to be processed, but don't have the required
-    metadata yet.
+    metadata yet. Up to cdrhook_workers messages are processed at the same
+    time, messages for the same cog are processed in order.
     """
-    logging.info("Starting RabbitMQ listener")
+    logging.info(f"Starting RabbitMQ listener with {config['cdrhook_workers']} workers")
 
-    while True:
-        try:
-            # connect to rabbitmq
-            parameters = pika.URLParameters(config['rabbitmq_uri'])
-            connection = pika.BlockingConnection(parameters)
-            channel = connection.channel()
-
-            # create all queues needed
-            channel.queue_declare(queue=f'{config["prefix"]}cdrhook', durable=True)
-            channel.queue_declare(queue=f'{config["prefix"]}cdrhook.error', durable=True)
-
-            # process messages
-            channel.basic_qos(prefetch_count=1)
-            channel.basic_consume(queue=f'{config["prefix"]}cdrhook', on_message_callback=cdrhook_callback, auto_ack=False)
-            channel.start_consuming()
-        except Exception as e:
-            logging.exception("Error running cdrhook.")
-        time.sleep(5)
+    consumer = KeyedConsumer(config['rabbitmq_uri'], f'{config["prefix"]}cdrhook', cdrhook_callback,
+                             workers=config["cdrhook_workers"], key=cdrhook_message_key,
+                             queues=[f'{config["prefix"]}cdrhook.error'], retry=config["retry_policy"],
+                             pass_properties=True, arguments=queue_arguments(config))
+    config["cdrhook_consumer"] = consumer
+    consumer.run()
 
 def create_app():
     """
@@ -411,6 +766,22 @@ def create_app():
     config["rabbitmq_uri"] = os.getenv("RABBITMQ_URI")
     config["prefix"] = os.getenv("PREFIX")
     config["cdr_keep_event"] = strtobool(os.getenv("CDR_KEEP_EVENT", "no"))
+    config["rabbitmq_pool_size"] = int(os.getenv("RABBITMQ_POOL_SIZE", "4"))
+    config["concurrent_lookup"] = strtobool(os.getenv("CDR_CONCURRENT_LOOKUP", "yes"))
+    config["lookup_threads"] = int(os.getenv("CDR_LOOKUP_THREADS", "8"))
+    config["cdrhook_workers"] = int(os.getenv("CDRHOOK_WORKERS", "1"))
+    config["event_threads"] = int(os.getenv("CDRHOOK_EVENT_THREADS", "4"))
+    config["drain_timeout"] = float(os.getenv("CDRHOOK_DRAIN_TIMEOUT", "300"))
+    config["cache_ttl"] = float(os.getenv("CDR_CACHE_TTL", "600"))
+    config["cache_size"] = int(os.getenv("CDR_CACHE_SIZE", "1024"))
+    config["cache_dir"] = os.getenv("CDR_CACHE_DIR", "")
+    config["map_data_gzip"] = strtobool(os.getenv("MAP_DATA_GZIP", "yes"))
+    config["spool_dir"] = os.getenv("CDRHOOK_SPOOL_DIR", "/data/spool")
+    config["spool_batch_size"] = int(os.getenv("CDRHOOK_SPOOL_BATCH_SIZE", "100"))
+    config["ingress_filter"] = strtobool(os.getenv("CDRHOOK_INGRESS_FILTER", "yes"))
+    config["coalesce_seconds"] = float(os.getenv("CDRHOOK_COALESCE_SECONDS", "300"))
+    config["queue_max_priority"] = int(os.getenv("QUEUE_MAX_PRIORITY", "0"))
+    config["priority_cmas"] = [x.strip() for x in os.getenv("PRIORITY_CMAS", "").split(",") if x.strip()]
     
     # load the models
     with open("models.json", "r") as f:
@@ -428,15 +799,56 @@ def create_app():
         callback_secret=os.getenv("CALLBACK_SECRET"),
         callback_username=os.getenv("CALLBACK_USERNAME"),
         callback_password=os.getenv("CALLBACK_PASSWORD"),
+        pool_size=int(os.getenv("CDR_POOL_SIZE", "10")),
+        timeout=float(os.getenv("CDR_TIMEOUT", "60")),
+        endpoint_timeouts=json.loads(os.getenv("CDR_ENDPOINT_TIMEOUTS", "{}")),
+        max_retries=int(os.getenv("CDR_MAX_RETRIES", "3")),
+        backoff_factor=float(os.getenv("CDR_BACKOFF_FACTOR", "0.5")),
     )
     cdr_connector.register()
     config["cdr_connector"] = cdr_connector
+    cdr_connector.add_observer(metrics.observe_cdr_request)
+
+    # cache responses from the CDR, so retriggering a cog does not fetch everything again
+    if config["cache_ttl"] > 0:
+        config["retrieve_cache"] = RetrieveCache(max_entries=config["cache_size"], ttl=config["cache_ttl"],
+                                                 directory=config["cache_dir"] or None)
+        set_retrieve_cache(config["retrieve_cache"])
+
+    # threads used to retrieve the cog prerequisites from the CDR in parallel
+    if config["concurrent_lookup"]:
+        config["lookup_executor"] = ThreadPoolExecutor(max_workers=config["lookup_threads"], thread_name_prefix="lookup")
+
+    # shared pool of channels used to publish messages
+    arguments = queue_arguments(config)
+    config["publisher"] = RabbitPublisher(config["rabbitmq_uri"], pool_size=config["rabbitmq_pool_size"],
+                                          queue_arguments={f'{config["prefix"]}cdrhook': arguments,
+                                                           f'{config["prefix"]}download': arguments})
+
+    # failed messages are retried with an increasing delay before they go to the error queue
+    config["retry_policy"] = RetryPolicy(f'{config["prefix"]}cdrhook', f'{config["prefix"]}cdrhook.error',
+                                         max_attempts=int(os.getenv("RETRY_MAX_ATTEMPTS", "5")),
+                                         delay=int(os.getenv("RETRY_DELAY", "30")),
+                                         max_delay=int(os.getenv("RETRY_MAX_DELAY", "3600")))
+
+    # drop incoming messages that are not handled and merge repeated triggers
+    if config["ingress_filter"] or config["coalesce_seconds"] > 0:
+        config["ingress"] = ingress.IngressFilter(drop_unhandled=config["ingress_filter"], window=config["coalesce_seconds"])
+
+    # incoming messages are written to the spool and forwarded to RabbitMQ in the background
+    if config["spool_dir"]:
+        config["spool"] = Spool(config["spool_dir"], batch_size=config["spool_batch_size"])
+        metrics.SPOOL_DEPTH.set_function(config["spool"].depth)
+        metrics.SPOOL_AGE_SECONDS.set_function(config["spool"].age)
+        thread = threading.Thread(target=config["spool"].run, args=(forward_spooled,), name="spool", daemon=True)
+        thread.start()
 
     # register the hook
     path = urllib.parse.urlparse(config["callback_url"]).path
     app.route(os.path.join(path, "hook"), methods=['POST'])(hook)
     app.route(os.path.join(path, "download", "<path:filename>"), methods=['GET'])(download)
     app.route(os.path.join(path, "cog", "<string:id>"), methods=['POST'])(cog)
+    app.route(os.path.join(path, "metrics"), methods=['GET'])(metrics_endpoint)
 
     # start daemon thread for rabbitmq
     thread = threading.Thread(target=cdrhook_listener, args=(config,))
@@ -466,7 +878,13 @@ if __name__ == '__main__':
     # this does not work.
     def handle_sig(sig, frame):
         logging.warning(f"Got signal {sig}, now close worker...")
+        if config.get("cdrhook_consumer"):
+            if not config["cdrhook_consumer"].stop(config["drain_timeout"]):
+                logging.warning("Timed out waiting for cdrhook messages to finish")
         config["cdr_connector"].unregister()
+        if config.get("spool"):
+            config["spool"].close()
+        config["publisher"].close()
         sys.exit(0)
 
     for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGQUIT, signal.SIGHUP):
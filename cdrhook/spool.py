@@ -0,0 +1,275 @@
+import collections
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+SEGMENT_PATTERN = re.compile(r"^spool-(\d{12})\.log$")
+
+
+class Spool:
+    """
+    Durable write-ahead spool for incoming webhook messages. Each message is
+    appended as a line of json to the current segment file and fsync'd before
+    append returns, so a message that was accepted is not lost if RabbitMQ is
+    down or the cdrhook restarts. A forwarder thread sends the messages to
+    RabbitMQ in batches and records how far it got in a cursor file. Segments
+    that are completely forwarded are removed.
+
+    Messages are forwarded at least once, a crash between publishing a batch
+    and saving the cursor sends the batch again.
+    """
+    def __init__(self, directory : str, segment_bytes : int=16 * 1024 * 1024, batch_size : int=100,
+                 fsync : bool=True):
+        """
+        Args:
+            directory (str): Folder to keep the spool in, created if needed.
+            segment_bytes (int, optional): Size after which a new segment is started. Defaults to 16MB.
+            batch_size (int, optional): Maximum number of messages forwarded at once. Defaults to 100.
+            fsync (bool, optional): Flush each message to disk before returning. Defaults to True.
+        """
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.cursor_file = os.path.join(directory, "cursor.json")
+        self.appended = 0
+        self.forwarded = 0
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._pending = collections.deque()
+        self._stopped = False
+        os.makedirs(directory, exist_ok=True)
+
+        self.cursor = self._load_cursor()
+        segments = self._segments()
+        for seq in segments:
+            if seq < self.cursor[0]:
+                self._remove_segment(seq)
+        segments = [seq for seq in segments if seq >= self.cursor[0]]
+        if segments and self.cursor[0] < segments[0]:
+            self.cursor = (segments[0], 0)
+        # messages left over from before a restart
+        for seq in segments:
+            offset = self.cursor[1] if seq == self.cursor[0] else 0
+            for _, _, record in self._read(seq, offset, None, None):
+                self._pending.append(record.get("time", time.time()))
+        if self._pending:
+            logging.info(f"Spool has {len(self._pending)} messages to forward")
+        # never append to an existing segment, it could end with a partial line
+        self.active = (segments[-1] + 1) if segments else max(1, self.cursor[0])
+        if not segments:
+            self.cursor = (self.active, 0)
+        self.active_size = 0
+        self._fh = open(self._segment_name(self.active), "ab")
+        self._sync_directory()
+
+    def _segment_name(self, seq : int) -> str:
+        return os.path.join(self.directory, f"spool-{seq:012d}.log")
+
+    def _segments(self) -> List[int]:
+        return sorted(int(m.group(1)) for m in map(SEGMENT_PATTERN.match, os.listdir(self.directory)) if m)
+
+    def _remove_segment(self, seq : int):
+        try:
+            os.remove(self._segment_name(seq))
+        except FileNotFoundError:
+            pass
+
+    def _sync_directory(self):
+        if not self.fsync:
+            return
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _load_cursor(self) -> Tuple[int, int]:
+        try:
+            with open(self.cursor_file, "r") as fh:
+                data = json.load(fh)
+            return int(data["segment"]), int(data["offset"])
+        except FileNotFoundError:
+            return 0, 0
+        except (ValueError, KeyError, TypeError):
+            logging.warning(f"Ignoring unreadable spool cursor {self.cursor_file}", exc_info=True)
+            return 0, 0
+
+    def _save_cursor(self, cursor : Tuple[int, int]):
+        tmpname = f"{self.cursor_file}.tmp"
+        with open(tmpname, "w") as fh:
+            json.dump({"segment": cursor[0], "offset": cursor[1]}, fh)
+            fh.flush()
+            if self.fsync:
+                os.fsync(fh.fileno())
+        os.replace(tmpname, self.cursor_file)
+
+    def _read(self, seq : int, offset : int, limit : Optional[int], end : Optional[int]):
+        """
+        Read the records of a segment from offset, up to limit records and end
+        bytes. Yields the segment, the offset after the record and the record.
+        A line that is not complete (the cdrhook stopped while writing it) is
+        skipped.
+        """
+        try:
+            fh = open(self._segment_name(seq), "rb")
+        except FileNotFoundError:
+            return
+        with fh:
+            fh.seek(offset)
+            count = 0
+            while limit is None or count < limit:
+                if end is not None and offset >= end:
+                    break
+                line = fh.readline()
+                if not line.endswith(b"\n"):
+                    if line:
+                        logging.warning(f"Skipping partial record at the end of spool segment {seq}")
+                    break
+                offset += len(line)
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logging.warning(f"Skipping unreadable record in spool segment {seq}")
+                    continue
+                count += 1
+                yield seq, offset, record
+
+    def append(self, queue : str, message, headers : Optional[dict]=None, priority : Optional[int]=None):
+        """
+        Add a message to the spool, returns once the message is on disk.
+
+        Args:
+            queue (str): The queue the message should be sent to.
+            message: The message, json encoded.
+            headers (dict, optional): Headers of the message. Defaults to None.
+            priority (int, optional): Priority of the message. Defaults to None.
+        """
+        now = time.time()
+        record = {"time": now, "queue": queue, "message": message, "headers": headers}
+        if priority is not None:
+            record["priority"] = priority
+        line = json.dumps(record).encode("utf-8") + b"\n"
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("Spool has been closed")
+            if self.active_size > 0 and self.active_size + len(line) > self.segment_bytes:
+                self._rotate()
+            self._fh.write(line)
+            self._fh.flush()
+            if self.fsync:
+                os.fsync(self._fh.fileno())
+            self.active_size += len(line)
+            self.appended += 1
+            self._pending.append(now)
+            self._available.notify_all()
+
+    def _rotate(self):
+        """
+        Start a new segment, the lock must be held.
+        """
+        self._fh.close()
+        self.active += 1
+        self.active_size = 0
+        self._fh = open(self._segment_name(self.active), "ab")
+        self._sync_directory()
+
+    def _next_batch(self) -> Tuple[list, Tuple[int, int]]:
+        """
+        Return the next records to forward and the cursor after them.
+        """
+        with self._lock:
+            active, active_size = self.active, self.active_size
+        records = []
+        seq, offset = self.cursor
+        while seq <= active and len(records) < self.batch_size:
+            end = active_size if seq == active else None
+            for seq, offset, record in self._read(seq, offset, self.batch_size - len(records), end):
+                records.append(record)
+            if len(records) >= self.batch_size or seq == active:
+                break
+            # the rest of this segment is forwarded, continue with the next one
+            seq, offset = seq + 1, 0
+        return records, (seq, offset)
+
+    def _advance(self, cursor : Tuple[int, int], count : int):
+        """
+        Save the cursor and remove segments that are completely forwarded.
+        """
+        with self._lock:
+            for _ in range(min(count, len(self._pending))):
+                self._pending.popleft()
+            self.forwarded += count
+            # everything is forwarded, start a new segment so the old one can be removed
+            if not self._stopped and cursor == (self.active, self.active_size) and self.active_size >= 64 * 1024:
+                self._rotate()
+                cursor = (self.active, 0)
+        self._save_cursor(cursor)
+        old = self.cursor[0]
+        self.cursor = cursor
+        for seq in range(old, cursor[0]):
+            self._remove_segment(seq)
+
+    def forward(self, publish : Callable[[list], None], timeout : float=1) -> int:
+        """
+        Forward the next batch of messages, waiting up to timeout seconds for
+        messages if the spool is empty.
+
+        Args:
+            publish (Callable): Called with the list of records to send, each a dict with
+                queue, message, headers and optionally priority. Should raise an exception if they could not be sent.
+            timeout (float, optional): Seconds to wait for new messages. Defaults to 1.
+
+        Returns:
+            int: The number of messages forwarded.
+        """
+        with self._lock:
+            if not self._pending and not self._stopped:
+                self._available.wait(timeout)
+            if not self._pending:
+                return 0
+        records, cursor = self._next_batch()
+        if records:
+            publish(records)
+        if cursor != self.cursor:
+            self._advance(cursor, len(records))
+        return len(records)
+
+    def run(self, publish : Callable[[list], None]):
+        """
+        Forward messages until the spool is closed, retrying with an increasing
+        delay when publishing fails.
+        """
+        delay = 1
+        while not self._stopped:
+            try:
+                self.forward(publish)
+                delay = 1
+            except Exception:
+                logging.exception(f"Error forwarding spooled messages, retrying in {delay} seconds")
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
+
+    def depth(self) -> int:
+        """
+        Return the number of messages that still need to be forwarded.
+        """
+        with self._lock:
+            return len(self._pending)
+
+    def age(self) -> float:
+        """
+        Return the seconds the oldest message waiting to be forwarded has been in the spool.
+        """
+        with self._lock:
+            return time.time() - self._pending[0] if self._pending else 0.0
+
+    def close(self):
+        with self._lock:
+            self._stopped = True
+            self._fh.close()
+            self._available.notify_all()
@@ -0,0 +1,260 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+
+def sha256sum(filename, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CogCache:
+    """
+    Keeps track of the COGs downloaded to the data folder (stored as
+    xx/yy/cog_id/) so they can be reused and removed when the folder grows too
+    large. The index records the size, last access time and checksum of each
+    COG and is stored as json in the data folder, at most every save_interval
+    seconds (losing the last changes only means a COG is not in the index and
+    its size is checked against the file). When the total size goes over the
+    high water mark the least recently used COGs are removed until the size
+    is below the low water mark, only the COG file is removed, the map data
+    stays. COGs that are pinned (being downloaded, or with process messages
+    that are still being worked on) are never removed.
+    """
+    def __init__(self, data_dir, max_bytes=0, low_water=0.9, pin_seconds=24 * 3600, verify=False,
+                 index_name="cog_cache.json", save_interval=60):
+        """
+        Args:
+            data_dir (str): The data folder where the COGs are stored.
+            max_bytes (int, optional): High water mark for the size of all COGs, 0 disables eviction. Defaults to 0.
+            low_water (float, optional): Fraction of max_bytes to evict down to. Defaults to 0.9.
+            pin_seconds (int, optional): How long a COG stays pinned after its process messages are sent,
+                this should be longer than the pipelines take to process a map. Defaults to 24 hours.
+            verify (bool, optional): Verify the checksum of a COG before reusing it. Defaults to False,
+                which only checks the size.
+            index_name (str, optional): The filename of the index in the data folder.
+            save_interval (float, optional): Least number of seconds between writing the index. Defaults to 60.
+        """
+        self.data_dir = data_dir
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.pin_seconds = pin_seconds
+        self.verify = verify
+        self.save_interval = save_interval
+        self.index_file = os.path.join(data_dir, index_name)
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._entries = {}
+        self._dirty = False
+        self._last_save = 0
+        self._load()
+
+    def folder(self, cog_id):
+        return os.path.join(self.data_dir, cog_id[0:2], cog_id[2:4], cog_id)
+
+    def _load(self):
+        try:
+            with open(self.index_file, "r") as fh:
+                self._entries = json.load(fh)
+            logging.info(f"Loaded COG cache index with {len(self._entries)} COGs")
+        except FileNotFoundError:
+            self._rebuild()
+        except ValueError:
+            logging.warning(f"COG cache index {self.index_file} is corrupt, rebuilding")
+            self._rebuild()
+
+    def _rebuild(self):
+        """
+        Build the index from the COGs already in the data folder. Checksums are
+        computed when the COG is used.
+        """
+        self._entries = {}
+        if not os.path.isdir(self.data_dir):
+            return
+        for xx in os.listdir(self.data_dir):
+            if len(xx) != 2 or not os.path.isdir(os.path.join(self.data_dir, xx)):
+                continue
+            for yy in os.listdir(os.path.join(self.data_dir, xx)):
+                if len(yy) != 2 or not os.path.isdir(os.path.join(self.data_dir, xx, yy)):
+                    continue
+                for cog_id in os.listdir(os.path.join(self.data_dir, xx, yy)):
+                    filename = os.path.join(self.folder(cog_id), f"{cog_id}.cog.tif")
+                    if os.path.isfile(filename):
+                        stat = os.stat(filename)
+                        self._entries[cog_id] = {"file": filename, "size": stat.st_size, "last_access": stat.st_mtime,
+                                                 "checksum": None, "pinned_until": 0}
+        logging.info(f"Rebuilt COG cache index with {len(self._entries)} COGs")
+        self._dirty = True
+        self.save(force=True)
+
+    def save(self, force=False):
+        """
+        Write the index if it changed and the last write is more than
+        save_interval seconds ago, or force is True.
+
+        Returns:
+            bool: True if the index was written.
+        """
+        with self._lock:
+            if not self._dirty or (not force and time.time() - self._last_save < self.save_interval):
+                return False
+            data = json.dumps(self._entries)
+            self._dirty = False
+            self._last_save = time.time()
+        tmpname = f"{self.index_file}.tmp"
+        with self._save_lock:
+            try:
+                os.makedirs(self.data_dir, exist_ok=True)
+                with open(tmpname, "w") as fh:
+                    fh.write(data)
+                os.replace(tmpname, self.index_file)
+            except OSError:
+                logging.warning(f"Could not write COG cache index {self.index_file}", exc_info=True)
+                with self._lock:
+                    self._dirty = True
+                return False
+        return True
+
+    def lookup(self, cog_id, filename):
+        """
+        Check if the COG is already downloaded and still valid. The COG is
+        pinned in either case, so it will not be evicted while it is used or
+        being downloaded.
+
+        Returns:
+            bool: True if the file can be reused, False if it needs to be downloaded.
+        """
+        self.pin(cog_id)
+        if not os.path.isfile(filename):
+            with self._lock:
+                self.misses += 1
+            return False
+        size = os.path.getsize(filename)
+        with self._lock:
+            entry = dict(self._entries.get(cog_id, {}))
+        valid = entry.get("file") is None or size == entry["size"]
+        checksum = entry.get("checksum")
+        if valid and self.verify:
+            current = sha256sum(filename)
+            valid = checksum is None or current == checksum
+            checksum = current
+        with self._lock:
+            if not valid:
+                logging.warning(f"Cached COG {filename} does not match the index, downloading again")
+                os.remove(filename)
+                self.misses += 1
+                return False
+            self._entries[cog_id].update({"file": filename, "size": size, "checksum": checksum})
+            self.hits += 1
+            self._dirty = True
+            return True
+
+    def pin(self, cog_id):
+        """
+        Pin the COG so it is not evicted, for example while it is being downloaded.
+        """
+        with self._lock:
+            entry = self._entries.setdefault(cog_id, {"file": None, "size": 0, "checksum": None})
+            entry["last_access"] = time.time()
+            entry["pinned_until"] = time.time() + self.pin_seconds
+            self._dirty = True
+
+    def add(self, cog_id, filename, checksum=None):
+        """
+        Record a newly downloaded COG, it stays pinned for pin_seconds so the
+        pipelines can process it.
+        """
+        with self._lock:
+            self._entries[cog_id] = {
+                "file": filename,
+                "size": os.path.getsize(filename),
+                "checksum": checksum,
+                "last_access": time.time(),
+                "pinned_until": time.time() + self.pin_seconds,
+            }
+            self._dirty = True
+        self.save()
+
+    @property
+    def total_bytes(self):
+        with self._lock:
+            return sum(e["size"] for e in self._entries.values())
+
+    def evict(self):
+        """
+        Remove the least recently used COGs that are not pinned until the total
+        size is below the low water mark, if the high water mark is exceeded.
+        The index is written if it changed.
+
+        Returns:
+            int: The number of bytes removed.
+        """
+        removed = self._evict()
+        self.save(force=removed > 0)
+        return removed
+
+    def _evict(self):
+        if self.max_bytes <= 0:
+            return 0
+        with self._lock:
+            total = sum(e["size"] for e in self._entries.values())
+            if total <= self.max_bytes:
+                return 0
+            target = self.max_bytes * self.low_water
+            now = time.time()
+            removed = 0
+            candidates = sorted((e.get("last_access", 0), cog_id) for cog_id, e in self._entries.items()
+                                if e.get("pinned_until", 0) < now)
+            for _, cog_id in candidates:
+                if total - removed <= target:
+                    break
+                entry = self._entries.pop(cog_id)
+                self._remove(cog_id, entry)
+                removed += entry["size"]
+                self.evicted += 1
+                logging.debug(f"Evicted COG {cog_id} ({entry['size']} bytes)")
+            if total - removed > self.max_bytes:
+                logging.warning(f"COG cache is {total - removed} bytes, above {self.max_bytes}, all remaining COGs are pinned")
+            self._dirty = True
+            logging.info(f"Evicted {removed / (1024 * 1024):.1f}MB from COG cache, now {(total - removed) / (1024 * 1024):.1f}MB")
+            return removed
+
+    def _remove(self, cog_id, entry):
+        """
+        Remove the COG file, and the folder of the cog if nothing else is left in it.
+        """
+        if entry.get("file"):
+            try:
+                os.remove(entry["file"])
+            except FileNotFoundError:
+                pass
+            except OSError:
+                logging.warning(f"Could not remove COG {entry['file']}", exc_info=True)
+        try:
+            os.rmdir(self.folder(cog_id))
+        except OSError:
+            pass
+
+    def report(self):
+        """
+        Return the statistics of the cache.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "cogs": len(self._entries),
+                "bytes": sum(e["size"] for e in self._entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evicted": self.evicted,
+            }
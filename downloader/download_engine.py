@@ -0,0 +1,329 @@
+import email.utils
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+
+
+class DownloadError(Exception):
+    """
+    Raised when a file could not be downloaded, or the downloaded file does
+    not match the size or checksum reported by the server.
+    """
+
+
+class DownloadResult:
+    """
+    Information about a finished download, used for logging throughput.
+    """
+    def __init__(self, url, filename, size, seconds, attempts, resumed, etag=None, checksum=None, not_modified=False):
+        self.url = url
+        self.filename = filename
+        self.size = size
+        self.seconds = seconds
+        self.attempts = attempts
+        self.resumed = resumed
+        self.etag = etag
+        self.checksum = checksum
+        self.not_modified = not_modified
+
+    @property
+    def rate(self):
+        """ bytes per second """
+        return self.size / self.seconds if self.seconds > 0 else 0.0
+
+    def __repr__(self):
+        return (f"DownloadResult(filename='{self.filename}', size={self.size}, seconds={self.seconds:.2f}, "
+                f"rate={self.rate / (1024 * 1024):.2f}MB/s, attempts={self.attempts}, resumed={self.resumed}, "
+                f"not_modified={self.not_modified})")
+
+
+class ByteBudget:
+    """
+    Limits the total number of bytes being downloaded at the same time. A
+    download larger than the budget is allowed once nothing else is in flight.
+    A limit of 0 disables the budget.
+    """
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.inflight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, size):
+        if self.limit <= 0:
+            return
+        with self._condition:
+            while self.inflight > 0 and self.inflight + size > self.limit:
+                self._condition.wait()
+            self.inflight += size
+
+    def release(self, size):
+        if self.limit <= 0:
+            return
+        with self._condition:
+            self.inflight -= size
+            self._condition.notify_all()
+
+
+class DownloadEngine:
+    """
+    Streams files to disk using a shared requests session. Data is written in
+    chunks to a temporary file that is renamed once complete, so other
+    processes never see a partial file. The size is checked against the
+    Content-Length and, if the ETag is a plain md5, the checksum is verified.
+    After a failure the download is resumed using a Range request, unless the
+    server sent the file compressed (Content-Encoding). The total
+    size of the files being downloaded at the same time can be capped with
+    max_inflight_bytes. If progress is given it is called with the size of each
+    chunk written, for example to count the bytes downloaded.
+
+    A file that already exists can be revalidated instead of downloaded again,
+    using the ETag of the previous download and the modification time of the
+    file, which is set to the Last-Modified of the server.
+
+    Downloads of the same file (for example two messages for the same cog)
+    are done one after the other, so they never write the same partial file.
+    """
+    def __init__(self, chunk_size=1024 * 1024, retries=3, timeout=60, pool_size=10, headers=None, max_inflight_bytes=0,
+                 progress=None):
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.budget = ByteBudget(max_inflight_bytes)
+        self.retries = retries
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if headers:
+            self.session.headers.update(headers)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="download")
+        self.total_bytes = 0
+        self.not_modified = 0
+        # ETag of the files downloaded, used to revalidate them
+        self.etags = {}
+        self.max_etags = 100000
+        self._lock = threading.Lock()
+        # lock and number of users for each file being downloaded
+        self._file_locks = {}
+
+    @staticmethod
+    def _md5_etag(etag):
+        """
+        Return the md5 from the ETag if it is a plain md5 checksum (not a
+        weak or multipart ETag), None otherwise.
+        """
+        if not etag or etag.startswith("W/"):
+            return None
+        etag = etag.strip('"')
+        if re.fullmatch(r"[0-9a-fA-F]{32}", etag):
+            return etag.lower()
+        return None
+
+    def _conditional_headers(self, filename):
+        """
+        Return the headers to ask the server to only send the file if it
+        changed since the existing file was downloaded.
+        """
+        headers = {}
+        if not os.path.exists(filename):
+            return headers
+        with self._lock:
+            etag = self.etags.get(filename)
+        if etag:
+            headers["If-None-Match"] = etag
+        headers["If-Modified-Since"] = email.utils.formatdate(os.path.getmtime(filename), usegmt=True)
+        return headers
+
+    def _remember(self, filename, response_headers):
+        """
+        Keep the ETag of the download and set the modification time of the file
+        to the Last-Modified of the server, so the file can be revalidated.
+        """
+        last_modified = response_headers.get("Last-Modified")
+        if last_modified:
+            try:
+                timestamp = email.utils.parsedate_to_datetime(last_modified).timestamp()
+                os.utime(filename, (timestamp, timestamp))
+            except (TypeError, ValueError, OverflowError):
+                pass
+        etag = response_headers.get("ETag")
+        with self._lock:
+            self.etags.pop(filename, None)
+            if etag:
+                self.etags[filename] = etag
+                while len(self.etags) > self.max_etags:
+                    del self.etags[next(iter(self.etags))]
+
+    @contextmanager
+    def _file_lock(self, filename):
+        """
+        Hold the lock of the file, the lock is removed once nobody uses it.
+        """
+        with self._lock:
+            entry = self._file_locks.setdefault(filename, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._file_locks[filename]
+
+    def download(self, url, filename, revalidate=False):
+        """
+        Download the url to filename, replacing the file if it already exists.
+
+        Args:
+            url (str): The url to download.
+            filename (str): The final location of the file.
+            revalidate (bool, optional): If the file exists, only download it again if
+                the server has a different version. Defaults to False.
+
+        Returns:
+            DownloadResult: Information about the download.
+
+        Raises:
+            DownloadError: If the file could not be downloaded after all retries.
+        """
+        with self._file_lock(filename):
+            return self._download(url, filename, revalidate)
+
+    def _download(self, url, filename, revalidate):
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        partname = f"{filename}.part"
+        if os.path.exists(partname):
+            os.remove(partname)
+        start = time.perf_counter()
+        etag = None
+        expected = None
+        encoded = False
+        resumed = 0
+        attempt = 0
+        conditional = self._conditional_headers(filename) if revalidate else {}
+        response_headers = {}
+        while True:
+            attempt += 1
+            if encoded and os.path.exists(partname):
+                # ranges of a compressed response do not match the decompressed file, start over
+                os.remove(partname)
+            offset = os.path.getsize(partname) if os.path.exists(partname) else 0
+            headers = dict(conditional) if offset == 0 else {}
+            if offset > 0:
+                headers["Range"] = f"bytes={offset}-"
+                if etag:
+                    headers["If-Range"] = etag
+            try:
+                with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                    response.raise_for_status()
+                    if response.status_code == 304 and headers.get("If-Modified-Since"):
+                        self._remember(filename, response.headers)
+                        with self._lock:
+                            self.not_modified += 1
+                        logging.info(f"Not modified {os.path.basename(filename)}, skipping download")
+                        return DownloadResult(url, filename, os.path.getsize(filename), time.perf_counter() - start,
+                                              attempt, resumed, response.headers.get("ETag"), not_modified=True)
+                    response_headers = response.headers
+                    if offset > 0 and response.status_code == 206:
+                        resumed += 1
+                        mode = "ab"
+                    else:
+                        # server sent the whole file
+                        offset = 0
+                        mode = "wb"
+                    etag = response.headers.get("ETag", etag)
+                    encoded = response.headers.get("Content-Encoding", "identity") != "identity"
+                    expected = self._expected_size(response, offset, expected)
+                    reserved = (expected or 0) - offset
+                    self.budget.acquire(reserved)
+                    try:
+                        with open(partname, mode) as fh:
+                            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                                fh.write(chunk)
+                                with self._lock:
+                                    self.total_bytes += len(chunk)
+                                if self.progress is not None:
+                                    self.progress(len(chunk))
+                    finally:
+                        self.budget.release(reserved)
+                size = os.path.getsize(partname)
+                if expected is not None and size != expected:
+                    raise DownloadError(f"Downloaded {size} bytes of {expected} for {url}")
+                break
+            except (RequestException, DownloadError) as e:
+                status = getattr(getattr(e, "response", None), "status_code", None)
+                if attempt > self.retries or (status is not None and 400 <= status < 500 and status != 429):
+                    if os.path.exists(partname):
+                        os.remove(partname)
+                    raise DownloadError(f"Error downloading {url} : {e}") from e
+                logging.warning(f"Error downloading {url} (attempt {attempt}), retrying : {e}")
+                time.sleep(min(2 ** attempt, 30))
+
+        # the ETag of a compressed response is not the checksum of the file
+        md5 = None if encoded else self._md5_etag(etag)
+        md5_digest = hashlib.md5()
+        sha256_digest = hashlib.sha256()
+        with open(partname, "rb") as fh:
+            for chunk in iter(lambda: fh.read(self.chunk_size), b""):
+                md5_digest.update(chunk)
+                sha256_digest.update(chunk)
+        if md5 is not None and md5_digest.hexdigest() != md5:
+            os.remove(partname)
+            raise DownloadError(f"Checksum mismatch for {url}, expected {md5} got {md5_digest.hexdigest()}")
+        os.replace(partname, filename)
+        self._remember(filename, response_headers)
+
+        result = DownloadResult(url, filename, os.path.getsize(filename), time.perf_counter() - start, attempt, resumed, etag,
+                                sha256_digest.hexdigest())
+        logging.info(f"Downloaded {os.path.basename(filename)} {result.size / (1024 * 1024):.1f}MB in "
+                     f"{result.seconds:.1f}s ({result.rate / (1024 * 1024):.2f}MB/s)")
+        return result
+
+    @staticmethod
+    def _expected_size(response, offset, expected):
+        """
+        Return the size of the complete file, using Content-Range for partial
+        responses and Content-Length otherwise.
+        """
+        content_range = response.headers.get("Content-Range")
+        if content_range and "/" in content_range:
+            total = content_range.split("/")[-1]
+            if total.isdigit():
+                return int(total)
+        length = response.headers.get("Content-Length")
+        if length is not None and length.isdigit() and "Content-Encoding" not in response.headers:
+            return offset + int(length)
+        return expected
+
+    def submit(self, url, filename, revalidate=False):
+        """
+        Start downloading the url in the background, returns a future with the DownloadResult.
+        """
+        return self.executor.submit(self.download, url, filename, revalidate)
+
+    def download_many(self, downloads):
+        """
+        Download a list of (url, filename) or (url, filename, revalidate) concurrently.
+
+        Returns:
+            list: The DownloadResult for each download, in the same order.
+
+        Raises:
+            DownloadError: If any of the downloads failed.
+        """
+        futures = [self.submit(*download) for download in downloads]
+        return [f.result() for f in futures]
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.session.close()
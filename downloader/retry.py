@@ -0,0 +1,163 @@
+import json
+import logging
+import threading
+import time
+
+import pika
+
+# header with the number of times the message has been tried
+ATTEMPT_HEADER = "x-attempt"
+
+# header with the exception of the last attempt
+EXCEPTION_HEADER = "x-exception"
+
+
+class RetryPolicy:
+    """
+    Decides what happens with a message that could not be processed. The
+    message is published to a delay queue, which has no consumers. Once the
+    time to live of the delay queue expires, RabbitMQ dead letters the message
+    back to the original queue. Each attempt waits twice as long as the
+    previous one, up to max_delay. After max_attempts the message is sent to
+    the error queue with the exception added.
+
+    The number of attempts is kept in the x-attempt header of the message.
+
+    This file is shared by the cdrhook, downloader and uploader and should
+    be kept the same in each of them.
+    """
+    def __init__(self, queue, error_queue=None, max_attempts=5, delay=30, max_delay=3600):
+        """
+        Args:
+            queue (str): The queue the messages are consumed from.
+            error_queue (str, optional): The queue for failed messages. Defaults to queue + ".error".
+            max_attempts (int, optional): The number of times a message is tried. Defaults to 5.
+            delay (int, optional): Seconds to wait before the first retry. Defaults to 30.
+            max_delay (int, optional): Longest wait between retries in seconds. Defaults to 3600.
+        """
+        self.queue = queue
+        self.error_queue = error_queue or f"{queue}.error"
+        self.max_attempts = max(1, max_attempts)
+        self.delay = delay
+        self.max_delay = max_delay
+        self.retried = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def get_delay(self, attempt):
+        """
+        Return the delay in seconds after the given attempt failed.
+        """
+        return int(min(self.delay * 2 ** (attempt - 1), self.max_delay))
+
+    def delay_queue(self, delay):
+        return f"{self.queue}.retry.{delay}"
+
+    def arguments(self, queue_name):
+        """
+        Return the arguments used to declare the queue, None for queues that
+        are not a delay queue.
+        """
+        prefix = f"{self.queue}.retry."
+        if not queue_name.startswith(prefix):
+            return None
+        return {
+            "x-message-ttl": int(queue_name[len(prefix):]) * 1000,
+            "x-dead-letter-exchange": "",
+            "x-dead-letter-routing-key": self.queue,
+        }
+
+    def declare(self, channel):
+        """
+        Declare the error queue and all delay queues on the channel.
+        """
+        channel.queue_declare(queue=self.error_queue, durable=True)
+        for delay in sorted(set(self.get_delay(a) for a in range(1, self.max_attempts))):
+            queue_name = self.delay_queue(delay)
+            channel.queue_declare(queue=queue_name, durable=True, arguments=self.arguments(queue_name))
+
+    @staticmethod
+    def attempt(properties):
+        """
+        Return the attempt number of the message, 1 for the first delivery.
+        """
+        headers = getattr(properties, "headers", None) or {}
+        try:
+            return int(headers.get(ATTEMPT_HEADER, 1))
+        except (TypeError, ValueError):
+            return 1
+
+    def route(self, properties=None, exception=None, permanent=False):
+        """
+        Decide where a failed message goes next.
+
+        Args:
+            properties (pika.BasicProperties, optional): The properties of the failed message.
+            exception (Exception, optional): The exception that made the message fail.
+            permanent (bool, optional): The message will never succeed, send it to the error queue.
+
+        Returns:
+            tuple: The queue name, the new message properties and True if the message is retried.
+        """
+        attempt = self.attempt(properties)
+        headers = dict(getattr(properties, "headers", None) or {})
+        if exception is not None:
+            headers[EXCEPTION_HEADER] = repr(exception)[:1000]
+        retry = not permanent and attempt < self.max_attempts
+        if retry:
+            headers[ATTEMPT_HEADER] = attempt + 1
+            queue_name = self.delay_queue(self.get_delay(attempt))
+            logging.warning(f"Retrying message from {self.queue} in {self.get_delay(attempt)} seconds "
+                            f"(attempt {attempt} of {self.max_attempts} failed)")
+        else:
+            queue_name = self.error_queue
+            logging.error(f"Message from {self.queue} failed after {attempt} attempts, sending to {self.error_queue}")
+        with self._lock:
+            if retry:
+                self.retried += 1
+            else:
+                self.failed += 1
+        new_properties = pika.BasicProperties(
+            content_type=getattr(properties, "content_type", None),
+            delivery_mode=pika.DeliveryMode.Persistent,
+            priority=getattr(properties, "priority", None),
+            correlation_id=getattr(properties, "correlation_id", None),
+            timestamp=int(time.time()),
+            headers=headers)
+        return queue_name, new_properties, retry
+
+    def retry(self, publish, body, properties=None, exception=None, permanent=False):
+        """
+        Send the failed message to a delay queue, or to the error queue with the
+        exception added to the message once all attempts are used.
+
+        Args:
+            publish (Callable): Called with the queue name, body, properties and the
+                arguments to declare the queue with.
+            body (bytes or str): The original message.
+            properties (pika.BasicProperties, optional): The properties of the original message.
+            exception (Exception, optional): The exception that made the message fail.
+            permanent (bool, optional): The message will never succeed, send it to the error queue.
+
+        Returns:
+            bool: True if the message will be retried, False if it was sent to the error queue.
+        """
+        queue_name, new_properties, retry = self.route(properties, exception, permanent)
+        if not retry and exception is not None:
+            try:
+                data = json.loads(body)
+                if isinstance(data, dict):
+                    data["exception"] = repr(exception)
+                    data["attempts"] = self.attempt(properties)
+                    body = json.dumps(data)
+            except ValueError:
+                pass
+        publish(queue_name, body, new_properties, self.arguments(queue_name))
+        return retry
+
+    def report(self):
+        """
+        Return the number of messages retried and sent to the error queue.
+        """
+        with self._lock:
+            return {"queue": self.queue, "retried": self.retried, "failed": self.failed}
@@ -0,0 +1,111 @@
+# Trace context that follows a cog through the pipeline in the message headers.
+# This file is shared by the cdrhook, downloader and uploader and should be kept
+# the same in each of them (checked by tests/test_shared/test_copies.py).
+import json
+import time
+import uuid
+
+import pika
+
+# header with the id of the trace, one trace for each cog processed
+TRACE_ID_HEADER = "x-trace-id"
+
+# header with the stages of the trace, each stored as "stage=timestamp"
+TRACE_HEADER = "x-trace"
+
+# queue with the trace records, collected by the monitor
+TRACE_QUEUE = "trace"
+
+# the trace queue is capped so it does not grow if the monitor is not running
+TRACE_QUEUE_ARGUMENTS = {"x-max-length": 100000}
+
+# headers that belong to the message in a single queue, the attempts of the
+# retry policy (retry.py) and the parts of a split upload already posted
+# (uploader.py). They are not passed on to the message for the next queue.
+MESSAGE_HEADERS = ("x-attempt", "x-exception", "x-uploaded-parts", "x-upload-part-bytes")
+
+
+def add_stage(headers, stage, timestamp=None):
+    """
+    Return a copy of the message headers with the stage added to the trace,
+    a new trace is started if the headers do not have one.
+    """
+    headers = dict(headers or {})
+    if not headers.get(TRACE_ID_HEADER):
+        headers[TRACE_ID_HEADER] = uuid.uuid4().hex
+    if timestamp is None:
+        timestamp = time.time()
+    headers[TRACE_HEADER] = list(headers.get(TRACE_HEADER) or []) + [f"{stage}={timestamp:.3f}"]
+    return headers
+
+
+def next_stage(headers, stage, timestamp=None):
+    """
+    Return the headers for the message sent to the next queue, with the stage
+    added to the trace and without the headers of the current message.
+    """
+    headers = {k: v for k, v in (headers or {}).items() if k not in MESSAGE_HEADERS}
+    return add_stage(headers, stage, timestamp)
+
+
+def fork(headers):
+    """
+    Return headers with the stages of the trace but a new trace id, used when
+    a single message results in multiple cogs being processed. Each cog is a
+    new message, so the headers of the current message are removed.
+    """
+    headers = {k: v for k, v in (headers or {}).items() if k not in MESSAGE_HEADERS}
+    headers.pop(TRACE_ID_HEADER, None)
+    return headers
+
+
+def get_stages(headers):
+    """
+    Return the stages of the trace as a list of (stage, timestamp).
+    """
+    stages = []
+    for item in (headers or {}).get(TRACE_HEADER) or []:
+        if isinstance(item, bytes):
+            item = item.decode("utf-8")
+        stage, _, timestamp = str(item).rpartition("=")
+        try:
+            stages.append((stage, float(timestamp)))
+        except ValueError:
+            continue
+    return stages
+
+
+def properties_with_stage(properties, stage, next_queue=False):
+    """
+    Return new message properties with the stage added to the trace of the
+    headers, keeping the other properties of the message. If next_queue is
+    True the properties are for a message sent to the next queue, the
+    headers of the current message (see next_stage) are not copied. Keep
+    them for a message that is retried in the same queue.
+    """
+    headers = getattr(properties, "headers", None)
+    return pika.BasicProperties(
+        content_type=getattr(properties, "content_type", None),
+        delivery_mode=pika.DeliveryMode.Persistent,
+        priority=getattr(properties, "priority", None),
+        correlation_id=getattr(properties, "correlation_id", None),
+        timestamp=int(time.time()),
+        headers=next_stage(headers, stage) if next_queue else add_stage(headers, stage))
+
+
+def trace_record(headers, cog_id):
+    """
+    Return the trace record sent to the trace queue as json.
+    """
+    headers = headers or {}
+    trace_id = headers.get(TRACE_ID_HEADER)
+    if isinstance(trace_id, bytes):
+        trace_id = trace_id.decode("utf-8")
+    return json.dumps({"trace_id": trace_id, "cog_id": cog_id, "stages": get_stages(headers)})
+
+
+def declare(channel, queue_name=TRACE_QUEUE):
+    """
+    Declare the trace queue on the channel.
+    """
+    channel.queue_declare(queue=queue_name, durable=True, arguments=TRACE_QUEUE_ARGUMENTS)
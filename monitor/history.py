@@ -0,0 +1,184 @@
+import array
+import math
+import threading
+
+# values kept for every queue in each snapshot, publish and ack are the
+# total number of messages published and acked reported by RabbitMQ
+FIELDS = ("time", "messages", "unack", "publish", "ack")
+
+
+class RingBuffer:
+  """
+  Fixed size history of samples, each field is stored in its own array of
+  doubles so a sample takes 8 bytes per field. Once full the oldest sample
+  is overwritten.
+  """
+  def __init__(self, capacity, fields=FIELDS):
+    self.capacity = capacity
+    self.fields = fields
+    self.columns = {field: array.array('d', bytes(8 * capacity)) for field in fields}
+    self.next = 0
+    self.count = 0
+
+  def append(self, values):
+    for field in self.fields:
+      self.columns[field][self.next] = values.get(field, math.nan)
+    self.next = (self.next + 1) % self.capacity
+    self.count = min(self.count + 1, self.capacity)
+
+  def samples(self, since=0):
+    """
+    Return the samples, oldest first, with a time of at least since.
+    """
+    start = (self.next - self.count) % self.capacity
+    times = self.columns["time"]
+    # the samples are appended in time order, find the first one with a binary search
+    low, high = 0, self.count
+    while low < high:
+      middle = (low + high) // 2
+      if times[(start + middle) % self.capacity] < since:
+        low = middle + 1
+      else:
+        high = middle
+    result = []
+    for i in range(low, self.count):
+      index = (start + i) % self.capacity
+      result.append({field: self.columns[field][index] for field in self.fields})
+    return result
+
+  def last(self):
+    if self.count == 0:
+      return None
+    index = (self.next - 1) % self.capacity
+    return {field: self.columns[field][index] for field in self.fields}
+
+
+def _value(value):
+  return None if value is None or math.isnan(value) else value
+
+
+def _rate(previous, current, field):
+  """
+  Return the rate per second of the counter between two samples, None if
+  unknown. Counters going back (RabbitMQ restarted) count as 0.
+  """
+  seconds = current["time"] - previous["time"]
+  if seconds <= 0 or math.isnan(previous[field]) or math.isnan(current[field]):
+    return None
+  return max(0.0, current[field] - previous[field]) / seconds
+
+
+def _average(values):
+  values = [v for v in values if v is not None]
+  return sum(values) / len(values) if values else None
+
+
+class QueueHistory:
+  """
+  Keeps the history of the messages in each queue for retention seconds,
+  recorded every time the queue snapshot is refreshed. Used to compute the
+  publish and ack rates of the queues and the estimated time until a queue
+  is empty.
+  """
+  def __init__(self, retention=86400, interval=5, window=300):
+    """
+    Args:
+      retention (float, optional): Seconds of history to keep. Defaults to 86400.
+      interval (float, optional): Seconds between snapshots. Defaults to 5.
+      window (float, optional): Seconds used to compute the current rates. Defaults to 300.
+    """
+    self.retention = retention
+    self.capacity = max(2, int(math.ceil(retention / interval)) + 1)
+    self.window = window
+    self.queues = {}
+    self.lock = threading.Lock()
+
+  def record(self, timestamp, data):
+    """
+    Add the queues returned by the RabbitMQ management API to the history.
+    Queues that have not been seen for longer than the retention are removed.
+    """
+    with self.lock:
+      for item in data:
+        stats = item.get("message_stats") or {}
+        buffer = self.queues.get(item["name"])
+        if buffer is None:
+          buffer = self.queues[item["name"]] = RingBuffer(self.capacity)
+        buffer.append({
+          "time": timestamp,
+          "messages": item.get("messages", math.nan),
+          "unack": item.get("messages_unacknowledged", math.nan),
+          "publish": stats.get("publish", math.nan),
+          "ack": stats.get("ack", math.nan),
+        })
+      for name in [name for name, buffer in self.queues.items() if buffer.last()["time"] < timestamp - self.retention]:
+        del self.queues[name]
+
+  def rates(self, name, now=None):
+    """
+    Return the publish and ack rates over the last window seconds, and the
+    estimated seconds until the queue is empty (None if it is not draining).
+    """
+    with self.lock:
+      buffer = self.queues.get(name)
+      if buffer is None:
+        return None
+      last = buffer.last()
+      samples = buffer.samples((now or last["time"]) - self.window)
+    result = {
+      "queue": name,
+      "messages": _value(last["messages"]),
+      "unack": _value(last["unack"]),
+      "publish_rate": None,
+      "ack_rate": None,
+      "eta_seconds": None,
+    }
+    if len(samples) < 2:
+      return result
+    result["publish_rate"] = _rate(samples[0], samples[-1], "publish")
+    result["ack_rate"] = _rate(samples[0], samples[-1], "ack")
+    drain = (result["ack_rate"] or 0) - (result["publish_rate"] or 0)
+    if result["messages"] is not None:
+      if result["messages"] == 0:
+        result["eta_seconds"] = 0
+      elif drain > 0:
+        result["eta_seconds"] = result["messages"] / drain
+    return result
+
+  def summary(self):
+    """
+    Return the rates and drain estimate of all queues.
+    """
+    with self.lock:
+      names = sorted(self.queues)
+    return [self.rates(name) for name in names]
+
+  def series(self, name, seconds=3600, points=360):
+    """
+    Return the history of the queue for the last seconds, averaged into at
+    most points buckets. Each bucket has the average messages, unacked
+    messages, publish and ack rate.
+    """
+    with self.lock:
+      buffer = self.queues.get(name)
+      if buffer is None:
+        return None
+      last = buffer.last()
+      samples = buffer.samples(last["time"] - seconds)
+    rows = []
+    for previous, current in zip(samples, samples[1:]):
+      rows.append((current["time"], current["messages"], current["unack"],
+                   _rate(previous, current, "publish"), _rate(previous, current, "ack")))
+    points = max(1, points)
+    size = max(1, int(math.ceil(len(rows) / points)))
+    result = []
+    for i in range(0, len(rows), size):
+      bucket = rows[i:i + size]
+      result.append({
+        "time": bucket[-1][0],
+        "messages": _average([_value(r[1]) for r in bucket]),
+        "unack": _average([_value(r[2]) for r in bucket]),
+        "publish_rate": _average([r[3] for r in bucket]),
+        "ack_rate": _average([r[4] for r in bucket]),
+      })
+    return {"queue": name, "seconds": seconds, "points": result}
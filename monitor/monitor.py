@@ -5,16 +5,39 @@ import json
 import logging
 import os
 import sys
-import requests
+import threading
 from urllib.parse import urlparse, parse_qs
 
+from history import QueueHistory
+from snapshot import QueueSnapshot
+import traces
+from traces import TraceCollector
+
+# history of the queues for HISTORY_RETENTION seconds, rates use the last HISTORY_WINDOW seconds
+monitor_interval = float(os.environ.get('MONITOR_INTERVAL', '5'))
+queue_history = QueueHistory(retention=float(os.environ.get('HISTORY_RETENTION', '86400')),
+                             interval=monitor_interval,
+                             window=float(os.environ.get('HISTORY_WINDOW', '300')))
+
+# snapshot of the queues, refreshed in the background every MONITOR_INTERVAL seconds
+queue_snapshot = QueueSnapshot(os.environ.get('RABBITMQ_MGMT_URL', 'http://rabbitmq:15672'),
+                               os.environ.get('RABBITMQ_USERNAME', 'guest'),
+                               os.environ.get('RABBITMQ_PASSWORD', 'guest'),
+                               interval=monitor_interval,
+                               history=queue_history)
+
+# collects the per stage timing of the cogs
+trace_collector = TraceCollector(max_traces=int(os.environ.get('TRACE_MAX', '10000')))
+
 # ----------------------------------------------------------------------
 # WEB SERVER
 # ----------------------------------------------------------------------
 class MyServer(http.server.SimpleHTTPRequestHandler):
   """
-  Handles the responses from the web server. Only response that is
-  handled is a GET that will return all known queues.
+  Handles the responses from the web server. Handles a GET that will
+  return all known queues from the last snapshot, a GET that returns the
+  history and drain estimate of the queues, and a GET that returns the
+  stage latencies and slowest cogs from the traces.
   """
   def do_GET(self):
     self.path = os.path.basename(self.path)
@@ -22,74 +45,53 @@ class MyServer(http.server.SimpleHTTPRequestHandler):
       self.path = '/'
 
     if self.path.startswith('queues.json'):
-      query = urlparse(self.path).query
       query_components = parse_qs(urlparse(self.path).query)
       search = query_components.get("search", [""])[0]
-      queues = {}
+      body, etag = queue_snapshot.get(search)
+      if etag in self.headers.get('If-None-Match', ''):
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.end_headers()
+        return
+      self.send_response(200)
+      self.send_header('Content-type', 'application/json')
+      self.send_header('Content-Length', str(len(body)))
+      self.send_header('ETag', etag)
+      self.send_header('Cache-Control', 'no-cache')
+      self.end_headers()
+      self.wfile.write(body)
+    elif self.path.startswith('history.json'):
+      query_components = parse_qs(urlparse(self.path).query)
+      queue = query_components.get("queue", [""])[0]
+      if queue:
+        try:
+          seconds = float(query_components.get("seconds", ["3600"])[0])
+          points = int(query_components.get("points", ["360"])[0])
+        except ValueError:
+          self.send_error(400, "seconds and points should be numbers")
+          return
+        result = queue_history.series(queue, seconds, points)
+        if result is None:
+          self.send_error(404, f"Unknown queue {queue}")
+          return
+        result.update(queue_history.rates(queue))
+      else:
+        result = queue_history.summary()
+      self.send_response(200)
+      self.send_header('Content-type', 'application/json')
+      self.end_headers()
+      self.wfile.write(bytes(json.dumps(result), 'utf-8'))
+    elif self.path.startswith('traces.json'):
+      query_components = parse_qs(urlparse(self.path).query)
       try:
-        rabbitmq_mgmt_url = os.environ.get('RABBITMQ_MGMT_URL', 'http://rabbitmq:15672')
-        rabbitmq_username = os.environ.get('RABBITMQ_USERNAME', 'guest')
-        rabbitmq_password = os.environ.get('RABBITMQ_PASSWORD', 'guest')
-        response = requests.get(f"{rabbitmq_mgmt_url}/api/queues/%2F", auth=(rabbitmq_username, rabbitmq_password), timeout=5)
-        response.raise_for_status()
-        for data in response.json():
-          if search not in data['name'].split('.')[0]:
-            continue
-          if data['name'].endswith(".error"):
-            queue = data['name'][:-6]
-            consumers = data['consumers']
-            messages = None
-            total = None
-            unack = None
-            unknown = 0
-            errors = data['messages']
-          elif data['name'].endswith(".unknown"):
-            queue = data['name'][:-8]
-            consumers = data['consumers']
-            messages = None
-            total = None
-            unack = None
-            unknown = data['messages']
-            errors = 0
-          else:
-            queue = data['name']
-            consumers = data['consumers']
-            messages = f'{data["messages"]} / {data["messages_unacknowledged"]}'
-            total = data["messages"]
-            unack = data["messages_unacknowledged"]
-            unknown = 0
-            errors = 0
-
-          if queue in queues:
-            if consumers != 0:
-              queues[queue]['consumers'] = consumers
-            if messages:
-              queues[queue]['messages'] = messages
-            if total:
-              queues[queue]['total'] = total
-            if unack:
-              queues[queue]['unack'] = unack
-            if errors != 0:
-              queues[queue]['errors'] = errors
-            if unknown != 0:
-              queues[queue]['unknown'] = unknown
-          else:
-            queues[queue] = {
-              'queue': queue,
-              'consumers': consumers,
-              'messages': messages,
-              'total': total,
-              'unack': unack,
-              'unknown': unknown,
-              'errors': errors,
-            }
-      except:
-        logging.exception("Error getting queues from RabbitMQ.")
-        queues = {}
+        slowest = int(query_components.get("slowest", ["10"])[0])
+      except ValueError:
+        self.send_error(400, "slowest should be a number")
+        return
       self.send_response(200)
       self.send_header('Content-type', 'application/json')
       self.end_headers()
-      self.wfile.write(bytes(json.dumps(list(queues.values())), 'utf-8'))
+      self.wfile.write(bytes(json.dumps(trace_collector.summary(slowest)), 'utf-8'))
     else:
       super().do_GET()
 
@@ -105,7 +107,15 @@ if __name__ == "__main__":
   logging.getLogger('urllib3.connectionpool').setLevel(logging.WARN)
   logging.getLogger('pika').setLevel(logging.WARN)
 
-  server = http.server.HTTPServer(("", 9999), MyServer)
+  rabbitmq_uri = os.environ.get('RABBITMQ_URI', '')
+  if rabbitmq_uri:
+    trace_queue = os.environ.get('PREFIX', '') + traces.TRACE_QUEUE
+    thread = threading.Thread(target=trace_collector.run, args=(rabbitmq_uri, trace_queue), daemon=True)
+    thread.start()
+
+  queue_snapshot.start()
+
+  server = http.server.ThreadingHTTPServer(("", 9999), MyServer)
   try:
     server.serve_forever()
   except:
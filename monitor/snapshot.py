@@ -0,0 +1,157 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+
+import requests
+
+
+def aggregate_queues(items, search=""):
+  """
+  Combine the queues returned by the RabbitMQ management API into one entry
+  per queue, with the messages of the .error and .unknown queues added as
+  errors and unknown, and the messages waiting in the .retry.<seconds> delay
+  queues added as retry. Only queues whose name before the first . contains
+  search are included.
+  """
+  queues = {}
+  for data in items:
+    if search not in data['name'].split('.')[0]:
+      continue
+    retry = 0
+    if data['name'].endswith(".error"):
+      queue = data['name'][:-6]
+      consumers = data['consumers']
+      messages = None
+      total = None
+      unack = None
+      unknown = 0
+      errors = data['messages']
+    elif data['name'].endswith(".unknown"):
+      queue = data['name'][:-8]
+      consumers = data['consumers']
+      messages = None
+      total = None
+      unack = None
+      unknown = data['messages']
+      errors = 0
+    elif ".retry." in data['name']:
+      queue = data['name'][:data['name'].rindex(".retry.")]
+      consumers = 0
+      messages = None
+      total = None
+      unack = None
+      unknown = 0
+      errors = 0
+      retry = data['messages']
+    else:
+      queue = data['name']
+      consumers = data['consumers']
+      messages = f'{data["messages"]} / {data["messages_unacknowledged"]}'
+      total = data["messages"]
+      unack = data["messages_unacknowledged"]
+      unknown = 0
+      errors = 0
+
+    if queue in queues:
+      if consumers != 0:
+        queues[queue]['consumers'] = consumers
+      if messages:
+        queues[queue]['messages'] = messages
+      if total:
+        queues[queue]['total'] = total
+      if unack:
+        queues[queue]['unack'] = unack
+      if errors != 0:
+        queues[queue]['errors'] = errors
+      if unknown != 0:
+        queues[queue]['unknown'] = unknown
+      queues[queue]['retry'] += retry
+    else:
+      queues[queue] = {
+        'queue': queue,
+        'consumers': consumers,
+        'messages': messages,
+        'total': total,
+        'unack': unack,
+        'unknown': unknown,
+        'errors': errors,
+        'retry': retry,
+      }
+  return list(queues.values())
+
+
+class QueueSnapshot:
+  """
+  Keeps a snapshot of the queues in RabbitMQ, refreshed in the background
+  every interval seconds, so requests to the monitor never wait for the
+  management API. The json for each search is computed once per snapshot,
+  together with an ETag so clients can skip unchanged responses. Each
+  snapshot is also recorded in the history, if one is given.
+  """
+  def __init__(self, mgmt_url, username, password, interval=5, timeout=5, history=None):
+    self.url = f"{mgmt_url}/api/queues/%2F"
+    self.auth = (username, password)
+    self.interval = interval
+    self.timeout = timeout
+    self.history = history
+    self.data = []
+    self.updated = 0
+    self.responses = {}
+    self.lock = threading.Lock()
+    self.session = requests.Session()
+
+  def refresh(self):
+    """
+    Get the queues from the management API and replace the snapshot. If the
+    request fails the previous snapshot is kept.
+    """
+    try:
+      response = self.session.get(self.url, auth=self.auth, timeout=self.timeout,
+                                  params={"columns": "name,consumers,messages,messages_unacknowledged,"
+                                                           "message_stats.publish,message_stats.ack"})
+      response.raise_for_status()
+      data = response.json()
+    except Exception:
+      logging.exception("Error getting queues from RabbitMQ.")
+      return False
+    with self.lock:
+      self.data = data
+      self.updated = time.time()
+      self.responses = {}
+    if self.history is not None:
+      self.history.record(self.updated, data)
+    return True
+
+  def get(self, search=""):
+    """
+    Return the json body and ETag of the queues matching search.
+    """
+    with self.lock:
+      response = self.responses.get(search)
+      if response is None:
+        body = bytes(json.dumps(aggregate_queues(self.data, search)), 'utf-8')
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        response = (body, etag)
+        # searches come from a small set of clients, limit it in case of abuse
+        if len(self.responses) < 1000:
+          self.responses[search] = response
+      return response
+
+  def run(self):
+    """
+    Refresh the snapshot every interval seconds. This does not return.
+    """
+    while True:
+      time.sleep(self.interval)
+      self.refresh()
+
+  def start(self):
+    """
+    Take the first snapshot and start refreshing in a background thread.
+    """
+    self.refresh()
+    thread = threading.Thread(target=self.run, name="snapshot", daemon=True)
+    thread.start()
+    return thread
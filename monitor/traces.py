@@ -0,0 +1,116 @@
+import collections
+import json
+import logging
+import math
+import threading
+import time
+
+import pika
+
+# queue with the trace records and its arguments, these have to match
+# tracing.py of the cdrhook, downloader and uploader
+TRACE_QUEUE = "trace"
+TRACE_QUEUE_ARGUMENTS = {"x-max-length": 100000}
+
+
+def percentile(values, fraction):
+  """
+  Return the value at the fraction (0-1) of the sorted values, using the
+  nearest rank.
+  """
+  if not values:
+    return None
+  values = sorted(values)
+  index = min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))
+  return values[index]
+
+
+class TraceCollector:
+  """
+  Collects the trace records sent by the downloader and uploader. Records
+  are merged by trace id, if the uploader has no trace id (the pipeline did
+  not pass the headers on) the record is added to the last trace of the cog.
+  Only the last max_traces traces are kept.
+  """
+  def __init__(self, max_traces=10000):
+    self.max_traces = max_traces
+    self.traces = collections.OrderedDict()
+    self.cogs = {}
+    self.received = 0
+    self.lock = threading.Lock()
+
+  def add(self, record):
+    trace_id = record.get("trace_id")
+    cog_id = record.get("cog_id")
+    with self.lock:
+      self.received += 1
+      if trace_id not in self.traces and cog_id in self.cogs:
+        trace_id = self.cogs[cog_id]
+      trace = self.traces.pop(trace_id, None) or {"trace_id": trace_id, "cog_id": cog_id, "stages": {}}
+      # a stage seen more than once (retries, multiple models) keeps the last time
+      for stage, timestamp in record.get("stages", []):
+        trace["stages"][stage] = timestamp
+      self.traces[trace_id] = trace
+      if cog_id:
+        self.cogs[cog_id] = trace_id
+      while len(self.traces) > self.max_traces:
+        old_id, old = self.traces.popitem(last=False)
+        if self.cogs.get(old["cog_id"]) == old_id:
+          del self.cogs[old["cog_id"]]
+
+  def summary(self, slowest=10):
+    """
+    Return the latency percentiles between consecutive stages, and the
+    slowest cogs from the first to the last stage seen.
+    """
+    with self.lock:
+      traces = [(t["trace_id"], t["cog_id"], dict(t["stages"])) for t in self.traces.values()]
+      received = self.received
+
+    latencies = collections.defaultdict(list)
+    totals = []
+    for trace_id, cog_id, stages in traces:
+      stages = sorted(stages.items(), key=lambda x: x[1])
+      for (first, start), (second, end) in zip(stages, stages[1:]):
+        latencies[f"{first} -> {second}"].append(end - start)
+      if len(stages) > 1:
+        totals.append({
+          "trace_id": trace_id,
+          "cog_id": cog_id,
+          "seconds": stages[-1][1] - stages[0][1],
+          "stages": {stage: timestamp - stages[0][1] for stage, timestamp in stages},
+        })
+
+    result = []
+    for name, values in latencies.items():
+      result.append({
+        "stage": name,
+        "count": len(values),
+        "p50": percentile(values, 0.5),
+        "p90": percentile(values, 0.9),
+        "p99": percentile(values, 0.99),
+        "max": max(values),
+      })
+    result.sort(key=lambda x: -x["p50"])
+    totals.sort(key=lambda x: -x["seconds"])
+    return {"received": received, "traces": len(traces), "stages": result, "slowest": totals[:slowest]}
+
+  def run(self, rabbitmq_uri, queue_name=TRACE_QUEUE):
+    """
+    Consume the trace records from RabbitMQ, reconnecting if the connection
+    is lost. This does not return.
+    """
+    while True:
+      try:
+        connection = pika.BlockingConnection(pika.URLParameters(rabbitmq_uri))
+        channel = connection.channel()
+        channel.queue_declare(queue=queue_name, durable=True, arguments=TRACE_QUEUE_ARGUMENTS)
+        logging.info(f"Collecting traces from {queue_name}")
+        for method, properties, body in channel.consume(queue=queue_name, auto_ack=True):
+          try:
+            self.add(json.loads(body))
+          except (ValueError, TypeError, AttributeError):
+            logging.warning(f"Ignoring invalid trace record {body[:200]}")
+      except Exception:
+        logging.exception("Error collecting traces.")
+      time.sleep(5)
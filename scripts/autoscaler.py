@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+"""
+Starts pipeline jobs on SLURM based on the number of messages waiting in the
+process queues. The queue sizes and ack rates are read from the monitor
+(queues.json and history.json) and squeue is called once per cycle for all
+models. The number of jobs for a model is the number needed to empty its
+queue in --target-seconds at the observed throughput per job, or 1 job for
+every --messages-per-job messages until the throughput is known.
+
+Jobs are never cancelled, they are expected to stop when their queue is
+empty. Since a job takes a while to start processing, the target of a model
+only goes down once it is more than --hysteresis jobs below the current
+target.
+"""
+import argparse
+import logging
+import math
+import os
+import subprocess
+import time
+
+import requests
+
+
+class Scheduler:
+    """
+    Counts and submits the SLURM jobs of the user, using the job name as the
+    name of the model.
+    """
+    def __init__(self, user=None):
+        self.user = user or os.environ.get("USER", "")
+
+    def jobs(self):
+        """
+        Return a dict from job name to the number of running and pending jobs,
+        using a single call to squeue.
+        """
+        result = subprocess.run(["squeue", "--user", self.user, "--noheader", "--format=%j %T"],
+                                stdout=subprocess.PIPE, check=True)
+        jobs = {}
+        for line in result.stdout.decode("utf-8").splitlines():
+            parts = line.split()
+            if len(parts) != 2:
+                continue
+            counts = jobs.setdefault(parts[0], {"running": 0, "pending": 0})
+            if parts[1] == "RUNNING":
+                counts["running"] += 1
+            else:
+                counts["pending"] += 1
+        return jobs
+
+    def submit(self, name, script):
+        """
+        Submit the batch script with the name of the model as job name.
+        """
+        result = subprocess.run(["sbatch", "--job-name", name, script], stdout=subprocess.PIPE, check=True)
+        return result.stdout.decode("utf-8").strip()
+
+
+class MonitorStats:
+    """
+    Reads the queues from the monitor, one request for the sizes and one for
+    the rates.
+    """
+    def __init__(self, url, timeout=10):
+        self.queues_url = url
+        self.history_url = url.replace("queues.json", "history.json")
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def get(self):
+        """
+        Return a dict from queue name to the total messages and the ack rate
+        per second, the ack rate is None if the monitor has no history.
+        """
+        response = self.session.get(self.queues_url, timeout=self.timeout)
+        response.raise_for_status()
+        stats = {q["queue"]: {"total": q.get("total") or 0, "ack_rate": None} for q in response.json()}
+        try:
+            response = self.session.get(self.history_url, timeout=self.timeout)
+            response.raise_for_status()
+            for q in response.json():
+                if q["queue"] in stats:
+                    stats[q["queue"]]["ack_rate"] = q.get("ack_rate")
+        except (requests.RequestException, ValueError, TypeError, KeyError):
+            logging.debug("No queue history in the monitor", exc_info=True)
+        return stats
+
+
+class Model:
+    """
+    A model that is started as a SLURM job to process the messages in its queue.
+    """
+    def __init__(self, name, script, queue=None, max_jobs=5, messages_per_job=10):
+        self.name = name
+        self.script = script
+        self.queue = queue or f"process_{name}"
+        self.max_jobs = max_jobs
+        self.messages_per_job = messages_per_job
+        # messages per second processed by a single job, learned from the ack rate
+        self.job_rate = None
+        self.target = 0
+        self.last_launch = 0
+
+
+class Autoscaler:
+    """
+    Decides how many jobs each model needs and submits the missing jobs.
+    """
+    def __init__(self, scheduler, stats, models, target_seconds=3600, hysteresis=1, cooldown=120,
+                 max_launch=2, smoothing=0.3):
+        """
+        Args:
+            scheduler (Scheduler): Used to count and submit jobs.
+            stats (MonitorStats): Used to get the queue sizes and ack rates.
+            models (list[Model]): The models to scale.
+            target_seconds (float, optional): Time in which the queue should be empty. Defaults to 3600.
+            hysteresis (int, optional): Number of jobs the need can be below the target without
+                lowering the target. Defaults to 1.
+            cooldown (float, optional): Seconds to wait after submitting jobs for a model before
+                submitting more. Defaults to 120.
+            max_launch (int, optional): Most jobs submitted for a model in one cycle. Defaults to 2.
+            smoothing (float, optional): Weight of the newest throughput measurement. Defaults to 0.3.
+        """
+        self.scheduler = scheduler
+        self.stats = stats
+        self.models = models
+        self.target_seconds = target_seconds
+        self.hysteresis = hysteresis
+        self.cooldown = cooldown
+        self.max_launch = max_launch
+        self.smoothing = smoothing
+
+    def needed(self, model, backlog):
+        """
+        Return the number of jobs needed to process the backlog in time.
+        """
+        if backlog <= 0:
+            return 0
+        if model.job_rate:
+            needed = math.ceil(backlog / (model.job_rate * self.target_seconds))
+        else:
+            needed = math.ceil(backlog / model.messages_per_job)
+        return max(1, min(needed, model.max_jobs))
+
+    def update_rate(self, model, ack_rate, running):
+        """
+        Update the throughput per job of the model, only while the jobs are
+        busy, so an empty queue does not lower the rate.
+        """
+        if not ack_rate or running <= 0:
+            return
+        rate = ack_rate / running
+        if model.job_rate is None:
+            model.job_rate = rate
+        else:
+            model.job_rate = self.smoothing * rate + (1 - self.smoothing) * model.job_rate
+
+    def cycle(self, now=None):
+        """
+        Check all models once and submit the jobs that are missing.
+
+        Returns:
+            list[dict]: The status of each model.
+        """
+        now = now or time.time()
+        jobs = self.scheduler.jobs()
+        stats = self.stats.get()
+        result = []
+        for model in self.models:
+            counts = jobs.get(model.name, {"running": 0, "pending": 0})
+            queue = stats.get(model.queue, {"total": 0, "ack_rate": None})
+            backlog = queue["total"]
+            if backlog > 0:
+                self.update_rate(model, queue["ack_rate"], counts["running"])
+            needed = self.needed(model, backlog)
+            # an empty queue needs no jobs, otherwise only lower the target if well below it
+            if needed == 0 or needed > model.target or needed < model.target - self.hysteresis:
+                model.target = needed
+            current = counts["running"] + counts["pending"]
+            launch = min(max(0, model.target - current), self.max_launch)
+            if launch and now - model.last_launch < self.cooldown:
+                launch = 0
+            for _ in range(launch):
+                logging.info(f"Starting {model.name}: {self.scheduler.submit(model.name, model.script)}")
+            if launch:
+                model.last_launch = now
+            result.append({
+                "model": model.name,
+                "backlog": backlog,
+                "running": counts["running"],
+                "pending": counts["pending"],
+                "job_rate": model.job_rate,
+                "target": model.target,
+                "launched": launch,
+            })
+        return result
+
+    def run(self, interval=60):
+        while True:
+            try:
+                for status in self.cycle():
+                    logging.info(" ".join(f"{k}={v}" for k, v in status.items()))
+            except Exception:
+                logging.exception("Error checking the queues")
+            time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Start pipeline jobs based on the process queues.")
+    parser.add_argument("--monitor-url", default=os.environ.get("MONITOR_URL"),
+                        help="url of queues.json of the monitor (default MONITOR_URL)")
+    parser.add_argument("--model", action="append", required=True,
+                        help="model to scale, can be given multiple times")
+    parser.add_argument("--script-dir", default="/projects/bbym/shared/CDR_processing/pipeline_processing_003",
+                        help="folder with the <model>_launcher.bash scripts")
+    parser.add_argument("--prefix", default=os.environ.get("PREFIX", ""), help="prefix of the queues")
+    parser.add_argument("--max-jobs", type=int, default=5, help="most jobs per model")
+    parser.add_argument("--messages-per-job", type=int, default=10,
+                        help="messages per job until the throughput is known")
+    parser.add_argument("--target-seconds", type=float, default=3600, help="time in which a queue should be empty")
+    parser.add_argument("--hysteresis", type=int, default=1, help="jobs the need can be below the target")
+    parser.add_argument("--cooldown", type=float, default=120, help="seconds between submits for a model")
+    parser.add_argument("--interval", type=float, default=60, help="seconds between checks")
+    parser.add_argument("--once", action="store_true", help="check once and exit")
+    args = parser.parse_args()
+    if not args.monitor_url:
+        parser.error("--monitor-url or MONITOR_URL is required")
+
+    logging.basicConfig(format='%(asctime)-15s %(levelname)-7s : %(message)s', level=logging.INFO)
+    models = [Model(name, os.path.join(args.script_dir, f"{name}_launcher.bash"),
+                    queue=f"{args.prefix}process_{name}", max_jobs=args.max_jobs,
+                    messages_per_job=args.messages_per_job) for name in args.model]
+    autoscaler = Autoscaler(Scheduler(), MonitorStats(args.monitor_url), models,
+                            target_seconds=args.target_seconds, hysteresis=args.hysteresis, cooldown=args.cooldown)
+    if args.once:
+        for status in autoscaler.cycle():
+            logging.info(" ".join(f"{k}={v}" for k, v in status.items()))
+    else:
+        autoscaler.run(args.interval)
+
+
+if __name__ == "__main__":
+    main()
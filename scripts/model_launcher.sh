@@ -15,22 +15,5 @@ EOF
 fi
 source secrets.sh
 
-# start monitoring process queues
-while [ 1 == 1 ]; do
-    LOG="$(date) :"
-    SKIP="\n"
-    for queue in golden_muscat icy_resin; do
-        RUNNING=$(squeue --name=${queue} --user ${USER} --noheader | wc -l)
-        JOBS=$(curl -s ${MONITOR_URL}?search=$queue | jq -r '.[0].total')
-        NEEDED=$(( (JOBS + 9) / 10 ))
-        NEEDED=$(( $NEEDED > 5 ? 5 : ${NEEDED} ))
-        if [ $RUNNING -lt $NEEDED ]; then
-            echo -en "${SKIP}Starting another pipeline for $queue. "
-            SKIP=""
-            sbatch --job-name ${queue} "/projects/bbym/shared/CDR_processing/pipeline_processing_003/${queue}_launcher.bash"
-        fi
-        LOG="${LOG} [$queue : Running=$RUNNING jobs=$JOBS need=$NEEDED]  "
-    done
-    echo -ne "${LOG}  \r"
-    sleep 1
-done
+# start monitoring process queues, see autoscaler.py for the options
+exec python3 "$(dirname "$0")/autoscaler.py" --model golden_muscat --model icy_resin --max-jobs 5 --messages-per-job 10
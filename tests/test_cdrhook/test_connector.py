@@ -94,4 +94,52 @@ class TestCDRConnector:
         con = get_mock_connector()
         del con
         
-        log.info("Test passed successfully")
\ No newline at end of file
+        log.info("Test passed successfully")
+
+    def test_session(self):
+        log = init_test_log("TestCDRConnector/test_session")
+        con = get_mock_connector()
+        con2 = get_mock_connector()
+        assert con.session is not con2.session
+        adapter = con.session.get_adapter("https://api.cdr.land")
+        assert adapter._pool_maxsize == con.pool_size
+        assert adapter.max_retries.total == con.max_retries
+        assert adapter.max_retries.backoff_factor == con.backoff_factor
+        assert adapter.max_retries.respect_retry_after_header
+        assert 429 in adapter.max_retries.status_forcelist
+        assert 502 in adapter.max_retries.status_forcelist
+        log.info("Test passed successfully")
+
+    def test_timeouts(self):
+        log = init_test_log("TestCDRConnector/test_timeouts")
+        con = get_mock_connector()
+        con.endpoint_timeouts = {"area_extractions": 120}
+        assert con.get_timeout(f"{con.cdr_url}/v1/features/abc/area_extractions?size=10") == 120
+        assert con.get_timeout(f"{con.cdr_url}/v1/maps/cog/abc") == con.timeout
+        log.info("Test passed successfully")
+
+    def test_observer(self):
+        log = init_test_log("TestCDRConnector/test_observer")
+
+        class FakeResponse:
+            status_code = 200
+            content = b'{"ok": true}'
+
+            def raise_for_status(self):
+                pass
+
+            def json(self):
+                return {"ok": True}
+
+        class FakeSession:
+            def get(self, url, headers, timeout):
+                return FakeResponse()
+
+        con = get_mock_connector()
+        con._session = FakeSession()
+        observed = []
+        con.add_observer(lambda *args: observed.append(args))
+        assert con.retrieve_endpoint(f"{con.cdr_url}/v1/maps/cog/abc", endpoint="cog_download") == {"ok": True}
+        con.retrieve_endpoint(f"{con.cdr_url}/v1/maps/cog/abc")
+        assert [(o[0], o[2], o[3]) for o in observed] == [("cog_download", 12, "200"), ("/v1/maps/cog/abc", 12, "200")]
+        log.info("Test passed successfully")
@@ -0,0 +1,80 @@
+from cdrhook.ingress import IngressFilter, coalesce_key, event_id, event_name, is_handled, message_priority, \
+    PRIORITY_BULK, PRIORITY_EVENT, PRIORITY_MANUAL
+from tests.utilities import init_test_log
+
+
+def feature(event_id):
+    return {"event": "feature.process", "payload": {"id": event_id}}
+
+
+class TestIngressFilter:
+    def test_handled(self):
+        log = init_test_log("TestIngressFilter/test_handled")
+        assert is_handled({"event": "ping"})
+        assert is_handled({"event": "ncsacog", "cog_id": "abc"})
+        assert is_handled(feature("uncharted-area_123"))
+        assert not is_handled(feature("polymer_123"))
+        assert not is_handled({"event": "map.process"})
+        assert not is_handled({"event": "something.else"})
+        assert not is_handled({})
+        assert event_name({"event": "something.else"}) == "other"
+        assert event_name({}) == "other"
+        assert event_id(feature(" uncharted-area_123 ")) == "uncharted-area_123"
+        assert event_id({"event": "ping"}) == ""
+        log.info("Test passed successfully")
+
+    def test_drop(self):
+        log = init_test_log("TestIngressFilter/test_drop")
+        ingress = IngressFilter()
+        assert ingress.accept({"event": "map.process"}) == "dropped"
+        assert ingress.accept(feature("polymer_123")) == "dropped"
+        assert ingress.accept({"event": "ping"}) == "accepted"
+        assert ingress.accept({"event": "ping"}) == "accepted"
+        ingress = IngressFilter(drop_unhandled=False)
+        assert ingress.accept({"event": "map.process"}) == "accepted"
+        log.info("Test passed successfully")
+
+    def test_coalesce(self):
+        log = init_test_log("TestIngressFilter/test_coalesce")
+        ingress = IngressFilter(window=60)
+        cog = {"event": "ncsacog", "cog_id": "abc", "parameters": {}}
+        assert ingress.accept(cog, now=1000) == "accepted"
+        assert ingress.accept(dict(cog), now=1010) == "merged"
+        # different parameters are different work
+        assert ingress.accept({"event": "ncsacog", "cog_id": "abc", "parameters": {"models": ["x"]}},
+                              now=1010) == "accepted"
+        assert ingress.accept(feature("uncharted-area_1"), now=1010) == "accepted"
+        assert ingress.accept(feature("uncharted-area_1"), now=1020) == "merged"
+
+        # once processing started a new trigger is queued again
+        ingress.started(cog)
+        assert ingress.accept(cog, now=1030) == "accepted"
+        # the window limits how long a message absorbs repeats
+        assert ingress.accept(cog, now=1100) == "accepted"
+        assert ingress.report() == {"accepted": 5, "dropped": 0, "merged": 2, "pending": 3}
+        assert coalesce_key({"event": "ping"}) is None
+        log.info("Test passed successfully")
+
+    def test_coalesce_priority(self):
+        log = init_test_log("TestIngressFilter/test_coalesce_priority")
+        ingress = IngressFilter(window=60)
+        cog = {"event": "ncsacog", "cog_id": "abc", "parameters": {}}
+        assert ingress.accept(cog, now=1000, priority=PRIORITY_BULK) == "accepted"
+        assert ingress.accept(cog, now=1001, priority=PRIORITY_BULK) == "merged"
+        assert ingress.accept(cog, now=1002) == "merged"
+        # a manual request is not stuck behind the bulk request
+        assert ingress.accept(cog, now=1003, priority=PRIORITY_MANUAL) == "accepted"
+        # the manual request is waiting now, lower priorities merge into it
+        assert ingress.accept(cog, now=1004, priority=PRIORITY_MANUAL) == "merged"
+        assert ingress.accept(cog, now=1005, priority=PRIORITY_EVENT) == "merged"
+        assert ingress.report() == {"accepted": 2, "dropped": 0, "merged": 4, "pending": 1}
+        log.info("Test passed successfully")
+
+    def test_priority(self):
+        log = init_test_log("TestIngressFilter/test_priority")
+        cog = {"event": "ncsacog", "cog_id": "abc", "parameters": {}}
+        assert message_priority(cog, manual=True) == PRIORITY_MANUAL
+        assert message_priority(feature("uncharted-area_1")) == PRIORITY_EVENT
+        assert message_priority(cog) == PRIORITY_BULK
+        assert PRIORITY_MANUAL > PRIORITY_EVENT > PRIORITY_BULK
+        log.info("Test passed successfully")
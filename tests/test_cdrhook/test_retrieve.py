@@ -1,5 +1,6 @@
 import os
 import json
+import time
 from dotenv import load_dotenv
 
 import cdrhook.retrieve as rt
@@ -73,6 +74,21 @@ class TestRetrieveCog:
             assert area_system.system_version == test_system.version
         log.info('Test passed successfully')
 
+    def test_iterate_cog_area_extraction(self):
+        log = init_test_log("TestRetrieveCog/test_iterate_cog_area_extraction")
+        cog_id = "5a06544690b6611f419f0c6f244776a536ad52915555555555515545c9b1ddb9"
+
+        all_items = rt.retrieve_cog_area_extraction(self.con, cog_id)
+        paged_items = list(rt.iterate_cog_area_extraction(self.con, cog_id, page_size=2))
+        # Check paging returns the same items as a single request
+        assert [a.area_extraction_id for a in paged_items] == [a.area_extraction_id for a in all_items]
+
+        # Check early stop once a map area is found
+        items = list(rt.iterate_cog_area_extraction(self.con, cog_id, page_size=2, required_categories={"map_area": 1}))
+        assert items[-1].category == "map_area"
+        assert len([a for a in items if a.category == "map_area"]) == 1
+        log.info("Test passed successfully")
+
     def test_retrieve_cog_legend_items(self):
         log = init_test_log("TestRetrieveCog/test_retrieve_cog_legend_items")
         response_data = rt.retrieve_cog_legend_items(self.con, self.cog_id)
@@ -166,4 +182,83 @@ class TestRetrieveEvent:
             fh.write(json.dumps(response_data))
         # Check if response is not empty
         assert response_data
-        log.info("Test passed successfully")
\ No newline at end of file
+        log.info("Test passed successfully")
+
+class TestRetrieveCache:
+    cog_id = "78c274e9575d1ac948d55a55265546d711551cdd5cdd53592c9928d502d50700"
+
+    def teardown_method(self):
+        rt.set_retrieve_cache(None)
+
+    def test_hit_miss(self):
+        log = init_test_log("TestRetrieveCache/test_hit_miss")
+        cache = rt.RetrieveCache(max_entries=2, ttl=60)
+        rt.set_retrieve_cache(cache)
+        calls = []
+        def fetch():
+            calls.append(1)
+            return ["item"]
+        system_id = SystemId(name='polymer', version='0.0.1')
+        for _ in range(3):
+            assert rt.cached_retrieve("legend_items", self.cog_id, fetch, system_id=system_id, validated="true") == ["item"]
+        assert len(calls) == 1
+        # different validated is a different entry
+        rt.cached_retrieve("legend_items", self.cog_id, fetch, system_id=system_id, validated="false")
+        assert len(calls) == 2
+        assert cache.stats() == {"hits": 2, "misses": 2, "entries": 2}
+        # oldest entry is evicted
+        rt.cached_retrieve("area_extractions", self.cog_id, fetch)
+        assert cache.stats()["entries"] == 2
+        log.info("Test passed successfully")
+
+    def test_ttl_and_invalidate(self, tmp_path):
+        log = init_test_log("TestRetrieveCache/test_ttl_and_invalidate")
+        cache = rt.RetrieveCache(ttl=60, directory=str(tmp_path))
+        rt.set_retrieve_cache(cache)
+        calls = []
+        def fetch():
+            calls.append(1)
+            return ["item"]
+        rt.cached_retrieve("cog_download", self.cog_id, fetch)
+        # a new cache reads the persisted entry
+        rt.set_retrieve_cache(rt.RetrieveCache(ttl=60, directory=str(tmp_path)))
+        rt.cached_retrieve("cog_download", self.cog_id, fetch)
+        assert len(calls) == 1
+        rt.invalidate_cog(self.cog_id)
+        rt.cached_retrieve("cog_download", self.cog_id, fetch)
+        assert len(calls) == 2
+        # expired entries are fetched again
+        rt.set_retrieve_cache(rt.RetrieveCache(ttl=0, directory=str(tmp_path)))
+        rt.cached_retrieve("cog_download", self.cog_id, fetch)
+        assert len(calls) == 3
+        log.info("Test passed successfully")
+
+    def test_prune(self, tmp_path):
+        log = init_test_log("TestRetrieveCache/test_prune")
+        cache = rt.RetrieveCache(ttl=60, directory=str(tmp_path))
+        cache.put(cache.make_key("cog_download", self.cog_id), "old")
+        cache.put(cache.make_key("cog_metadata", self.cog_id), "new")
+        old = cache._filename(cache.make_key("cog_download", self.cog_id))
+        os.utime(old, (time.time() - 120, time.time() - 120))
+        assert cache.prune() == 1
+        assert not os.path.exists(old)
+        assert os.path.exists(cache._filename(cache.make_key("cog_metadata", self.cog_id)))
+        # expired files are also removed when the cache is created, with their empty folders
+        rt.RetrieveCache(ttl=0, directory=str(tmp_path))
+        assert os.listdir(tmp_path) == []
+        log.info("Test passed successfully")
+
+    def test_empty_not_cached(self):
+        log = init_test_log("TestRetrieveCache/test_empty_not_cached")
+        cache = rt.RetrieveCache(ttl=60)
+        rt.set_retrieve_cache(cache)
+        results = [[], None, ["item"]]
+        def fetch():
+            return results.pop(0)
+        # nothing posted yet, the CDR is asked again
+        assert rt.cached_retrieve("area_extractions", self.cog_id, fetch) == []
+        assert rt.cached_retrieve("area_extractions", self.cog_id, fetch) is None
+        assert rt.cached_retrieve("area_extractions", self.cog_id, fetch) == ["item"]
+        assert rt.cached_retrieve("area_extractions", self.cog_id, fetch) == ["item"]
+        assert cache.stats()["entries"] == 1
+        log.info("Test passed successfully")
@@ -0,0 +1,64 @@
+import json
+
+import pika
+
+from cdrhook.retry import ATTEMPT_HEADER, RetryPolicy
+from tests.utilities import init_test_log
+
+
+class FakeChannel:
+    def __init__(self):
+        self.declared = {}
+
+    def queue_declare(self, queue, durable, arguments=None):
+        self.declared[queue] = arguments
+
+
+class TestRetryPolicy:
+    def test_delays(self):
+        log = init_test_log("TestRetryPolicy/test_delays")
+        policy = RetryPolicy("download", max_attempts=6, delay=30, max_delay=300)
+        assert [policy.get_delay(a) for a in range(1, 6)] == [30, 60, 120, 240, 300]
+        channel = FakeChannel()
+        policy.declare(channel)
+        assert channel.declared["download.error"] is None
+        assert sorted(channel.declared) == ["download.error", "download.retry.120", "download.retry.240",
+                                            "download.retry.30", "download.retry.300", "download.retry.60"]
+        assert channel.declared["download.retry.60"] == {"x-message-ttl": 60000, "x-dead-letter-exchange": "",
+                                                         "x-dead-letter-routing-key": "download"}
+        log.info("Test passed successfully")
+
+    def test_retry_then_error(self):
+        log = init_test_log("TestRetryPolicy/test_retry_then_error")
+        policy = RetryPolicy("upload", max_attempts=3, delay=10)
+        published = []
+
+        def publish(queue, body, properties, arguments):
+            published.append((queue, body, properties, arguments))
+
+        body = json.dumps({"cog_id": "abc"})
+        properties = None
+        for _ in range(3):
+            policy.retry(publish, body, properties, ValueError("boom"))
+            properties = published[-1][2]
+
+        assert [p[0] for p in published] == ["upload.retry.10", "upload.retry.20", "upload.error"]
+        assert published[0][2].headers[ATTEMPT_HEADER] == 2
+        assert published[1][2].headers[ATTEMPT_HEADER] == 3
+        assert published[0][1] == body
+        error = json.loads(published[2][1])
+        assert error["exception"] == repr(ValueError("boom"))
+        assert error["attempts"] == 3
+        assert published[2][3] is None
+        assert published[0][2].delivery_mode == pika.DeliveryMode.Persistent.value
+        assert policy.report() == {"queue": "upload", "retried": 2, "failed": 1}
+        log.info("Test passed successfully")
+
+    def test_permanent(self):
+        log = init_test_log("TestRetryPolicy/test_permanent")
+        policy = RetryPolicy("upload", max_attempts=3)
+        published = []
+        assert not policy.retry(lambda *args: published.append(args), b"not json", None, ValueError("bad"), True)
+        assert published[0][0] == "upload.error"
+        assert published[0][1] == b"not json"
+        log.info("Test passed successfully")
@@ -1,8 +1,15 @@
 import os
 import json
+import gzip
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from flask import Flask
+import pytest
 
-from cdrhook.server import process_cog
+import cdrhook.server as server
+from cdrhook.server import process_cog, group_event_extractions, write_map_data
+from cmaas_utils.types import CMAAS_Map
 from cdrhook.connector import CdrConnector
 from tests.utilities import init_test_log
 
@@ -38,3 +45,233 @@ class TestCallbacks:
 
         process_cog(self.con, self.cog_id, config_parm=config)
         log.info("Test passed successfully")
+
+    def test_process_cog_concurrent(self):
+        log = init_test_log("TestCallbacks/test_process_cog_concurrent")
+        config = {}
+        config["mode"] = 'test'
+        config["prefix"] = os.getenv("PREFIX")
+        config["callback_url"] = 'http://fakeurl.com'
+        config['systems'] = {'area' : ['uncharted-area'], 'legend' : ['polymer']}
+        with open("cdrhook/models.json", "r") as f:
+            config["models"] = json.load(f)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            config["lookup_executor"] = executor
+            process_cog(self.con, self.cog_id, config_parm=config)
+        log.info("Test passed successfully")
+
+
+class TestEvents:
+    def test_group_event_extractions(self):
+        log = init_test_log("TestEvents/test_group_event_extractions")
+        with open("tests/data/sample_cog_area_extraction.json", "r") as fh:
+            data = json.load(fh)
+        # duplicate extractions are only used once
+        cogs = group_event_extractions(data + data)
+        assert len(cogs) == len({x["cog_id"] for x in data})
+        for cog_id, cog in cogs.items():
+            systems = {f'{x["system"]}__{x["system_version"]}' for x in data if x["cog_id"] == cog_id}
+            assert set(cog["systems"]) == systems
+            for system, areas in cog["areas"].items():
+                expected = [x for x in data if x["cog_id"] == cog_id and f'{x["system"]}__{x["system_version"]}' == system]
+                assert len(areas) == len(expected)
+        log.info("Test passed successfully")
+
+    def test_callback_feature_process(self, monkeypatch):
+        log = init_test_log("TestEvents/test_callback_feature_process")
+        events = []
+        monkeypatch.setattr(server, "process_event", lambda event_id, trace, priority: events.append(event_id))
+        monkeypatch.setitem(server.config, "ingress", None)
+        monkeypatch.setitem(server.config, "cdr_keep_event", False)
+        for event_id in [" uncharted-area_1 ", "polymer_2", "uncharted-area_3"]:
+            server.cdrhook_callback(json.dumps({"event": "feature.process", "payload": {"id": event_id}}))
+        # the same events as the ingress filter lets through
+        assert events == ["uncharted-area_1", "uncharted-area_3"]
+        log.info("Test passed successfully")
+
+    def test_receive_priority(self, monkeypatch):
+        log = init_test_log("TestEvents/test_receive_priority")
+        sent = []
+        monkeypatch.setattr(server, "send_message", lambda message, queue, headers, priority: sent.append(priority))
+        monkeypatch.setitem(server.config, "ingress", server.ingress.IngressFilter(window=60))
+        monkeypatch.setitem(server.config, "spool", None)
+        monkeypatch.setitem(server.config, "prefix", "")
+        message = {"event": "ncsacog", "cog_id": "abc", "parameters": {}}
+        assert server.receive_message(message) == "accepted"
+        assert server.receive_message(message) == "merged"
+        # a manual request for the same cog is queued with its own priority
+        assert server.receive_message(message, priority=server.ingress.PRIORITY_MANUAL) == "accepted"
+        assert sent == [server.ingress.PRIORITY_BULK, server.ingress.PRIORITY_MANUAL]
+        log.info("Test passed successfully")
+
+    def test_retried_message_headers(self, monkeypatch):
+        log = init_test_log("TestEvents/test_retried_message_headers")
+        sent = []
+
+        class Versions:
+            def pretty_str(self):
+                return ""
+
+        class Download:
+            cog_url = "https://example.com/cog.tif"
+
+        monkeypatch.setattr(server, "config", {"ingress": None, "cdr_keep_event": False, "cdr_connector": None,
+                                               "prefix": "", "callback_url": "http://fakeurl.com",
+                                               "systems": {"area": [], "legend": []}, "models": {}})
+        monkeypatch.setattr(server, "lookup_cog_sequential", lambda *args: (Versions(), [], []))
+        monkeypatch.setattr(server, "retrieve_cog_download", lambda *args: Download())
+        monkeypatch.setattr(server.convert, "convert_cdr_area_extraction_to_layout", lambda x: None)
+        monkeypatch.setattr(server.convert, "convert_cdr_legend_items_to_legend", lambda x: None)
+        monkeypatch.setattr(server, "send_message", lambda message, queue, headers, priority: sent.append(headers))
+        with tempfile.TemporaryDirectory() as folder:
+            monkeypatch.setattr(server, "data_folder", folder)
+            # the message failed twice in the cdrhook queue before it succeeded
+            properties = server.pika.BasicProperties(headers={"x-attempt": 3, "x-exception": "ValueError()"})
+            body = json.dumps({"event": "ncsacog", "cog_id": "abcdef", "parameters": {"model": ["golden_muscat"]}})
+            server.cdrhook_callback(body, properties)
+        assert len(sent) == 1
+        assert "x-attempt" not in sent[0] and "x-exception" not in sent[0]
+        assert [stage for stage, _ in server.tracing.get_stages(sent[0])] == ["cdrhook", "download_queued"]
+        log.info("Test passed successfully")
+
+
+class TestNoModels:
+    cog_id = "78c274e9575d1ac948d55a55265546d711551cdd5cdd53592c9928d502d50700"
+
+    def teardown_method(self):
+        server.set_retrieve_cache(None)
+
+    def test_invalidates_cache(self, monkeypatch):
+        log = init_test_log("TestNoModels/test_invalidates_cache")
+        cache = server.RetrieveCache(ttl=600)
+        server.set_retrieve_cache(cache)
+        cache.put(cache.make_key("cog_system_versions", self.cog_id), "versions")
+
+        class Versions:
+            def pretty_str(self):
+                return ""
+
+        # no areas or legends posted yet
+        monkeypatch.setattr(server, "lookup_cog_sequential", lambda *args: (Versions(), [], []))
+        config = {"mode": "test", "prefix": "", "callback_url": "http://fakeurl.com",
+                  "systems": {"area": ["uncharted-area"], "legend": ["polymer"]},
+                  "models": {"golden_muscat": ["map_area", "polygon_legend_area"]}}
+        with pytest.raises(ValueError, match="no models"):
+            process_cog(None, self.cog_id, config_parm=config)
+        # the retry of the message asks the CDR again
+        assert cache.stats()["entries"] == 0
+        log.info("Test passed successfully")
+
+
+class TestDownload:
+    cog_id = "78c274e9575d1ac948d55a55265546d711551cdd5cdd53592c9928d502d50700"
+
+    def setup_method(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.folder.name, f"{self.cog_id}.map_data.json")
+        write_map_data(self.filename, CMAAS_Map(name=self.cog_id, cog_id=self.cog_id))
+        app = Flask(__name__)
+        app.route("/download/<path:filename>", methods=['GET'])(server.download)
+        self.client = app.test_client()
+        self.url = f"/download/{self.cog_id}.map_data.json"
+
+    def teardown_method(self):
+        self.folder.cleanup()
+
+    @pytest.fixture(autouse=True)
+    def data_folder(self, monkeypatch):
+        monkeypatch.setattr(server, "data_folder", self.folder.name)
+        monkeypatch.setitem(server.config, "callback_username", None)
+        monkeypatch.setitem(server.config, "callback_password", None)
+
+    def test_write_map_data(self):
+        log = init_test_log("TestDownload/test_write_map_data")
+        with open(self.filename, "rb") as fh:
+            data = fh.read()
+        with gzip.open(self.filename + ".gz", "rb") as fh:
+            assert fh.read() == data
+        assert json.loads(data)["cog_id"] == self.cog_id
+        # no temporary files are left behind
+        assert sorted(os.listdir(self.folder.name)) == [f"{self.cog_id}.map_data.json", f"{self.cog_id}.map_data.json.gz"]
+        # without compression the old compressed copy is removed, so it is not served
+        write_map_data(self.filename, CMAAS_Map(name="other", cog_id=self.cog_id), compress=False)
+        assert os.listdir(self.folder.name) == [f"{self.cog_id}.map_data.json"]
+        log.info("Test passed successfully")
+
+    def test_gzip(self):
+        log = init_test_log("TestDownload/test_gzip")
+        with open(self.filename, "rb") as fh:
+            data = fh.read()
+        response = self.client.get(self.url, headers={"Accept-Encoding": "gzip"})
+        assert response.status_code == 200
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert "Accept-Encoding" in response.headers["Vary"]
+        assert gzip.decompress(response.data) == data
+        # a client that does not accept gzip gets the json file
+        response = self.client.get(self.url)
+        assert response.status_code == 200
+        assert "Content-Encoding" not in response.headers
+        assert response.data == data
+        log.info("Test passed successfully")
+
+    def test_not_modified(self):
+        log = init_test_log("TestDownload/test_not_modified")
+        for headers in [{}, {"Accept-Encoding": "gzip"}]:
+            response = self.client.get(self.url, headers=headers)
+            etag = response.headers["ETag"]
+            response = self.client.get(self.url, headers={**headers, "If-None-Match": etag})
+            assert response.status_code == 304
+            assert "Content-Encoding" not in response.headers
+            assert response.data == b""
+        # the json and the compressed copy have a different ETag
+        plain = self.client.get(self.url).headers["ETag"]
+        assert self.client.get(self.url, headers={"Accept-Encoding": "gzip"}).headers["ETag"] != plain
+        # a changed file is sent again
+        write_map_data(self.filename, CMAAS_Map(name="other", cog_id=self.cog_id), compress=False)
+        response = self.client.get(self.url, headers={"If-None-Match": plain})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != plain
+        log.info("Test passed successfully")
+
+    def test_range(self):
+        log = init_test_log("TestDownload/test_range")
+        with open(self.filename, "rb") as fh:
+            data = fh.read()
+        response = self.client.get(self.url, headers={"Range": "bytes=10-"})
+        assert response.status_code == 206
+        assert response.data == data[10:]
+        etag = response.headers["ETag"]
+        # If-Range with the current ETag resumes, a different ETag sends the whole file
+        response = self.client.get(self.url, headers={"Range": "bytes=10-", "If-Range": etag})
+        assert response.status_code == 206
+        response = self.client.get(self.url, headers={"Range": "bytes=10-", "If-Range": '"other"'})
+        assert response.status_code == 200
+        assert response.data == data
+        log.info("Test passed successfully")
+
+    def test_missing(self):
+        log = init_test_log("TestDownload/test_missing")
+        assert self.client.get("/download/missing.map_data.json").status_code == 404
+        assert self.client.get("/download/../etc/passwd").status_code == 404
+        log.info("Test passed successfully")
+
+
+class TestCog:
+    def test_cog_bulk(self, monkeypatch):
+        log = init_test_log("TestCog/test_cog_bulk")
+        received = []
+        monkeypatch.setitem(server.config, "callback_username", None)
+        monkeypatch.setitem(server.config, "callback_password", None)
+        monkeypatch.setattr(server, "receive_message", lambda message, headers, priority: received.append(priority))
+        app = Flask(__name__)
+        app.route("/cog/<string:id>", methods=['POST'])(server.cog)
+        client = app.test_client()
+        assert client.post("/cog/abc").status_code == 200
+        assert client.post("/cog/abc?bulk=yes").status_code == 200
+        assert client.post("/cog/abc?bulk").status_code == 200
+        assert received == [server.ingress.PRIORITY_MANUAL, server.ingress.PRIORITY_BULK, server.ingress.PRIORITY_BULK]
+        # an invalid value is an error of the client
+        assert client.post("/cog/abc?bulk=maybe").status_code == 400
+        assert len(received) == 3
+        log.info("Test passed successfully")
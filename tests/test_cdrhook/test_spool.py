@@ -0,0 +1,84 @@
+import os
+import tempfile
+
+import pytest
+
+from cdrhook.spool import Spool
+from tests.utilities import init_test_log
+
+
+class TestSpool:
+    def test_forward(self):
+        log = init_test_log("TestSpool/test_forward")
+        with tempfile.TemporaryDirectory() as directory:
+            spool = Spool(directory, batch_size=2)
+            for i in range(5):
+                spool.append("cdrhook", {"count": i}, {"x-trace-id": str(i)}, priority=i or None)
+            assert spool.depth() == 5
+            assert spool.age() >= 0
+            sent = []
+            while spool.forward(sent.extend, timeout=0):
+                pass
+            assert [r["message"]["count"] for r in sent] == [0, 1, 2, 3, 4]
+            assert sent[0]["headers"] == {"x-trace-id": "0"}
+            assert [r.get("priority") for r in sent] == [None, 1, 2, 3, 4]
+            assert spool.depth() == 0
+            assert spool.forward(sent.extend, timeout=0) == 0
+            spool.close()
+        log.info("Test passed successfully")
+
+    def test_failed_publish(self):
+        log = init_test_log("TestSpool/test_failed_publish")
+        with tempfile.TemporaryDirectory() as directory:
+            spool = Spool(directory)
+            spool.append("cdrhook", {"event": "ping"})
+
+            def fail(records):
+                raise ConnectionError("RabbitMQ is down")
+            with pytest.raises(ConnectionError):
+                spool.forward(fail, timeout=0)
+            assert spool.depth() == 1
+            sent = []
+            assert spool.forward(sent.extend, timeout=0) == 1
+            assert sent[0]["message"] == {"event": "ping"}
+            spool.close()
+        log.info("Test passed successfully")
+
+    def test_restart(self):
+        log = init_test_log("TestSpool/test_restart")
+        with tempfile.TemporaryDirectory() as directory:
+            spool = Spool(directory, batch_size=1)
+            for i in range(3):
+                spool.append("cdrhook", {"count": i})
+            sent = []
+            spool.forward(sent.extend, timeout=0)
+            spool.close()
+            # the cdrhook stopped while writing a message
+            with open(os.path.join(directory, "spool-000000000001.log"), "ab") as fh:
+                fh.write(b'{"time": 1, "queue": "cdrhook", "mess')
+
+            spool = Spool(directory)
+            assert spool.depth() == 2
+            spool.append("cdrhook", {"count": 3})
+            while spool.forward(sent.extend, timeout=0):
+                pass
+            assert [r["message"]["count"] for r in sent] == [0, 1, 2, 3]
+            assert spool.depth() == 0
+            assert not os.path.exists(os.path.join(directory, "spool-000000000001.log"))
+            spool.close()
+        log.info("Test passed successfully")
+
+    def test_segments(self):
+        log = init_test_log("TestSpool/test_segments")
+        with tempfile.TemporaryDirectory() as directory:
+            spool = Spool(directory, segment_bytes=200, batch_size=3)
+            for i in range(10):
+                spool.append("cdrhook", {"count": i})
+            assert len([f for f in os.listdir(directory) if f.endswith(".log")]) > 1
+            sent = []
+            while spool.forward(sent.extend, timeout=0):
+                pass
+            assert [r["message"]["count"] for r in sent] == list(range(10))
+            assert len([f for f in os.listdir(directory) if f.endswith(".log")]) == 1
+            spool.close()
+        log.info("Test passed successfully")
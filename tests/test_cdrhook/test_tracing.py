@@ -0,0 +1,106 @@
+import json
+
+import pika
+
+from cdrhook.retry import ATTEMPT_HEADER, EXCEPTION_HEADER, RetryPolicy
+from cdrhook.tracing import MESSAGE_HEADERS, TRACE_HEADER, TRACE_ID_HEADER, TRACE_QUEUE, TRACE_QUEUE_ARGUMENTS, \
+    add_stage, declare, fork, get_stages, next_stage, properties_with_stage, trace_record
+from tests.utilities import init_test_log
+
+
+class FakeChannel:
+    def __init__(self):
+        self.declared = []
+
+    def queue_declare(self, **kwargs):
+        self.declared.append(kwargs)
+
+
+class TestTracing:
+    def test_add_stage(self):
+        log = init_test_log("TestTracing/test_add_stage")
+        original = {"other": "value"}
+        headers = add_stage(original, "cdrhook", 100.0)
+        assert original == {"other": "value"}
+        trace_id = headers[TRACE_ID_HEADER]
+        assert trace_id
+        headers = add_stage(headers, "download", 105.5)
+        assert headers[TRACE_ID_HEADER] == trace_id
+        assert headers[TRACE_HEADER] == ["cdrhook=100.000", "download=105.500"]
+        assert headers["other"] == "value"
+        assert add_stage(None, "start", 1)[TRACE_HEADER] == ["start=1.000"]
+        log.info("Test passed successfully")
+
+    def test_fork(self):
+        log = init_test_log("TestTracing/test_fork")
+        headers = add_stage({}, "cdrhook", 100.0)
+        forked = add_stage(fork(headers), "process", 101.0)
+        assert forked[TRACE_ID_HEADER] != headers[TRACE_ID_HEADER]
+        assert get_stages(forked) == [("cdrhook", 100.0), ("process", 101.0)]
+        assert TRACE_ID_HEADER in headers
+        log.info("Test passed successfully")
+
+    def test_next_stage(self):
+        log = init_test_log("TestTracing/test_next_stage")
+        assert ATTEMPT_HEADER in MESSAGE_HEADERS and EXCEPTION_HEADER in MESSAGE_HEADERS
+        # the message needed 3 attempts in the cdrhook queue
+        headers = add_stage({ATTEMPT_HEADER: 3, EXCEPTION_HEADER: "error", "x-uploaded-parts": 2}, "cdrhook", 100.0)
+        forwarded = next_stage(headers, "download_queued", 101.0)
+        assert not set(MESSAGE_HEADERS) & set(forwarded)
+        assert forwarded[TRACE_ID_HEADER] == headers[TRACE_ID_HEADER]
+        assert get_stages(forwarded) == [("cdrhook", 100.0), ("download_queued", 101.0)]
+        assert headers[ATTEMPT_HEADER] == 3
+        # the first failure in the next queue is retried
+        policy = RetryPolicy("download", max_attempts=3)
+        assert policy.route(pika.BasicProperties(headers=add_stage(headers, "x")), Exception())[0] == "download.error"
+        assert policy.route(pika.BasicProperties(headers=forwarded), Exception())[0] != "download.error"
+        assert not set(MESSAGE_HEADERS) & set(fork(headers))
+        log.info("Test passed successfully")
+
+    def test_get_stages(self):
+        log = init_test_log("TestTracing/test_get_stages")
+        # headers read back from RabbitMQ can be bytes, stage names can contain =
+        headers = {TRACE_HEADER: [b"cdrhook=100.000", "a=b=101.5", "invalid", "bad=time"]}
+        assert get_stages(headers) == [("cdrhook", 100.0), ("a=b", 101.5)]
+        assert get_stages(None) == []
+        assert get_stages({TRACE_HEADER: None}) == []
+        log.info("Test passed successfully")
+
+    def test_properties_with_stage(self):
+        log = init_test_log("TestTracing/test_properties_with_stage")
+        properties = pika.BasicProperties(content_type="application/json", priority=7, correlation_id="abc",
+                                          headers={"x-retry": 2})
+        result = properties_with_stage(properties, "download")
+        assert result.priority == 7
+        assert result.content_type == "application/json"
+        assert result.correlation_id == "abc"
+        assert result.delivery_mode == pika.DeliveryMode.Persistent.value
+        assert result.headers["x-retry"] == 2
+        assert [stage for stage, _ in get_stages(result.headers)] == ["download"]
+        assert properties.headers == {"x-retry": 2}
+        # a retry in the same queue keeps the attempts, the next queue starts over
+        properties = pika.BasicProperties(priority=7, headers={ATTEMPT_HEADER: 2})
+        assert properties_with_stage(properties, "download").headers[ATTEMPT_HEADER] == 2
+        result = properties_with_stage(properties, "process_queued", next_queue=True)
+        assert ATTEMPT_HEADER not in result.headers
+        assert result.priority == 7
+        log.info("Test passed successfully")
+
+    def test_trace_record(self):
+        log = init_test_log("TestTracing/test_trace_record")
+        headers = {TRACE_ID_HEADER: b"1234", TRACE_HEADER: ["cdrhook=100.000", "download=102.000"]}
+        record = json.loads(trace_record(headers, "cog"))
+        assert record == {"trace_id": "1234", "cog_id": "cog", "stages": [["cdrhook", 100.0], ["download", 102.0]]}
+        assert json.loads(trace_record(None, "cog")) == {"trace_id": None, "cog_id": "cog", "stages": []}
+        log.info("Test passed successfully")
+
+    def test_declare(self):
+        log = init_test_log("TestTracing/test_declare")
+        channel = FakeChannel()
+        declare(channel)
+        declare(channel, "prefix-" + TRACE_QUEUE)
+        assert channel.declared == [
+            {"queue": TRACE_QUEUE, "durable": True, "arguments": TRACE_QUEUE_ARGUMENTS},
+            {"queue": "prefix-" + TRACE_QUEUE, "durable": True, "arguments": TRACE_QUEUE_ARGUMENTS},
+        ]
+        log.info("Test passed successfully")
@@ -0,0 +1,87 @@
+import json
+import os
+import tempfile
+import time
+
+from downloader.cog_cache import CogCache, sha256sum
+from tests.utilities import init_test_log
+
+
+def write_cog(data_dir, cog_id, size):
+    folder = os.path.join(data_dir, cog_id[0:2], cog_id[2:4], cog_id)
+    os.makedirs(folder, exist_ok=True)
+    filename = os.path.join(folder, f"{cog_id}.cog.tif")
+    with open(filename, "wb") as fh:
+        fh.write(os.urandom(size))
+    with open(os.path.join(folder, f"{cog_id}.map_data.json"), "w") as fh:
+        fh.write("{}")
+    return filename
+
+
+class TestCogCache:
+    def test_lookup(self):
+        log = init_test_log("TestCogCache/test_lookup")
+        with tempfile.TemporaryDirectory() as data_dir:
+            cache = CogCache(data_dir, verify=True)
+            filename = write_cog(data_dir, "aabbcc", 100)
+            assert not cache.lookup("aabbcc", filename + ".missing")
+            cache.add("aabbcc", filename, sha256sum(filename))
+            assert cache.lookup("aabbcc", filename)
+            # a file that does not match the index is removed and downloaded again
+            with open(filename, "ab") as fh:
+                fh.write(b"x")
+            assert not cache.lookup("aabbcc", filename)
+            assert not os.path.exists(filename)
+            assert cache.report()["hits"] == 1
+            assert cache.report()["misses"] == 2
+        log.info("Test passed successfully")
+
+    def test_save(self):
+        log = init_test_log("TestCogCache/test_save")
+        with tempfile.TemporaryDirectory() as data_dir:
+            cache = CogCache(data_dir, save_interval=3600)
+            filename = write_cog(data_dir, "aabbcc", 100)
+            # the index is written when the cache is created, changes wait for the interval
+            cache.add("aabbcc", filename)
+            mtime = os.stat(cache.index_file).st_mtime_ns
+            time.sleep(0.01)
+            assert cache.lookup("aabbcc", filename)
+            cache.add("ddeeff", write_cog(data_dir, "ddeeff", 50))
+            assert os.stat(cache.index_file).st_mtime_ns == mtime
+            assert not cache.save()
+            assert cache.save(force=True)
+            with open(cache.index_file) as fh:
+                assert sorted(json.load(fh)) == ["aabbcc", "ddeeff"]
+            # nothing changed, nothing to write
+            assert not cache.save(force=True)
+            # a new cache reads the index
+            assert CogCache(data_dir).report()["cogs"] == 2
+        log.info("Test passed successfully")
+
+    def test_evict(self):
+        log = init_test_log("TestCogCache/test_evict")
+        with tempfile.TemporaryDirectory() as data_dir:
+            cache = CogCache(data_dir, max_bytes=250, low_water=0.8, pin_seconds=3600, save_interval=3600)
+            files = {cog_id: write_cog(data_dir, cog_id, 100) for cog_id in ["aa0001", "aa0002", "aa0003"]}
+            for cog_id, filename in files.items():
+                cache.add(cog_id, filename)
+            # everything is pinned
+            assert cache.evict() == 0
+            assert cache.total_bytes == 300
+            # unpin the two oldest, the least recently used is removed first
+            with cache._lock:
+                cache._entries["aa0001"].update({"pinned_until": 0, "last_access": 1})
+                cache._entries["aa0002"].update({"pinned_until": 0, "last_access": 2})
+            assert cache.evict() == 100
+            assert not os.path.exists(files["aa0001"])
+            assert os.path.exists(files["aa0002"])
+            # the map data is kept
+            assert os.path.exists(os.path.join(os.path.dirname(files["aa0001"]), "aa0001.map_data.json"))
+            with open(cache.index_file) as fh:
+                assert sorted(json.load(fh)) == ["aa0002", "aa0003"]
+            assert cache.report()["evicted"] == 1
+            # pinning a cog again protects it
+            cache.pin("aa0002")
+            cache.max_bytes = 100
+            assert cache.evict() == 0
+        log.info("Test passed successfully")
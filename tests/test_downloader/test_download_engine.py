@@ -0,0 +1,238 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from downloader.download_engine import ByteBudget, DownloadEngine, DownloadError
+from tests.utilities import init_test_log
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    """
+    Serves the files of the server, with Content-Length, an md5 ETag and
+    Range/If-Range support and a 304 for If-None-Match or If-Modified-Since.
+    The first request for a path in truncate is cut off halfway.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, dict(self.headers)))
+        if self.path not in server.files:
+            self.send_error(404)
+            return
+        data = server.files[self.path]
+        etag = server.etags.get(self.path, '"' + hashlib.md5(data).hexdigest() + '"')
+        last_modified = server.modified.get(self.path, "Mon, 13 Jan 2025 10:00:00 GMT")
+        if self.headers.get("If-None-Match", etag) == etag and \
+                (self.headers.get("If-None-Match") or self.headers.get("If-Modified-Since") == last_modified):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        start = 0
+        if self.headers.get("Range") and self.headers.get("If-Range", etag) == etag:
+            start = int(self.headers["Range"].split("=")[1].split("-")[0])
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.send_header("Last-Modified", last_modified)
+        self.end_headers()
+        if server.delay:
+            # send the file slowly, so downloads overlap
+            for i in range(start, len(data), 10000):
+                self.wfile.write(data[i:i + 10000])
+                self.wfile.flush()
+                time.sleep(server.delay)
+            return
+        if self.path in server.truncate:
+            server.truncate.remove(self.path)
+            self.wfile.write(data[start:start + (len(data) - start) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(data[start:])
+
+
+class TestDownloadEngine:
+    def setup_method(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FileHandler)
+        self.server.files = {}
+        self.server.etags = {}
+        self.server.modified = {}
+        self.server.truncate = set()
+        self.server.requests = []
+        self.server.delay = 0
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.engine = DownloadEngine(chunk_size=1024, retries=2, timeout=5)
+
+    def teardown_method(self):
+        self.engine.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmpdir.cleanup()
+
+    def test_download(self):
+        log = init_test_log("TestDownloadEngine/test_download")
+        data = os.urandom(100000)
+        self.server.files["/cog.tif"] = data
+        filename = os.path.join(self.tmpdir.name, "ab", "cog.tif")
+        result = self.engine.download(f"{self.url}/cog.tif", filename)
+        with open(filename, "rb") as fh:
+            assert fh.read() == data
+        assert not os.path.exists(f"{filename}.part")
+        assert result.size == len(data)
+        assert result.attempts == 1 and result.resumed == 0
+        assert result.checksum == hashlib.sha256(data).hexdigest()
+        assert self.engine.total_bytes == len(data)
+        log.info("Test passed successfully")
+
+    def test_resume(self):
+        log = init_test_log("TestDownloadEngine/test_resume")
+        data = os.urandom(100000)
+        self.server.files["/cog.tif"] = data
+        self.server.truncate.add("/cog.tif")
+        filename = os.path.join(self.tmpdir.name, "cog.tif")
+        result = self.engine.download(f"{self.url}/cog.tif", filename)
+        with open(filename, "rb") as fh:
+            assert fh.read() == data
+        assert result.attempts == 2 and result.resumed == 1
+        headers = self.server.requests[1][1]
+        assert headers["Range"].startswith("bytes=") and headers["Range"] != "bytes=0-"
+        assert headers["If-Range"] == '"' + hashlib.md5(data).hexdigest() + '"'
+        log.info("Test passed successfully")
+
+    def test_same_file(self):
+        log = init_test_log("TestDownloadEngine/test_same_file")
+        data = os.urandom(100000)
+        self.server.files["/cog.tif"] = data
+        self.server.delay = 0.02
+        filename = os.path.join(self.tmpdir.name, "cog.tif")
+        results = self.engine.download_many([(f"{self.url}/cog.tif", filename), (f"{self.url}/cog.tif", filename)])
+        assert [r.size for r in results] == [len(data), len(data)]
+        assert [r.attempts for r in results] == [1, 1]
+        with open(filename, "rb") as fh:
+            assert fh.read() == data
+        assert os.listdir(self.tmpdir.name) == ["cog.tif"]
+        assert self.engine._file_locks == {}
+        log.info("Test passed successfully")
+
+    def test_checksum_mismatch(self):
+        log = init_test_log("TestDownloadEngine/test_checksum_mismatch")
+        self.server.files["/cog.tif"] = b"content"
+        self.server.etags["/cog.tif"] = '"' + hashlib.md5(b"other").hexdigest() + '"'
+        filename = os.path.join(self.tmpdir.name, "cog.tif")
+        with pytest.raises(DownloadError, match="Checksum mismatch"):
+            self.engine.download(f"{self.url}/cog.tif", filename)
+        assert not os.path.exists(filename)
+        assert not os.path.exists(f"{filename}.part")
+        # an ETag that is not an md5 is not checked
+        self.server.etags["/cog.tif"] = '"abc-2"'
+        assert self.engine.download(f"{self.url}/cog.tif", filename).size == 7
+        log.info("Test passed successfully")
+
+    def test_not_modified(self):
+        log = init_test_log("TestDownloadEngine/test_not_modified")
+        data = os.urandom(10000)
+        self.server.files["/map_data.json"] = data
+        filename = os.path.join(self.tmpdir.name, "map_data.json")
+        url = f"{self.url}/map_data.json"
+        # nothing to revalidate yet
+        result = self.engine.download(url, filename, revalidate=True)
+        assert not result.not_modified
+        assert "If-None-Match" not in self.server.requests[-1][1]
+        # the file has the time of the server
+        assert os.path.getmtime(filename) == 1736762400
+
+        result = self.engine.download(url, filename, revalidate=True)
+        assert result.not_modified
+        assert result.size == len(data)
+        assert self.engine.not_modified == 1
+        headers = self.server.requests[-1][1]
+        assert headers["If-None-Match"] == '"' + hashlib.md5(data).hexdigest() + '"'
+        assert headers["If-Modified-Since"] == "Mon, 13 Jan 2025 10:00:00 GMT"
+
+        # after a restart the ETag is not known, the modification time is still used
+        engine = DownloadEngine(chunk_size=1024, retries=2, timeout=5)
+        try:
+            assert engine.download(url, filename, revalidate=True).not_modified
+            assert "If-None-Match" not in self.server.requests[-1][1]
+            # a changed file is downloaded again
+            self.server.files["/map_data.json"] = data[::-1]
+            self.server.modified["/map_data.json"] = "Tue, 14 Jan 2025 10:00:00 GMT"
+            result = engine.download(url, filename, revalidate=True)
+            assert not result.not_modified
+            with open(filename, "rb") as fh:
+                assert fh.read() == data[::-1]
+        finally:
+            engine.close()
+        # without revalidate the file is always downloaded
+        assert not self.engine.download(url, filename).not_modified
+        assert "If-Modified-Since" not in self.server.requests[-1][1]
+        log.info("Test passed successfully")
+
+    def test_client_error(self):
+        log = init_test_log("TestDownloadEngine/test_client_error")
+        with pytest.raises(DownloadError):
+            self.engine.download(f"{self.url}/missing.tif", os.path.join(self.tmpdir.name, "missing.tif"))
+        # a 4xx is not retried
+        assert len(self.server.requests) == 1
+        log.info("Test passed successfully")
+
+    def test_expected_size(self):
+        log = init_test_log("TestDownloadEngine/test_expected_size")
+
+        class Response:
+            def __init__(self, headers):
+                self.headers = headers
+
+        assert DownloadEngine._expected_size(Response({"Content-Length": "10"}), 0, None) == 10
+        assert DownloadEngine._expected_size(Response({"Content-Length": "10"}), 5, None) == 15
+        assert DownloadEngine._expected_size(Response({"Content-Range": "bytes 5-14/15"}), 5, None) == 15
+        assert DownloadEngine._expected_size(Response({"Content-Length": "10", "Content-Encoding": "gzip"}), 0, None) is None
+        log.info("Test passed successfully")
+
+
+class TestByteBudget:
+    def test_limit(self):
+        log = init_test_log("TestByteBudget/test_limit")
+        budget = ByteBudget(100)
+        budget.acquire(60)
+        acquired = threading.Event()
+
+        def second():
+            budget.acquire(60)
+            acquired.set()
+
+        thread = threading.Thread(target=second)
+        thread.start()
+        time.sleep(0.1)
+        assert not acquired.is_set()
+        budget.release(60)
+        assert acquired.wait(5)
+        assert budget.inflight == 60
+        budget.release(60)
+        thread.join()
+        # a download larger than the budget is allowed when nothing else is in flight
+        budget.acquire(500)
+        assert budget.inflight == 500
+        budget.release(500)
+        # 0 disables the budget
+        unlimited = ByteBudget(0)
+        unlimited.acquire(1000)
+        assert unlimited.inflight == 0
+        log.info("Test passed successfully")
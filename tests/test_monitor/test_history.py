@@ -0,0 +1,98 @@
+import math
+
+from monitor.history import QueueHistory, RingBuffer
+from tests.utilities import init_test_log
+
+
+def queue(name, messages, publish, ack, unack=0):
+    return {"name": name, "messages": messages, "messages_unacknowledged": unack,
+            "message_stats": {"publish": publish, "ack": ack}}
+
+
+class TestRingBuffer:
+    def test_samples(self):
+        log = init_test_log("TestRingBuffer/test_samples")
+        buffer = RingBuffer(5)
+        assert buffer.last() is None
+        assert buffer.samples() == []
+        for i in range(3):
+            buffer.append({"time": 10 + i, "messages": i})
+        assert [s["time"] for s in buffer.samples()] == [10, 11, 12]
+        assert buffer.last()["messages"] == 2
+        # fields that are not given are nan
+        assert math.isnan(buffer.last()["publish"])
+        log.info("Test passed successfully")
+
+    def test_wrap(self):
+        log = init_test_log("TestRingBuffer/test_wrap")
+        buffer = RingBuffer(5)
+        for i in range(12):
+            buffer.append({"time": 100 + i, "messages": i})
+        assert buffer.count == 5
+        assert [s["messages"] for s in buffer.samples()] == [7, 8, 9, 10, 11]
+        # the start of the samples can be on either side of the wrap
+        for since in range(100, 114):
+            expected = [t for t in range(107, 112) if t >= since]
+            assert [s["time"] for s in buffer.samples(since)] == expected
+        assert [s["time"] for s in buffer.samples(108.5)] == [109, 110, 111]
+        log.info("Test passed successfully")
+
+
+class TestQueueHistory:
+    def test_rates(self):
+        log = init_test_log("TestQueueHistory/test_rates")
+        history = QueueHistory(retention=3600, interval=10, window=60)
+        # 100 messages in, 200 out in 100 seconds, 100 messages left
+        for i in range(11):
+            history.record(1000 + 10 * i, [queue("download", 200 - 10 * i, 10 * i, 20 * i)])
+        rates = history.rates("download")
+        assert rates["messages"] == 100
+        # only the last window is used
+        assert rates["publish_rate"] == 1
+        assert rates["ack_rate"] == 2
+        assert rates["eta_seconds"] == 100
+        assert history.rates("unknown") is None
+        assert history.summary() == [rates]
+        log.info("Test passed successfully")
+
+    def test_rates_not_draining(self):
+        log = init_test_log("TestQueueHistory/test_rates_not_draining")
+        history = QueueHistory(retention=3600, interval=10, window=60)
+        history.record(1000, [queue("a", 10, 100, 100), queue("b", 0, 0, 0)])
+        # a single sample has no rates
+        assert history.rates("a")["publish_rate"] is None
+        # RabbitMQ restarted, the counters went back
+        history.record(1010, [queue("a", 20, 10, 0), queue("b", 0, 0, 0)])
+        rates = history.rates("a")
+        assert rates["publish_rate"] == 0 and rates["ack_rate"] == 0
+        assert rates["eta_seconds"] is None
+        assert history.rates("b")["eta_seconds"] == 0
+        log.info("Test passed successfully")
+
+    def test_retention(self):
+        log = init_test_log("TestQueueHistory/test_retention")
+        history = QueueHistory(retention=100, interval=10)
+        history.record(1000, [queue("old", 1, 0, 0)])
+        history.record(1050, [queue("new", 1, 0, 0)])
+        assert sorted(history.queues) == ["new", "old"]
+        history.record(1200, [queue("new", 1, 0, 0)])
+        assert list(history.queues) == ["new"]
+        # the samples older than the retention are overwritten
+        assert history.queues["new"].capacity == 11
+        log.info("Test passed successfully")
+
+    def test_series(self):
+        log = init_test_log("TestQueueHistory/test_series")
+        history = QueueHistory(retention=3600, interval=10)
+        for i in range(61):
+            history.record(1000 + 10 * i, [queue("download", i, 10 * i, 5 * i, unack=2)])
+        series = history.series("download", seconds=600, points=10)
+        assert series["queue"] == "download"
+        points = series["points"]
+        assert len(points) == 10
+        assert points[-1]["time"] == 1600
+        assert points[-1]["messages"] == (55 + 56 + 57 + 58 + 59 + 60) / 6
+        assert all(p["unack"] == 2 and p["publish_rate"] == 1 and p["ack_rate"] == 0.5 for p in points)
+        assert len(history.series("download", seconds=100, points=360)["points"]) == 10
+        assert history.series("unknown") is None
+        log.info("Test passed successfully")
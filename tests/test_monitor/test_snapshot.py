@@ -0,0 +1,97 @@
+import json
+
+from monitor.history import QueueHistory
+from monitor.snapshot import QueueSnapshot, aggregate_queues
+from tests.utilities import init_test_log
+
+
+def queue(name, messages=0, consumers=1, unack=0):
+    return {"name": name, "consumers": consumers, "messages": messages, "messages_unacknowledged": unack}
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        if isinstance(self.data, Exception):
+            raise self.data
+
+    def json(self):
+        return self.data
+
+
+class FakeSession:
+    def __init__(self):
+        self.data = []
+        self.requests = 0
+
+    def get(self, url, **kwargs):
+        self.requests += 1
+        return FakeResponse(self.data)
+
+
+class TestAggregateQueues:
+    def test_aggregate(self):
+        log = init_test_log("TestAggregateQueues/test_aggregate")
+        items = [
+            queue("download", messages=10, consumers=2, unack=3),
+            queue("download.error", messages=4, consumers=0),
+            queue("download.retry.60", messages=2, consumers=0),
+            queue("download.retry.600", messages=1, consumers=0),
+            queue("upload.unknown", messages=5, consumers=0),
+        ]
+        result = {q["queue"]: q for q in aggregate_queues(items)}
+        assert result["download"] == {"queue": "download", "consumers": 2, "messages": "10 / 3", "total": 10,
+                                      "unack": 3, "unknown": 0, "errors": 4, "retry": 3}
+        # only the .unknown queue exists
+        assert result["upload"]["unknown"] == 5
+        assert result["upload"]["messages"] is None
+        log.info("Test passed successfully")
+
+    def test_search(self):
+        log = init_test_log("TestAggregateQueues/test_search")
+        items = [queue("download"), queue("download.error"), queue("upload"), queue("upload.download")]
+        assert [q["queue"] for q in aggregate_queues(items, "down")] == ["download"]
+        assert [q["queue"] for q in aggregate_queues(items, "")] == ["download", "upload", "upload.download"]
+        log.info("Test passed successfully")
+
+
+class TestQueueSnapshot:
+    def test_get(self):
+        log = init_test_log("TestQueueSnapshot/test_get")
+        snapshot = QueueSnapshot("http://rabbitmq:15672", "guest", "guest")
+        snapshot.session = FakeSession()
+        snapshot.session.data = [queue("download", messages=1)]
+        assert snapshot.refresh()
+        body, etag = snapshot.get()
+        assert json.loads(body)[0]["total"] == 1
+        # the same snapshot gives the same response, without asking RabbitMQ
+        assert snapshot.get() == (body, etag)
+        assert snapshot.session.requests == 1
+        # a changed snapshot gives a new ETag
+        snapshot.session.data = [queue("download", messages=2)]
+        snapshot.refresh()
+        body2, etag2 = snapshot.get()
+        assert json.loads(body2)[0]["total"] == 2
+        assert etag2 != etag
+        # the same content gives the same ETag
+        snapshot.session.data = [queue("download", messages=1)]
+        snapshot.refresh()
+        assert snapshot.get() == (body, etag)
+        log.info("Test passed successfully")
+
+    def test_refresh_error(self):
+        log = init_test_log("TestQueueSnapshot/test_refresh_error")
+        history = QueueHistory(retention=3600, interval=5)
+        snapshot = QueueSnapshot("http://rabbitmq:15672", "guest", "guest", history=history)
+        snapshot.session = FakeSession()
+        snapshot.session.data = [queue("download", messages=1)]
+        assert snapshot.refresh()
+        assert list(history.queues) == ["download"]
+        # the previous snapshot is kept when RabbitMQ does not answer
+        snapshot.session.data = ValueError("connection refused")
+        assert not snapshot.refresh()
+        assert json.loads(snapshot.get()[0])[0]["total"] == 1
+        assert history.queues["download"].count == 1
+        log.info("Test passed successfully")
@@ -0,0 +1,70 @@
+from monitor.traces import TraceCollector, percentile
+from tests.utilities import init_test_log
+
+
+def record(trace_id, cog_id, *stages):
+    return {"trace_id": trace_id, "cog_id": cog_id, "stages": [list(stage) for stage in stages]}
+
+
+class TestTraceCollector:
+    def test_percentile(self):
+        log = init_test_log("TestTraceCollector/test_percentile")
+        values = list(range(1, 101))
+        assert percentile([], 0.5) is None
+        assert percentile(values, 0.5) == 50
+        assert percentile(values, 0.9) == 90
+        assert percentile(values, 0.99) == 99
+        assert percentile([5, 1, 3], 1.0) == 5
+        assert percentile([5, 1, 3], 0) == 1
+        log.info("Test passed successfully")
+
+    def test_merge(self):
+        log = init_test_log("TestTraceCollector/test_merge")
+        collector = TraceCollector()
+        collector.add(record("t1", "cog1", ("cdrhook", 100), ("download", 110)))
+        collector.add(record("t1", "cog1", ("download", 110), ("upload", 130)))
+        # the uploader lost the trace id, the record goes to the last trace of the cog
+        collector.add(record(None, "cog1", ("cdr", 135)))
+        assert list(collector.traces) == ["t1"]
+        assert collector.traces["t1"]["stages"] == {"cdrhook": 100, "download": 110, "upload": 130, "cdr": 135}
+        assert collector.received == 3
+        # a retry keeps the last time of the stage
+        collector.add(record("t1", "cog1", ("upload", 140)))
+        assert collector.traces["t1"]["stages"]["upload"] == 140
+        log.info("Test passed successfully")
+
+    def test_max_traces(self):
+        log = init_test_log("TestTraceCollector/test_max_traces")
+        collector = TraceCollector(max_traces=2)
+        collector.add(record("t1", "cog1", ("cdrhook", 1)))
+        collector.add(record("t2", "cog2", ("cdrhook", 2)))
+        # updating t1 makes it the most recent, so t2 is dropped
+        collector.add(record("t1", "cog1", ("download", 3)))
+        collector.add(record("t3", "cog3", ("cdrhook", 4)))
+        assert list(collector.traces) == ["t1", "t3"]
+        assert collector.cogs == {"cog1": "t1", "cog3": "t3"}
+        # a record without trace id for a dropped cog starts a new trace
+        collector.add(record(None, "cog2", ("upload", 5)))
+        assert list(collector.traces) == ["t3", None]
+        log.info("Test passed successfully")
+
+    def test_summary(self):
+        log = init_test_log("TestTraceCollector/test_summary")
+        collector = TraceCollector()
+        for i in range(10):
+            collector.add(record(f"t{i}", f"cog{i}", ("cdrhook", 100), ("download", 101 + i), ("upload", 200 + i)))
+        collector.add(record("single", "cog", ("cdrhook", 100)))
+        summary = collector.summary(slowest=3)
+        assert summary["received"] == 11
+        assert summary["traces"] == 11
+        stages = {s["stage"]: s for s in summary["stages"]}
+        assert list(stages) == ["download -> upload", "cdrhook -> download"]
+        assert stages["cdrhook -> download"]["count"] == 10
+        assert stages["cdrhook -> download"]["p50"] == 5
+        assert stages["cdrhook -> download"]["p90"] == 9
+        assert stages["cdrhook -> download"]["max"] == 10
+        assert stages["download -> upload"]["p50"] == 99
+        assert [t["trace_id"] for t in summary["slowest"]] == ["t9", "t8", "t7"]
+        assert summary["slowest"][0]["seconds"] == 109
+        assert summary["slowest"][0]["stages"] == {"cdrhook": 0, "download": 10, "upload": 109}
+        log.info("Test passed successfully")
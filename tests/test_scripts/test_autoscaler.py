@@ -0,0 +1,104 @@
+from scripts.autoscaler import Autoscaler, Model
+from tests.utilities import init_test_log
+
+
+class FakeScheduler:
+    def __init__(self):
+        self.running = {}
+        self.pending = {}
+        self.submitted = []
+        self.calls = 0
+
+    def jobs(self):
+        self.calls += 1
+        names = set(self.running) | set(self.pending)
+        return {n: {"running": self.running.get(n, 0), "pending": self.pending.get(n, 0)} for n in names}
+
+    def submit(self, name, script):
+        self.submitted.append(name)
+        self.pending[name] = self.pending.get(name, 0) + 1
+        return f"Submitted batch job {len(self.submitted)}"
+
+
+class FakeStats:
+    def __init__(self):
+        self.queues = {}
+
+    def get(self):
+        return self.queues
+
+
+class TestAutoscaler:
+    def test_backlog(self):
+        log = init_test_log("TestAutoscaler/test_backlog")
+        scheduler = FakeScheduler()
+        stats = FakeStats()
+        models = [Model("golden_muscat", "gm.bash", max_jobs=5), Model("icy_resin", "ir.bash", max_jobs=5)]
+        autoscaler = Autoscaler(scheduler, stats, models, cooldown=0, max_launch=10)
+
+        stats.queues = {"process_golden_muscat": {"total": 25, "ack_rate": None}}
+        status = autoscaler.cycle(now=1000)
+        assert scheduler.calls == 1
+        assert scheduler.submitted == ["golden_muscat"] * 3
+        assert [s["target"] for s in status] == [3, 0]
+
+        # pending jobs count, nothing new is submitted
+        autoscaler.cycle(now=1060)
+        assert len(scheduler.submitted) == 3
+
+        # never more than max_jobs
+        stats.queues["process_icy_resin"] = {"total": 1000, "ack_rate": None}
+        autoscaler.cycle(now=1120)
+        assert scheduler.submitted.count("icy_resin") == 5
+        log.info("Test passed successfully")
+
+    def test_throughput(self):
+        log = init_test_log("TestAutoscaler/test_throughput")
+        scheduler = FakeScheduler()
+        stats = FakeStats()
+        model = Model("golden_muscat", "gm.bash", max_jobs=10)
+        autoscaler = Autoscaler(scheduler, stats, [model], target_seconds=1000, cooldown=0, smoothing=1)
+
+        # 2 jobs process 0.1 messages/sec (0.05 each), 400 messages need 8 jobs to finish in 1000 seconds
+        scheduler.running["golden_muscat"] = 2
+        stats.queues = {"process_golden_muscat": {"total": 400, "ack_rate": 0.1}}
+        status = autoscaler.cycle(now=1000)
+        assert model.job_rate == 0.05
+        assert status[0]["target"] == 8
+        assert status[0]["launched"] == 2
+        log.info("Test passed successfully")
+
+    def test_hysteresis(self):
+        log = init_test_log("TestAutoscaler/test_hysteresis")
+        scheduler = FakeScheduler()
+        stats = FakeStats()
+        model = Model("golden_muscat", "gm.bash", max_jobs=5)
+        autoscaler = Autoscaler(scheduler, stats, [model], hysteresis=1, cooldown=100, max_launch=10)
+
+        stats.queues = {"process_golden_muscat": {"total": 40, "ack_rate": None}}
+        autoscaler.cycle(now=1000)
+        assert model.target == 4
+        assert len(scheduler.submitted) == 4
+
+        # a small drop keeps the target, a large drop lowers it
+        stats.queues["process_golden_muscat"]["total"] = 30
+        autoscaler.cycle(now=1010)
+        assert model.target == 4
+        stats.queues["process_golden_muscat"]["total"] = 20
+        autoscaler.cycle(now=1020)
+        assert model.target == 2
+
+        # jobs finished, but the cooldown delays new jobs
+        scheduler.pending = {}
+        autoscaler.cycle(now=1050)
+        assert len(scheduler.submitted) == 4
+        autoscaler.cycle(now=1101)
+        assert len(scheduler.submitted) == 6
+
+        # an empty queue needs no jobs
+        scheduler.pending = {}
+        stats.queues["process_golden_muscat"]["total"] = 0
+        autoscaler.cycle(now=1300)
+        assert model.target == 0
+        assert len(scheduler.submitted) == 6
+        log.info("Test passed successfully")
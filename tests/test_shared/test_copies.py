@@ -0,0 +1,42 @@
+import os
+
+from tests.utilities import init_test_log
+
+SERVICES = ["cdrhook", "downloader", "uploader"]
+
+
+def read(*path):
+    with open(os.path.join(*path), "r") as fh:
+        return fh.read()
+
+
+class TestCopies:
+    def test_tracing(self):
+        log = init_test_log("TestCopies/test_tracing")
+        for service in SERVICES[1:]:
+            assert read(service, "tracing.py") == read("cdrhook", "tracing.py"), f"{service}/tracing.py differs"
+        log.info("Test passed successfully")
+
+    def test_retry(self):
+        log = init_test_log("TestCopies/test_retry")
+        for service in SERVICES[1:]:
+            assert read(service, "retry.py") == read("cdrhook", "retry.py"), f"{service}/retry.py differs"
+        log.info("Test passed successfully")
+
+    def test_metrics(self):
+        log = init_test_log("TestCopies/test_metrics")
+        # the metrics are different, the helpers after them are shared
+        downloader = read("downloader", "metrics.py")
+        uploader = read("uploader", "metrics.py")
+        start = "_metrics_file = "
+        assert downloader[downloader.index(start):] == uploader[uploader.index(start):]
+        assert downloader.split("\n\n")[0] == uploader.split("\n\n")[0]
+        log.info("Test passed successfully")
+
+    def test_monitor_trace_queue(self):
+        log = init_test_log("TestCopies/test_monitor_trace_queue")
+        import cdrhook.tracing as tracing
+        import monitor.traces as traces
+        assert traces.TRACE_QUEUE == tracing.TRACE_QUEUE
+        assert traces.TRACE_QUEUE_ARGUMENTS == tracing.TRACE_QUEUE_ARGUMENTS
+        log.info("Test passed successfully")
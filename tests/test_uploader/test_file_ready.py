@@ -0,0 +1,98 @@
+import os
+import tempfile
+import threading
+import time
+
+import pytest
+
+from uploader.file_ready import FileWaiter
+from tests.utilities import init_test_log
+
+
+class CountingWaiter(FileWaiter):
+    checks = 0
+
+    def _is_ready(self, filename, state):
+        self.checks += 1
+        return super()._is_ready(filename, state)
+
+
+def later(seconds, action):
+    thread = threading.Timer(seconds, action)
+    thread.start()
+    return thread
+
+
+def write(filename, data=b"x" * 100, mode="ab"):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, mode) as fh:
+        fh.write(data)
+
+
+class TestFileWaiter:
+    @pytest.mark.parametrize("use_inotify", [True, False])
+    def test_stable_size(self, use_inotify):
+        log = init_test_log("TestFileWaiter/test_stable_size")
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "sub", "result.json")
+            waiter = FileWaiter(deadline=10, stable_seconds=0.3, max_interval=0.2, use_inotify=use_inotify)
+            # the file shows up in a new folder and keeps growing for a while
+            timers = [later(0.2 + 0.1 * i, lambda: write(filename)) for i in range(4)]
+            seconds = waiter.wait(filename)
+            for timer in timers:
+                timer.join()
+            assert seconds >= 0.8
+            assert os.path.getsize(filename) == 400
+            assert waiter.report()["ready"] == 1
+        log.info("Test passed successfully")
+
+    def test_marker(self):
+        log = init_test_log("TestFileWaiter/test_marker")
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "result.json")
+            write(filename)
+            os.utime(filename, (time.time() - 60, time.time() - 60))
+            waiter = FileWaiter(deadline=10, stable_seconds=0.1, marker=".done", max_interval=5)
+            timer = later(0.3, lambda: write(filename + ".done", b""))
+            seconds = waiter.wait(filename)
+            timer.join()
+            # inotify wakes up for the marker, long before the next poll
+            assert 0.3 <= seconds < 2
+        log.info("Test passed successfully")
+
+    def test_deadline(self):
+        log = init_test_log("TestFileWaiter/test_deadline")
+        with tempfile.TemporaryDirectory() as directory:
+            waiter = FileWaiter(deadline=0.3, max_interval=0.1)
+            start = time.monotonic()
+            with pytest.raises(ValueError):
+                waiter.wait(os.path.join(directory, "missing.json"))
+            assert 0.3 <= time.monotonic() - start < 2
+            assert waiter.report()["timeouts"] == 1
+            assert waiter.report()["ready"] == 0
+        log.info("Test passed successfully")
+
+    def test_other_files(self):
+        log = init_test_log("TestFileWaiter/test_other_files")
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "result.json")
+            waiter = CountingWaiter(deadline=10, stable_seconds=0.1, max_interval=0.2)
+            stop = threading.Event()
+
+            def busy():
+                # another result being written in the same folder
+                while not stop.is_set():
+                    write(os.path.join(directory, "other.json"), mode="wb")
+
+            thread = threading.Thread(target=busy)
+            thread.start()
+            timer = later(1, lambda: write(filename))
+            try:
+                waiter.wait(filename)
+            finally:
+                stop.set()
+                thread.join()
+                timer.join()
+            # only the polls and the events for the file itself, not every write of the other file
+            assert waiter.checks < 30
+        log.info("Test passed successfully")
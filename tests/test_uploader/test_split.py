@@ -0,0 +1,87 @@
+import io
+import json
+import os
+import tempfile
+
+from uploader.split import iter_json_object, split_feature_file, split_feature_results, split_legend_result
+from tests.utilities import init_test_log
+
+
+def polygon_legend(name, count):
+    return {
+        "legend_id": name,
+        "polygon_features": {
+            "type": "FeatureCollection",
+            "features": [{"id": f"{name}-{i}", "geometry": {"coordinates": [[[i, i], [i, i + 1], [i + 1, i]]]}}
+                         for i in range(count)],
+        },
+    }
+
+
+def feature_results(legends=5, features=20):
+    return {
+        "system": "test",
+        "system_version": "0.1",
+        "cog_id": "abc",
+        "polygon_feature_results": [polygon_legend(f"legend{i}", features) for i in range(legends)],
+        "line_feature_results": [],
+        "cog_area_extractions": [{"area_id": i} for i in range(3)],
+    }
+
+
+def features_of(parts):
+    return [f["id"] for part in parts for legend in part["polygon_feature_results"]
+            for f in legend["polygon_features"]["features"]]
+
+
+class TestSplit:
+    def test_split_legend_result(self):
+        log = init_test_log("TestSplit/test_split_legend_result")
+        legend = polygon_legend("legend", 50)
+        assert split_legend_result(legend, 1000000) == [legend]
+        pieces = split_legend_result(legend, 1000)
+        assert len(pieces) > 1
+        assert all(len(json.dumps(p)) <= 1000 for p in pieces)
+        assert all(p["legend_id"] == "legend" and p["polygon_features"]["type"] == "FeatureCollection" for p in pieces)
+        assert [f["id"] for p in pieces for f in p["polygon_features"]["features"]] == \
+            [f["id"] for f in legend["polygon_features"]["features"]]
+        # the original is not changed
+        assert len(legend["polygon_features"]["features"]) == 50
+        # nothing to split
+        assert split_legend_result({"legend_id": "x", "name": "y" * 100}, 10) == [{"legend_id": "x", "name": "y" * 100}]
+        log.info("Test passed successfully")
+
+    def test_split_feature_results(self):
+        log = init_test_log("TestSplit/test_split_feature_results")
+        results = feature_results()
+        assert split_feature_results(results, 10 ** 9) == [results]
+        parts = split_feature_results(results, 2000)
+        assert len(parts) > 1
+        for part in parts:
+            assert len(json.dumps(part)) <= 2000
+            assert (part["system"], part["system_version"], part["cog_id"]) == ("test", "0.1", "abc")
+            assert set(part) == set(results)
+        assert features_of(parts) == features_of([results])
+        assert [a for part in parts for a in part["cog_area_extractions"]] == results["cog_area_extractions"]
+        log.info("Test passed successfully")
+
+    def test_split_feature_file(self):
+        log = init_test_log("TestSplit/test_split_feature_file")
+        results = feature_results(legends=10, features=30)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "results.json")
+            with open(filename, "w") as fh:
+                json.dump(results, fh, indent=2)
+            for max_bytes in [10 ** 9, 5000, 500]:
+                assert list(split_feature_file(filename, max_bytes)) == split_feature_results(results, max_bytes)
+        log.info("Test passed successfully")
+
+    def test_iter_json_object(self):
+        log = init_test_log("TestSplit/test_iter_json_object")
+        data = {"a": 12345, "b": [], "c": [{"x": "y" * 50}, 1.5, "z"], "d": {"e": [1, 2]}}
+        # small chunks make every value span multiple reads
+        fields = list(iter_json_object(io.StringIO(json.dumps(data)), chunk_size=3))
+        assert fields == [("value", "a", 12345), ("list", "b", None), ("list", "c", None), ("item", "c", {"x": "y" * 50}),
+                          ("item", "c", 1.5), ("item", "c", "z"), ("value", "d", {"e": [1, 2]})]
+        assert list(iter_json_object(io.StringIO(" { } "))) == []
+        log.info("Test passed successfully")
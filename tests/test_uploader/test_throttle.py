@@ -0,0 +1,67 @@
+import io
+import os
+import threading
+import time
+
+from uploader.throttle import BandwidthLimiter, ThrottledReader
+from tests.utilities import init_test_log
+
+
+class TestBandwidthLimiter:
+    def test_rate(self):
+        log = init_test_log("TestBandwidthLimiter/test_rate")
+        limiter = BandwidthLimiter(100000)
+        start = time.monotonic()
+        # the first chunk goes right away, the next ones wait for the previous ones
+        for _ in range(6):
+            limiter.consume(10000)
+        elapsed = time.monotonic() - start
+        assert 0.45 <= elapsed < 2
+        log.info("Test passed successfully")
+
+    def test_shared(self):
+        log = init_test_log("TestBandwidthLimiter/test_shared")
+        limiter = BandwidthLimiter(100000)
+        start = time.monotonic()
+        threads = [threading.Thread(target=lambda: [limiter.consume(10000) for _ in range(3)]) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # the workers share the rate, 60000 bytes take 0.5 seconds after the first chunk
+        assert 0.45 <= time.monotonic() - start < 2
+        log.info("Test passed successfully")
+
+    def test_disabled(self):
+        log = init_test_log("TestBandwidthLimiter/test_disabled")
+        limiter = BandwidthLimiter(0)
+        start = time.monotonic()
+        for _ in range(100):
+            limiter.consume(10 ** 9)
+        assert time.monotonic() - start < 0.5
+        log.info("Test passed successfully")
+
+
+class TestThrottledReader:
+    def test_read(self):
+        log = init_test_log("TestThrottledReader/test_read")
+        data = os.urandom(50000)
+        counted = []
+        reader = ThrottledReader(io.BytesIO(data), BandwidthLimiter(200000), counted.append)
+        assert len(reader) == len(data)
+        start = time.monotonic()
+        chunks = list(iter(lambda: reader.read(10000), b""))
+        assert 0.15 <= time.monotonic() - start < 2
+        assert b"".join(chunks) == data
+        assert sum(counted) == len(data)
+        log.info("Test passed successfully")
+
+    def test_length_from_position(self):
+        log = init_test_log("TestThrottledReader/test_length_from_position")
+        fileobj = io.BytesIO(b"0123456789")
+        fileobj.seek(4)
+        reader = ThrottledReader(fileobj, BandwidthLimiter(0))
+        # the whole file is sent, from the start
+        assert len(reader) == 10
+        assert reader.read() == b"0123456789"
+        log.info("Test passed successfully")
@@ -0,0 +1,224 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+import time
+
+
+class Inotify:
+    """
+    Minimal inotify binding using ctypes, used to wake up as soon as a file is
+    created or closed after writing in a folder. Raises OSError if inotify is
+    not available.
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    # struct inotify_event: wd, mask, cookie and len, followed by len bytes of name
+    EVENT = struct.Struct("iIII")
+
+    _libc = None
+
+    def __init__(self):
+        if Inotify._libc is None:
+            Inotify._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(Inotify._libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self.fd = Inotify._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watched = None
+        self.folders = {}
+
+    def watch(self, path):
+        """
+        Watch the folder for new or modified files, folders watched before
+        keep being watched until the notifier is closed.
+        """
+        if path == self.watched:
+            return
+        wd = Inotify._libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+        self.folders[wd] = path
+        self.watched = path
+
+    def read_events(self):
+        """
+        Return the paths of the files in the events that are waiting.
+        """
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        paths = []
+        offset = 0
+        while offset + self.EVENT.size <= len(data):
+            wd, _, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if wd in self.folders and name:
+                paths.append(os.path.join(self.folders[wd], os.fsdecode(name)))
+        return paths
+
+    def wait(self, timeout, paths=None):
+        """
+        Wait for an event for one of paths (any event if None) or the timeout,
+        returns True if there was such an event. Events for other files are
+        read and ignored.
+        """
+        end = time.monotonic() + timeout
+        while True:
+            ready, _, _ = select.select([self.fd], [], [], max(0, end - time.monotonic()))
+            if not ready:
+                return False
+            events = self.read_events()
+            if paths is None or any(path in paths for path in events):
+                return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileWaiter:
+    """
+    Waits for a file to be visible and completely written. The folder is
+    watched with inotify when available, which wakes up as soon as the file is
+    created locally. Changes made on other nodes of a parallel filesystem are
+    not always reported by inotify, so the file is also checked with a poll
+    interval that starts small and backs off up to max_interval, until the
+    deadline. A file is ready once the marker file exists (if a marker suffix
+    is given) and its size has not changed for stable_seconds.
+    """
+    def __init__(self, deadline=300, stable_seconds=2, marker="", min_interval=0.1, max_interval=5,
+                 use_inotify=True):
+        """
+        Args:
+            deadline (float, optional): Maximum seconds to wait for the file. Defaults to 300.
+            stable_seconds (float, optional): Seconds the size has to be unchanged. Defaults to 2.
+            marker (str, optional): Suffix of a marker file written once the file is complete,
+                for example ".done". Defaults to "", no marker file.
+            min_interval (float, optional): First poll interval in seconds. Defaults to 0.1.
+            max_interval (float, optional): Largest poll interval in seconds. Defaults to 5.
+            use_inotify (bool, optional): Use inotify if available. Defaults to True.
+        """
+        self.deadline = deadline
+        self.stable_seconds = stable_seconds
+        self.marker = marker
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.use_inotify = use_inotify
+        self.ready = 0
+        self.timeouts = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def _is_ready(self, filename, state):
+        """
+        Check if the file exists, the marker exists and the size is stable.
+        state keeps the last seen size and when it was first seen.
+        """
+        if self.marker and not os.path.exists(filename + self.marker):
+            return False
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            return False
+        now = time.time()
+        # not modified recently, no need to wait for the size to be stable
+        if now - stat.st_mtime >= self.stable_seconds:
+            return True
+        if state.get("size") != stat.st_size:
+            state["size"] = stat.st_size
+            state["since"] = now
+            return False
+        return now - state["since"] >= self.stable_seconds
+
+    @staticmethod
+    def _existing_folder(filename):
+        folder = os.path.dirname(os.path.abspath(filename))
+        while not os.path.isdir(folder) and folder != os.path.dirname(folder):
+            folder = os.path.dirname(folder)
+        return folder
+
+    def _watched_paths(self, filename, folder):
+        """
+        Return the paths in folder whose events mean the file could be ready,
+        the file and its marker, or the next folder on the way to the file.
+        """
+        filename = os.path.abspath(filename)
+        if folder == os.path.dirname(filename):
+            return {filename, filename + self.marker}
+        return {os.path.join(folder, os.path.relpath(filename, folder).split(os.sep)[0])}
+
+    def wait(self, filename):
+        """
+        Wait for the file to be ready.
+
+        Returns:
+            float: The number of seconds it took for the file to be ready.
+
+        Raises:
+            ValueError: If the file was not ready before the deadline.
+        """
+        start = time.monotonic()
+        state = {}
+        interval = self.min_interval
+        notifier = None
+        if self.use_inotify:
+            try:
+                notifier = Inotify()
+            except (OSError, AttributeError):
+                logging.debug("inotify not available, polling for files", exc_info=True)
+        try:
+            while not self._is_ready(filename, state):
+                remaining = self.deadline - (time.monotonic() - start)
+                if remaining <= 0:
+                    with self._lock:
+                        self.timeouts += 1
+                    raise ValueError(f"File {filename} is not ready after {self.deadline} seconds")
+                timeout = min(interval, remaining)
+                if "since" in state:
+                    # check again as soon as the size could be stable
+                    timeout = min(timeout, max(0.05, state["since"] + self.stable_seconds - time.time()))
+                if notifier is not None:
+                    try:
+                        folder = self._existing_folder(filename)
+                        notifier.watch(folder)
+                        if notifier.wait(timeout, self._watched_paths(filename, folder)):
+                            continue
+                    except OSError:
+                        logging.debug("inotify failed, polling for files", exc_info=True)
+                        notifier.close()
+                        notifier = None
+                        time.sleep(timeout)
+                else:
+                    time.sleep(timeout)
+                interval = min(interval * 2, self.max_interval)
+        finally:
+            if notifier is not None:
+                notifier.close()
+        seconds = time.monotonic() - start
+        with self._lock:
+            self.ready += 1
+            self.total_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+        return seconds
+
+    def report(self):
+        """
+        Return the time to visibility statistics.
+        """
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "timeouts": self.timeouts,
+                "average_seconds": self.total_seconds / self.ready if self.ready else 0.0,
+                "max_seconds": self.max_seconds,
+            }
@@ -0,0 +1,75 @@
+import logging
+import os
+import time
+
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY, start_http_server, write_to_textfile
+
+# buckets used for the time to upload a file, in seconds
+DURATION_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+# buckets used for the time a message waits in the queue, in seconds
+WAIT_BUCKETS = (1, 5, 15, 30, 60, 300, 900, 1800, 3600, 7200, 21600, 86400)
+
+BYTES = Counter(
+    "uploader_bytes_total", "Bytes uploaded, after compression")
+
+FILE_SECONDS = Histogram(
+    "uploader_file_seconds", "Time to upload a file, by mode (single or split)",
+    ["mode"], buckets=DURATION_BUCKETS)
+
+TIME_TO_VISIBLE_SECONDS = Histogram(
+    "uploader_time_to_visible_seconds", "Time to wait for the file to be ready",
+    buckets=DURATION_BUCKETS)
+
+INFLIGHT = Gauge(
+    "uploader_inflight", "Messages being uploaded")
+
+QUEUE_WAIT_SECONDS = Histogram(
+    "uploader_queue_wait_seconds", "Time between publishing a message and starting the upload",
+    buckets=WAIT_BUCKETS)
+
+MESSAGES = Counter(
+    "uploader_messages_total", "Messages handled, by result (success, retry or error)",
+    ["result"])
+
+_metrics_file = os.getenv("METRICS_FILE", "")
+_metrics_file_interval = float(os.getenv("METRICS_FILE_INTERVAL", "15"))
+_metrics_file_written = 0
+
+
+def start_metrics(port):
+    """
+    Expose the metrics on the port, 0 disables the http server.
+    """
+    if port > 0:
+        start_http_server(port)
+        logging.info(f"Metrics available on port {port}")
+    if _metrics_file:
+        logging.info(f"Writing metrics to {_metrics_file}")
+
+
+def observe_queue_wait(properties):
+    """
+    Record the time the message waited in the queue, if it has a timestamp.
+    """
+    timestamp = getattr(properties, "timestamp", None)
+    if timestamp:
+        QUEUE_WAIT_SECONDS.observe(max(0, time.time() - timestamp))
+
+
+def write_metrics_file(force=False):
+    """
+    Write the metrics to METRICS_FILE (for example for the node exporter
+    textfile collector), at most once every METRICS_FILE_INTERVAL seconds.
+    """
+    global _metrics_file_written
+
+    if not _metrics_file:
+        return
+    if not force and time.monotonic() - _metrics_file_written < _metrics_file_interval:
+        return
+    try:
+        write_to_textfile(_metrics_file, REGISTRY)
+    except OSError:
+        logging.warning(f"Could not write metrics to {_metrics_file}", exc_info=True)
+    _metrics_file_written = time.monotonic()
@@ -0,0 +1,199 @@
+import copy
+import json
+import logging
+
+# size of the blocks read from the file when splitting it
+read_chunk_size = 1024 * 1024
+
+
+def split_legend_result(item, max_bytes):
+    """
+    Split a single legend result (for example a polygon legend with its
+    polygon_features) into multiple copies of the legend result, each with a
+    part of the features, so each copy is less than max_bytes. A single
+    feature larger than max_bytes is returned by itself.
+    """
+    if not isinstance(item, dict) or len(json.dumps(item)) <= max_bytes:
+        return [item]
+    key = next((k for k, v in item.items() if isinstance(v, dict) and isinstance(v.get("features"), list)), None)
+    if key is None:
+        return [item]
+    template = copy.copy(item)
+    template[key] = {k: v for k, v in item[key].items() if k != "features"}
+    available = max_bytes - len(json.dumps(template)) - len('"features": []')
+    pieces = []
+    features = []
+    size = 0
+    for feature in item[key]["features"]:
+        feature_size = len(json.dumps(feature)) + 2
+        if features and size + feature_size > available:
+            pieces.append(features)
+            features = []
+            size = 0
+        features.append(feature)
+        size += feature_size
+    if features:
+        pieces.append(features)
+    result = []
+    for features in pieces:
+        piece = copy.copy(template)
+        piece[key] = {**template[key], "features": features}
+        result.append(piece)
+    return result
+
+
+def _split(empty, items, max_bytes):
+    """
+    Divide the (key, item) pairs over copies of empty, yielding each part as
+    soon as adding the next item would make it larger than max_bytes.
+    """
+    available = max(1, max_bytes - len(json.dumps(empty)))
+    current = copy.deepcopy(empty)
+    size = 0
+    parts = 0
+    for key, item in items:
+        for piece in split_legend_result(item, available):
+            piece_size = len(json.dumps(piece)) + 2
+            if size > 0 and size + piece_size > available:
+                yield current
+                parts += 1
+                current = copy.deepcopy(empty)
+                size = 0
+            if piece_size > available:
+                logging.warning(f"Feature in {key} is {piece_size} bytes, larger than the maximum upload size")
+            current[key].append(piece)
+            size += piece_size
+    if size > 0 or parts == 0:
+        yield current
+
+
+def split_feature_results(results, max_bytes):
+    """
+    Split the feature results into multiple feature results, each less than
+    max_bytes when encoded as json. Every part has the same system,
+    system_version and cog_id, the lists (line/point/polygon feature results,
+    area and metadata extractions) are divided over the parts. Legend results
+    that are too large by themselves are split by their features.
+
+    Returns:
+        list: The feature results to upload, each a valid publish request.
+    """
+    list_keys = [k for k, v in results.items() if isinstance(v, list)]
+    empty = {k: [] if k in list_keys else v for k, v in results.items()}
+    items = ((key, item) for key in list_keys for item in results[key])
+    return list(_split(empty, items, max_bytes))
+
+
+def split_feature_file(filename, max_bytes):
+    """
+    Split the feature results in the file the same way as split_feature_results,
+    without loading the whole file. The file is read twice, once for the
+    fields that are not lists and once for the items of the lists, so only
+    one item and the part being built are in memory. The parts are always
+    the same for the same file and max_bytes.
+
+    Yields:
+        dict: The feature results to upload, each a valid publish request.
+    """
+    with open(filename, "r", encoding="utf-8") as fh:
+        empty = {key: [] if kind == "list" else value for kind, key, value in iter_json_object(fh) if kind != "item"}
+    with open(filename, "r", encoding="utf-8") as fh:
+        items = ((key, value) for kind, key, value in iter_json_object(fh) if kind == "item")
+        yield from _split(empty, items, max_bytes)
+
+
+class JsonReader:
+    """
+    Reads json values one at a time from a file, keeping only the part of the
+    file that is not decoded yet in memory.
+    """
+    decoder = json.JSONDecoder()
+
+    def __init__(self, fileobj, chunk_size=None):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size or read_chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size):
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        data = self.fileobj.read(size)
+        if not data:
+            self.eof = True
+            return False
+        self.buffer += data
+        return True
+
+    def peek(self):
+        """
+        Return the next character that is not whitespace, without consuming it.
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill(self.chunk_size):
+                raise ValueError("Unexpected end of json file")
+
+    def expect(self, chars):
+        """
+        Consume the next character that is not whitespace, which should be one of chars.
+        """
+        char = self.peek()
+        if char not in chars:
+            raise ValueError(f"Expected one of {chars!r} in json file, found {char!r}")
+        self.pos += 1
+        return char
+
+    def decode(self):
+        """
+        Decode the next json value, reading more of the file until it is complete.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number at the end of the buffer might continue in the file
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # read at least as much as is buffered, so large values are not decoded too often
+            self._fill(max(self.chunk_size, len(self.buffer)))
+
+
+def iter_json_object(fileobj, chunk_size=None):
+    """
+    Iterate over the fields of the json object in the file, the items of a
+    list are returned one at a time.
+
+    Yields:
+        tuple: ("value", key, value) for fields that are not lists, ("list", key, None)
+            at the start of a list and ("item", key, item) for each item of the list.
+    """
+    reader = JsonReader(fileobj, chunk_size)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+    while True:
+        key = reader.decode()
+        reader.expect(":")
+        if reader.peek() == "[":
+            reader.expect("[")
+            yield "list", key, None
+            if reader.peek() == "]":
+                reader.expect("]")
+            else:
+                while True:
+                    yield "item", key, reader.decode()
+                    if reader.expect(",]") == "]":
+                        break
+        else:
+            yield "value", key, reader.decode()
+        if reader.expect(",}") == "}":
+            return
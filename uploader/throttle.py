@@ -0,0 +1,49 @@
+import io
+import threading
+import time
+
+
+class BandwidthLimiter:
+    """
+    Limits the total upload rate of all workers to rate bytes per second. Each
+    chunk reserves the time it takes to send at the given rate, a worker waits
+    until the chunks sent before it are done. A rate of 0 disables the limit.
+    """
+    def __init__(self, rate=0):
+        self.rate = rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, size):
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + size / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class ThrottledReader:
+    """
+    File like object that reads from a file using the bandwidth limiter, the
+    length is known so requests still sends a Content-Length. If progress is
+    given it is called with the size of each block read, for example to count
+    the bytes uploaded.
+    """
+    def __init__(self, fileobj, limiter, progress=None):
+        self.fileobj = fileobj
+        self.limiter = limiter
+        self.progress = progress
+        self.length = fileobj.seek(0, io.SEEK_END) - fileobj.seek(0)
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.limiter.consume(len(data))
+        if self.progress is not None:
+            self.progress(len(data))
+        return data